@@ -7,6 +7,7 @@ from django.contrib import messages
 from django.db import transaction
 from django.http import JsonResponse
 from django.shortcuts import redirect
+from django.utils import timezone
 
 from mlarchive.archive.tasks import remove_selected_task, mark_not_spam_task
 
@@ -29,7 +30,7 @@ def remove_selected(request, queryset):
     Our _message_remove receiver will handle moving the message file to the "removed"
     directory
     """
-    queryset.update(spam_score=settings.SPAM_SCORE_TO_REMOVE)
+    queryset.update(spam_score=settings.SPAM_SCORE_TO_REMOVE, updated=timezone.now())
     transaction.on_commit(
         lambda: remove_selected_task.delay(user_id=request.user.id)
     )
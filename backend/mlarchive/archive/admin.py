@@ -1,6 +1,6 @@
 from django.contrib import admin
 from mlarchive.archive.models import (Message, EmailList, Attachment, Thread,
-    Redirect, UserEmail, MailmanMember, Subscriber)
+    Redirect, UserEmail, MailmanMember, Subscriber, ImportCheckpoint)
 
 
 class MessageAdmin(admin.ModelAdmin):
@@ -31,3 +31,4 @@ admin.site.register(Redirect)
 admin.site.register(Subscriber)
 admin.site.register(UserEmail, UserEmailAdmin)
 admin.site.register(MailmanMember, MailmanMemberAdmin)
+admin.site.register(ImportCheckpoint)
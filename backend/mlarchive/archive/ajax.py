@@ -151,13 +151,13 @@ def get_browse_results_gbt(reference_message, direction):
     if direction == 'next':
         thread = reference_message.thread.get_previous()
         while len(results) < buffer and thread:
-            results.extend(thread.message_set.order_by('thread_order'))
+            results.extend(thread.get_messages())
             thread = thread.get_previous()
     elif direction == 'previous':
         thread = reference_message.thread.get_next()
         while len(results) < buffer and thread:
             # prepend to results
-            results = list(thread.message_set.order_by('thread_order')) + results
+            results = thread.get_messages() + results
             thread = thread.get_next()
     return results
 
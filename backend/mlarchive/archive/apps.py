@@ -11,6 +11,10 @@ class ArchiveConfig(AppConfig):
 
     def ready(self):
         import mlarchive.archive.signals    # noqa
+        from mlarchive.archive.inspectors import get_inspectors
+
+        # resolve the inspectors once, this also checks the INSPECTORS setting
+        get_inspectors()
         
         # Setup the signal processor.
         if not self.signal_processor:
@@ -1,22 +1,65 @@
 import logging
+import os
 import re
+import threading
 
 from elasticsearch import Elasticsearch, TransportError
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import bulk, parallel_bulk
 from elasticsearch_dsl import Search, A, Q
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db.models import prefetch_related_objects
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import force_str
 
 from mlarchive.archive.query_utils import (queries_from_params,
     filters_from_params, get_order_fields, generate_queryid, parse_query)
+from mlarchive.archive.models import Message
 from mlarchive.archive.utils import get_noauth
 
 logger = logging.getLogger(__name__)
 IDENTIFIER_REGEX = re.compile(r'^[\w\d_]+\.[\w\d_]+\.[\w\d-]+$')
 
+# process wide client, see get_client()
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+# indexes known to exist in this process, see ESBackend.setup()
+_setup_indices = set()
+
+
+def get_client():
+    '''Returns the Elasticsearch client of this process.  The client is thread
+    safe and keeps a pool of persistent connections, size and timeouts are set
+    with ELASTICSEARCH_CONNECTION['KWARGS'].  Forked processes get their own
+    client, connections can't be shared across processes'''
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                connection_options = settings.ELASTICSEARCH_CONNECTION
+                _client = Elasticsearch(
+                    connection_options['URL'],
+                    index=connection_options['INDEX_NAME'],
+                    http_auth=connection_options['http_auth'],
+                    **connection_options.get('KWARGS', {}))
+                _client_pid = pid
+                _setup_indices.clear()
+    return _client
+
+
+@receiver(setting_changed)
+def _reset_client(setting, **kwargs):
+    global _client
+    if setting in ('ELASTICSEARCH_CONNECTION', 'ELASTICSEARCH_INDEX_NAME'):
+        _client = None
+        _setup_indices.clear()
+
 
 def prep_text(message):
     '''Prepare the "text" field that is used as the default field for
@@ -53,6 +96,45 @@ def full_prepare(message):
     return prepared_data
 
 
+def prepare_document(message):
+    '''Returns the bulk index action for message, or None if it can't be prepared'''
+    try:
+        prepped_data = full_prepare(message)
+        # final_data = {}
+
+        # Convert the data to make sure it's happy.
+        # - handled already (dates=isoformat, no binary)
+        # for key, value in prepped_data.items():
+        #     final_data[key] = self._from_python(value)
+
+        # what is this for?
+        # final_data['_id'] = final_data['id']
+        prepped_data['_id'] = prepped_data['id']
+        return prepped_data
+    # except SkipDocument:
+    #     log.debug(u"Indexing for object `%s` skipped", obj)
+    except TransportError as e:
+        if not settings.ELASTICSEARCH_SILENTLY_FAIL:
+            raise
+
+        # We'll log the object identifier but won't include the actual object
+        # to avoid the possibility of that generating encoding errors while
+        # processing the log message:
+        extra = {"data": {"index": settings.ELASTICSEARCH_INDEX_NAME,
+                          "object": force_str(message.pk)}}
+        logger.error(
+            u"%s while preparing object for update" % e.__class__.__name__,
+            exc_info=True,
+            extra=extra)
+
+
+def prepare_documents(pks):
+    '''Returns the bulk index actions for the messages with pks.  Runs in the
+    process pool of ESBackend.update(), the messages are read by the worker'''
+    messages = Message.objects.filter(pk__in=pks).select_related('email_list', 'thread').order_by('pk')
+    return [doc for doc in map(prepare_document, messages) if doc is not None]
+
+
 class ESBackend():
     """Elasticsearch Backend"""
 
@@ -107,7 +189,16 @@ class ESBackend():
         }
     }
 
-    def __init__(self):
+    # index settings while loading a new index, see create_index()
+    BULK_SETTINGS = {
+        "number_of_replicas": 0,
+        "refresh_interval": "-1",
+    }
+
+    def __init__(self, index_name=None):
+        '''Searches and writes go through the alias INDEX_NAME, which points at a
+        versioned index, see switch_alias().  Pass index_name to write to another
+        index, ie. one that is being built'''
         connection_options = settings.ELASTICSEARCH_CONNECTION
         if 'URL' not in connection_options:
             raise ImproperlyConfigured("You must specify a 'URL' in your settings for connection Elasticsearch.")
@@ -115,41 +206,116 @@ class ESBackend():
         if 'INDEX_NAME' not in connection_options:
             raise ImproperlyConfigured("You must specify a 'INDEX_NAME' in your settings for connection Elasticsearch.")
 
-        self.client = Elasticsearch(
-            connection_options['URL'],
-            index=connection_options['INDEX_NAME'],
-            http_auth=connection_options['http_auth'],
-            **connection_options.get('KWARGS', {}))
-        self.index_name = connection_options['INDEX_NAME']
+        self.client = get_client()
+        self.alias = connection_options['INDEX_NAME']
+        self.index_name = index_name or self.alias
         self.log = logging.getLogger(__name__)
         self.mapping = settings.ELASTICSEARCH_INDEX_MAPPINGS
-        self.setup_complete = False
+        self.setup_complete = self.index_name in _setup_indices
         self.silently_fail = connection_options.get('SILENTLY_FAIL', True)
 
     def setup(self):
         """
         If the index doesn't exist, create it and set mappings. You can't
-        change mappings of existing indexes.
+        change mappings of existing indexes.  The alias gets a new versioned
+        index.  Checked once per process and index.
         """
         if not self.client.indices.exists(index=self.index_name):
-            self.client.indices.create(index=self.index_name,
-                                       settings=self.DEFAULT_SETTINGS)
-            self.client.indices.put_mapping(index=self.index_name,
-                                            body=self.mapping)
+            if self.index_name == self.alias:
+                self.switch_alias(self.create_index())
+            else:
+                self.create_index(self.index_name)
 
+        _setup_indices.add(self.index_name)
         self.setup_complete = True
 
+    def create_index(self, index_name=None, bulk=False):
+        '''Creates an index with settings and mappings and returns its name, by
+        default a new versioned name for the alias.  With bulk the index has no
+        replicas and no refresh, for loading at full speed, call finish_bulk()
+        when done'''
+        if index_name is None:
+            index_name = '{}-{}'.format(self.alias, timezone.now().strftime('%Y%m%d%H%M%S%f'))
+        index_settings = dict(self.DEFAULT_SETTINGS)
+        if bulk:
+            index_settings.update(self.BULK_SETTINGS)
+        self.client.indices.create(index=index_name,
+                                   settings=index_settings)
+        self.client.indices.put_mapping(index=index_name,
+                                        body=self.mapping)
+        return index_name
+
+    def finish_bulk(self, index_name):
+        '''Restores replicas and refresh of an index created with bulk=True,
+        replicas as in the live index, and makes its documents visible'''
+        replicas = None
+        for name in self.get_alias_indices():
+            index_settings = self.client.indices.get_settings(index=name, name='index.number_of_replicas')
+            replicas = index_settings[name]['settings']['index']['number_of_replicas']
+        # None restores the default
+        self.client.indices.put_settings(index=index_name,
+                                         body={'index': {'number_of_replicas': replicas,
+                                                         'refresh_interval': None}})
+        self.client.indices.refresh(index=index_name)
+
+    def get_alias_indices(self):
+        '''Returns names of the indexes the alias points at.  Empty if there is
+        no alias, or a concrete index has the alias name'''
+        if not self.client.indices.exists_alias(name=self.alias):
+            return []
+        return list(self.client.indices.get_alias(name=self.alias).keys())
+
+    def switch_alias(self, index_name):
+        '''Points the alias at index_name, in one atomic request, and deletes the
+        indexes it pointed at.  A concrete index with the alias name, from before
+        aliases were used, is replaced'''
+        old_indices = self.get_alias_indices()
+        actions = [{'add': {'index': index_name, 'alias': self.alias}}]
+        if old_indices:
+            actions.extend({'remove': {'index': name, 'alias': self.alias}} for name in old_indices)
+        elif self.client.indices.exists(index=self.alias):
+            actions.append({'remove_index': {'index': self.alias}})
+        self.client.indices.update_aliases(body={'actions': actions})
+        for name in old_indices:
+            if name != index_name:
+                self.client.indices.delete(index=name, ignore=404)
+        logger.info('index alias {} switched to {}, removed {}'.format(self.alias, index_name, old_indices))
+
+    def delete_index(self, index_name):
+        '''Deletes index_name, ie. an index that was being built when it failed'''
+        self.client.indices.delete(index=index_name, ignore=404)
+        _setup_indices.discard(index_name)
+
     def clear(self, commit=True):
         '''Clears index of all data, and runs setup, leaving
         an empty index.'''
         logger.debug('ESBackend.clear() called.')
-        self.client.indices.delete(index=self.index_name, ignore=404)
+        indices = self.get_alias_indices() if self.index_name == self.alias else []
+        for name in indices or [self.index_name]:
+            self.client.indices.delete(index=name, ignore=404)
+        _setup_indices.discard(self.index_name)
         self.setup()
 
-    def update(self, iterable, commit=True):
-        '''Update index records using iterable of instances'''
-        logger.debug('ESBackend.update() called. iterable={}, iterable_length={}, last_message={}, commit={}, setup_complete={}'.format(
-            type(iterable), len(iterable), iterable[-1].django_id, commit, self.setup_complete))
+    def refresh(self):
+        '''Make all writes to the index visible to searches now.  Writes become
+        visible with the index refresh interval anyway, use this after large
+        updates that need to be searchable right away'''
+        self.client.indices.refresh(index=self.index_name)
+
+    def update(self, iterable, refresh=False, pool=None):
+        '''Update index records using iterable of instances.  By default the
+        records become searchable with the next scheduled refresh of the index,
+        pass refresh='wait_for' to return only once they are visible (or True
+        to force a refresh).
+
+        Related email_list and thread rows are loaded for all instances at once.
+        Pass a multiprocessing pool to prepare the documents, ie. extract the
+        text, in parallel, the workers read the messages by pk.  Documents are
+        prepared before sending, so the sending threads don't use the database.
+        Batches larger than ELASTICSEARCH_BULK_CHUNK_SIZE are sent by several
+        threads'''
+        logger.debug('ESBackend.update() called. iterable={}, iterable_length={}, last_message={}, refresh={}, setup_complete={}'.format(
+            type(iterable), len(iterable), iterable[-1].django_id, refresh, self.setup_complete))
 
         if not self.setup_complete:
             try:
@@ -160,49 +326,56 @@ class ESBackend():
                 self.log.error("Failed to add documents to Elasticsearch: %s", e, exc_info=True)
                 return
 
-        prepped_docs = []
-        for obj in iterable:
-            try:
-                prepped_data = full_prepare(obj)
-                # final_data = {}
-
-                # Convert the data to make sure it's happy.
-                # - handled already (dates=isoformat, no binary)
-                # for key, value in prepped_data.items():
-                #     final_data[key] = self._from_python(value)
+        if pool:
+            pks = [obj.pk for obj in iterable]
+            prepped_docs = []
+            for docs in pool.imap(prepare_documents, [pks[i:i + 10] for i in range(0, len(pks), 10)]):
+                prepped_docs.extend(docs)
+        else:
+            prefetch_related_objects(iterable, 'email_list', 'thread')
+            prepped_docs = [doc for doc in map(prepare_document, iterable) if doc is not None]
+
+        chunk_size = settings.ELASTICSEARCH_BULK_CHUNK_SIZE
+        if len(iterable) > chunk_size:
+            results = [0, 0]
+            for ok, info in parallel_bulk(self.client, prepped_docs,
+                                          index=self.index_name,
+                                          refresh=refresh,
+                                          chunk_size=chunk_size,
+                                          thread_count=settings.ELASTICSEARCH_BULK_THREADS):
+                results[0 if ok else 1] += 1
+        else:
+            results = bulk(self.client, prepped_docs,
+                           index=self.index_name,
+                           refresh=refresh,
+                           chunk_size=chunk_size)
+        logger.debug('ESBackend.update() bulk results={}'.format(results))
 
-                # what is this for?
-                # final_data['_id'] = final_data['id']
-                prepped_data['_id'] = prepped_data['id']
+    def remove(self, obj_or_string, refresh=False):
+        """Remove record from index.  See update() for refresh"""
+        doc_id = get_identifier(obj_or_string)
 
-                prepped_docs.append(prepped_data)
-            # except SkipDocument:
-            #     log.debug(u"Indexing for object `%s` skipped", obj)
+        if not self.setup_complete:
+            try:
+                self.setup()
             except TransportError as e:
-                if not settings.ELASTICSEARCH_SILENTLY_FAIL:
+                if not self.silently_fail:
                     raise
 
-                # We'll log the object identifier but won't include the actual object
-                # to avoid the possibility of that generating encoding errors while
-                # processing the log message:
-                extra = {"data": {"index": self.index_name,
-                                  "object": force_str(obj.pk)}}
-                logger.error(
-                    u"%s while preparing object for update" % e.__class__.__name__,
-                    exec_info=True,
-                    extra=extra)
-
-        results = bulk(self.client, prepped_docs,
-                       index=self.index_name)
-        logger.debug('ESBackend.update() bulk results={}'.format(results))
+                self.log.error("Failed to remove document '%s' from Elasticsearch: %s", doc_id, e,
+                               exc_info=True)
+                return
 
-        if commit:
-            self.client.indices.refresh(index=self.index_name)
+        try:
+            self.client.delete(index=self.index_name, id=doc_id, ignore=404, refresh=refresh)
+        except TransportError as e:
+            if not self.silently_fail:
+                raise
 
-    def remove(self, obj_or_string, commit=True):
-        """Remove record from index"""
-        doc_id = get_identifier(obj_or_string)
+            self.log.error("Failed to remove document '%s' from Elasticsearch: %s", doc_id, e, exc_info=True)
 
+    def remove_many(self, identifiers, refresh=False):
+        """Remove records from index with one bulk request.  See update() for refresh"""
         if not self.setup_complete:
             try:
                 self.setup()
@@ -210,32 +383,120 @@ class ESBackend():
                 if not self.silently_fail:
                     raise
 
-                self.log.error("Failed to remove document '%s' from Elasticsearch: %s", doc_id, e,
-                               exc_info=True)
+                self.log.error("Failed to remove documents from Elasticsearch: %s", e, exc_info=True)
                 return
 
+        actions = [{'_op_type': 'delete', '_id': get_identifier(i)} for i in identifiers]
+        try:
+            # missing documents are not an error
+            bulk(self.client, actions, index=self.index_name, raise_on_error=False, refresh=refresh)
+        except TransportError as e:
+            if not self.silently_fail:
+                raise
+
+            self.log.error("Failed to remove documents from Elasticsearch: %s", e, exc_info=True)
+
+    def scan_ids(self, batch_size=1000, keep_alive='5m'):
+        """Yields (django_id, id) of all records, in django_id order.  Pages through a
+        point in time of the index with search_after, one page in memory at a time
+        """
+        pit_id = self.client.open_point_in_time(index=self.index_name, keep_alive=keep_alive)['id']
+        search_after = None
         try:
-            self.client.delete(index=self.index_name, id=doc_id, ignore=404)
+            while True:
+                body = {
+                    'size': batch_size,
+                    '_source': False,
+                    'pit': {'id': pit_id, 'keep_alive': keep_alive},
+                    'sort': [{'django_id': 'asc'}],
+                }
+                if search_after:
+                    body['search_after'] = search_after
+                response = self.client.search(body=body)
+                pit_id = response['pit_id']
+                hits = response['hits']['hits']
+                for hit in hits:
+                    yield hit['sort'][0], hit['_id']
+                if len(hits) < batch_size:
+                    return
+                search_after = hits[-1]['sort']
+        finally:
+            self.client.close_point_in_time(body={'id': pit_id})
+
+    def shift_thread_order(self, thread_id, start, exclude=None, refresh=False):
+        """Increment thread_order of records in thread_id with thread_order >= start,
+        in place.  Mirrors the database update made when a message is inserted into
+        the middle of a thread.  Use exclude to skip the (already indexed) new message.
+        update_by_query doesn't support "wait_for", any true refresh refreshes the index
+        """
+        query = {'bool': {'filter': [{'term': {'thread_id': thread_id}},
+                                     {'range': {'thread_order': {'gte': start}}}]}}
+        if exclude is not None:
+            query['bool']['must_not'] = [{'term': {'django_id': exclude}}]
+        script = {'source': 'ctx._source.thread_order += 1', 'lang': 'painless'}
 
-            if commit:
-                self.client.indices.refresh(index=self.index_name)
+        try:
+            self.client.update_by_query(index=self.index_name,
+                                        body={'query': query, 'script': script},
+                                        conflicts='proceed',
+                                        refresh=bool(refresh))
         except TransportError as e:
             if not self.silently_fail:
                 raise
 
-            self.log.error("Failed to remove document '%s' from Elasticsearch: %s", doc_id, e, exc_info=True)
+            self.log.error("Failed to shift thread %s in Elasticsearch: %s", thread_id, e, exc_info=True)
+
+    def set_thread_orders(self, thread_id, orders, refresh=False):
+        """Set thread_order of records in thread_id, in place.  orders maps message
+        pks to their thread_order.  Unlike shift_thread_order() this can be repeated
+        safely.  See shift_thread_order() for refresh
+        """
+        orders = {force_str(pk): order for pk, order in orders.items()}
+        query = {'bool': {'filter': [{'term': {'thread_id': thread_id}},
+                                     {'terms': {'django_id': list(orders)}}]}}
+        script = {'source': 'ctx._source.thread_order = params.orders[ctx._source.django_id]',
+                  'lang': 'painless',
+                  'params': {'orders': orders}}
+
+        try:
+            self.client.update_by_query(index=self.index_name,
+                                        body={'query': query, 'script': script},
+                                        conflicts='proceed',
+                                        refresh=bool(refresh))
+        except TransportError as e:
+            if not self.silently_fail:
+                raise
+
+            self.log.error("Failed to set thread %s order in Elasticsearch: %s", thread_id, e, exc_info=True)
+
+    def update_thread_date(self, thread_id, date, refresh=False):
+        """Set thread_date of all records in thread_id, in place, so the messages
+        of a thread don't need to be prepared again when its first message changes.
+        See shift_thread_order() for refresh
+        """
+        query = {'bool': {'filter': [{'term': {'thread_id': thread_id}}],
+                          'must_not': [{'term': {'thread_date': date.isoformat()}}]}}
+        script = {'source': 'ctx._source.thread_date = params.thread_date',
+                  'lang': 'painless',
+                  'params': {'thread_date': date.isoformat()}}
+
+        try:
+            self.client.update_by_query(index=self.index_name,
+                                        body={'query': query, 'script': script},
+                                        conflicts='proceed',
+                                        refresh=bool(refresh))
+        except TransportError as e:
+            if not self.silently_fail:
+                raise
+
+            self.log.error("Failed to update thread %s date in Elasticsearch: %s", thread_id, e, exc_info=True)
 
 
 class ElasticsearchSimpleQuery():
     '''Class for creating custom Elasticsearch Search query objects'''
 
     def __init__(self):
-        connection_options = settings.ELASTICSEARCH_CONNECTION
-        self.client = Elasticsearch(
-            connection_options['URL'],
-            index=connection_options['INDEX_NAME'],
-            http_auth=connection_options['http_auth'],
-            **connection_options.get('KWARGS', {}))
+        self.client = get_client()
         self.search = Search(using=self.client, index=settings.ELASTICSEARCH_INDEX_NAME)
 
 
@@ -249,12 +510,7 @@ class ElasticsearchQuery():
     def __init__(self, form, email_list=None, skip_facets=False):
         self.form = form
         self.request = form.request
-        connection_options = settings.ELASTICSEARCH_CONNECTION
-        self.client = Elasticsearch(
-            connection_options['URL'],
-            index=connection_options['INDEX_NAME'],
-            http_auth=connection_options['http_auth'],
-            **connection_options.get('KWARGS', {}))
+        self.client = get_client()
         self.search = Search(using=self.client, index=settings.ELASTICSEARCH_INDEX_NAME)
         self.skip_facets = skip_facets
         self.email_list = email_list
@@ -5,10 +5,19 @@ The value of the entry is a dictionary of options.
 
 Supported Options:
 "includes": a list of list names to act upon. If not present acts on all lists
+
+The configured inspectors are looked up in the Inspector registry once, see
+get_inspectors().  Inspectors with header_only = True only look at
+message_wrapper.headers and run ahead of the others.
 '''
 
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+_inspectors = None
 
 
 def is_no_archive(email_message):
@@ -21,6 +30,31 @@ def is_no_archive(email_message):
     return False
 
 
+def get_inspectors():
+    '''Returns the inspectors configured in settings.INSPECTORS as a list of
+    (class, options), header only inspectors first.  The list is built once
+    '''
+    global _inspectors
+    if _inspectors is None:
+        inspectors = []
+        for name, options in getattr(settings, 'INSPECTORS', {}).items():
+            try:
+                inspector_class = Inspector.registry[name.lower()]
+            except KeyError:
+                raise ImproperlyConfigured('Unknown inspector in INSPECTORS: {}'.format(name))
+            inspectors.append((inspector_class, options))
+        inspectors.sort(key=lambda item: not item[0].header_only)
+        _inspectors = inspectors
+    return _inspectors
+
+
+@receiver(setting_changed)
+def _reset_inspectors(setting, **kwargs):
+    global _inspectors
+    if setting == 'INSPECTORS':
+        _inspectors = None
+
+
 class InspectorMessage(Exception):
     pass
 
@@ -49,12 +83,14 @@ class InspectorMeta(type):
 class Inspector(object, metaclass=InspectorMeta):
     '''The base class for inspector classes.  Takes a MessageWrapper object and listname
     (string).  Inherit from this class and implement has_condition(), handle_file(),
-    raise_error() methods.  Call inspect() to run inspection.'''
+    raise_error() methods.  Call inspect() to run inspection.
+    Set header_only if has_condition() only needs message_wrapper.headers'''
+    header_only = False
 
     def __init__(self, message_wrapper, options=None):
         self.message_wrapper = message_wrapper
         self.listname = message_wrapper.listname
-        if options:
+        if options is not None:
             self.options = options
         else:
             self.options = settings.INSPECTORS.get(self.__class__.__name__)
@@ -95,8 +131,10 @@ class SpamInspector(Inspector):
 class ListIdSpamInspector(SpamInspector):
     '''Checks for missing or bogus List-Id header (doesn't contain listname).  If so,
     message is spam (has_condition = True)'''
+    header_only = True
+
     def has_condition(self):
-        listid = self.message_wrapper.email_message.get('List-Id')
+        listid = self.message_wrapper.headers.get('List-Id')
         if listid and self.listname in listid:
             return False
         else:
@@ -105,8 +143,10 @@ class ListIdSpamInspector(SpamInspector):
 
 class ListIdExistsSpamInspector(SpamInspector):
     '''Checks for missing List-Id header.  If so, message is spam (has_condition = True)'''
+    header_only = True
+
     def has_condition(self):
-        listid = self.message_wrapper.email_message.get('List-Id')
+        listid = self.message_wrapper.headers.get('List-Id')
         if listid is None:
             return True
         else:
@@ -115,20 +155,26 @@ class ListIdExistsSpamInspector(SpamInspector):
 
 class SpamStatusSpamInspector(SpamInspector):
     '''Checks for SpamStatus == Yes'''
+    header_only = True
+
     def has_condition(self):
-        return self.message_wrapper.email_message.get('X-Spam-Status', '').startswith('Yes')
+        return self.message_wrapper.headers.get('X-Spam-Status', '').startswith('Yes')
 
 
 class SpamLevelSpamInspector(SpamInspector):
     '''Checks for SpamLevel >= *****'''
+    header_only = True
+
     def has_condition(self):
-        return self.message_wrapper.email_message.get('X-Spam-Level', '').startswith('*****')
+        return self.message_wrapper.headers.get('X-Spam-Level', '').startswith('*****')
 
 
 class NoArchiveInspector(Inspector):
     '''Checks for no archive headers'''
+    header_only = True
+
     def has_condition(self):
-        return is_no_archive(self.message_wrapper.email_message)
+        return is_no_archive(self.message_wrapper.headers)
 
     def handle_file(self):
         '''Don't do anything. Drop file'''
@@ -140,6 +186,8 @@ class NoArchiveInspector(Inspector):
 
 class LongMessageIDSpamInspector(SpamInspector):
     '''Checks if the Message-ID header exceeds max length'''
+    header_only = True
+
     def has_condition(self):
-        msgid = self.message_wrapper.email_message.get('Message-ID')
+        msgid = self.message_wrapper.headers.get('Message-ID')
         return len(msgid) > 998
@@ -4,30 +4,38 @@ import email
 import glob
 import hashlib
 import io
+import itertools
 import mailbox
+import mmap
 import os
 import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
 import traceback
 import uuid
-from collections import deque
+from collections import defaultdict, namedtuple, OrderedDict
 from email import policy as email_policy
+from email.parser import BytesParser
 from email.utils import getaddresses, make_msgid, parsedate_to_datetime
 from io import StringIO
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.management.base import CommandError
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 
-from mlarchive.archive.models import (Attachment, EmailList, Legacy, Message,
-    Thread, get_in_reply_to_message, is_attachment)
+from mlarchive.archive.models import (Attachment, EmailList, ImportCheckpoint, Legacy, Message,
+    Thread, get_message_prefer_list, get_subject_thread, is_attachment, update_subject_threads)
 from mlarchive.archive.management.commands._mimetypes import CONTENT_TYPES, UNKNOWN_CONTENT_TYPE
 from mlarchive.archive.inspectors import *      # noqa
 from mlarchive.archive.storage_utils import store_file
-from mlarchive.archive.thread import compute_thread, reconcile_thread, parse_message_ids
+from mlarchive.archive.thread import (ThreadRow, compute_thread, get_insert_position,
+    reconcile_thread, parse_message_ids)
 from mlarchive.utils.decorators import check_datetime
 from mlarchive.utils.encoding import decode_safely, decode_rfc2047_header, get_filename
 
@@ -80,6 +88,7 @@ SENT_PATTERN = re.compile(
 MSGID_PATTERN = re.compile(r'<([^>]+)>')                    # [^>] means any character except ">"
 ENVELOPE_DATE_PATTERN = re.compile(r'(Mon|Tue|Wed|Thu|Fri|Sat|Sun),?\s.+')
 ENVELOPE_DUPETZ_PATTERN = re.compile(r'[\-\+]\d{4} \([A-Z]+\)$')
+CRLF_PATTERN = re.compile(b"\r(?!\n)|(?<!\r)\n")          # bare CR or LF
 
 subj_blob_pattern = r'(\[[\040-\132\134\136-\176]{1,}\]\s*)'
 subj_refwd_pattern = r'([Rr][eE]|F[Ww][d]?)\s*' + subj_blob_pattern + r'?:\s'
@@ -117,6 +126,11 @@ class UnknownFormat(Exception):
     pass
 
 
+class SizeLimitExceeded(Exception):
+    # the import source is larger than allowed
+    pass
+
+
 # --------------------------------------------------
 # Helper Functions
 # --------------------------------------------------
@@ -305,7 +319,7 @@ def get_mb(path):
             line = f.readline()
         if line.startswith(b'From '):                # most common mailbox type, MBOX
             # return CustomMbox(path, separator=MBOX_SEPARATOR_PATTERN)
-            return mailbox.mbox(path)
+            return MappedMbox(path)
         elif line == b'\x01\x01\x01\x01\n':          # next most common type, MMDF
             return CustomMMDF(path)
         # TODO currently not supported
@@ -408,12 +422,21 @@ def subject_is_reply(text):
     return False
 
 
+def to_crlf(data):
+    """Returns data with line endings converted to CRLF"""
+    if b'\r' not in data:
+        # the common case, plain newlines
+        return data.replace(b'\n', b'\r\n')
+    return CRLF_PATTERN.sub(b'\r\n', data)
+
+
 def write_file(path, data):
     """Function to write file to disk.
     - creates directory if it doesn't exist
-    - saves file
+    - saves file, with line endings converted to CRLF, and syncs it
     - sets mode of file
     - calls external backup script if defined
+    Returns the bytes written
     """
     assert isinstance(data, bytes)
     directory = os.path.dirname(path)
@@ -421,14 +444,19 @@ def write_file(path, data):
         os.makedirs(directory)
         os.chmod(directory, 0o2777)
 
-    # convert line endings to crlf
-    output = re.sub(b"\r(?!\n)|(?<!\r)\n", b"\r\n", data)
+    output = to_crlf(data)
 
-    with open(path, 'wb') as f:
-        f.write(output)
-        f.flush()
-    os.chmod(path, 0o666)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        os.fchmod(fd, 0o666)
+        view = memoryview(output)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
     # call_remote_backup(path)
+    return output
 
 
 def lookup_extension(mime_type):
@@ -460,13 +488,24 @@ to the legacy object email.message.Message by using the commpat32
 policy.
 '''
 
-def get_message_from_bytes(b, policy):
-    msg = email.message_from_bytes(b, policy=policy)
+def get_message_from_bytes(b, policy, headersonly=False):
+    """Returns email.message.Message parsed from bytes.  Use headersonly=True to
+    leave the body unparsed, as a string payload
+    """
+    msg = BytesParser(policy=policy).parsebytes(b, headersonly=headersonly)
     try:
         _ = list(msg.items())
         return msg
     except:
-        return email.message_from_bytes(b, policy=email_policy.compat32)
+        return BytesParser(policy=email_policy.compat32).parsebytes(b, headersonly=headersonly)
+
+
+def set_msgid_header(msg, msgid):
+    """Sets the Message-ID header of email.message.Message msg"""
+    if 'message-id' in msg:
+        msg.replace_header('Message-ID', msgid)
+    else:
+        msg.add_header('Message-ID', msgid)
 
 
 def make_hash(msgid, listname):
@@ -487,25 +526,252 @@ def make_hash(msgid, listname):
 # --------------------------------------------------
 
 
-class CustomMMDF(mailbox.MMDF):
+class ChunkStream(io.RawIOBase):
+    """Read-only file object over an iterable of bytes chunks, ie. the
+    iter_content() of a streamed requests response.  Raises SizeLimitExceeded
+    if more than max_size bytes are read
+    """
+    def __init__(self, chunks, max_size=None):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b'')
+        self.max_size = max_size
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                return 0
+            self.bytes_read += len(chunk)
+            if self.max_size and self.bytes_read > self.max_size:
+                raise SizeLimitExceeded('read {} bytes, limit is {}'.format(self.bytes_read, self.max_size))
+            self._buffer = memoryview(chunk)
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class MboxStream(object):
+    """Splits a mailbox, read sequentially from a binary file object, into messages.
+    The formats of get_mb() are supported, detected from the first line.  Message
+    boundaries are the same as mailbox.mbox, a message starts with a "From " line
+    and ends before the blank line preceding the next one, or CustomMMDF, messages
+    are enclosed in "^A^A^A^A" lines.  Only one message is held in memory at a time.
+    """
+    MMDF_MARKER = b'\x01\x01\x01\x01\n'
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def __iter__(self):
+        for offset, msg in self.iter_messages():
+            yield msg
+
+    def iter_messages(self, offset=0):
+        """Yields (offset, mailbox.mboxMessage or mailbox.MMDFMessage), offset is the
+        position in the stream following the message.  Messages starting before offset
+        are skipped
+        """
+        pos = 0
+        for line in self.fileobj:
+            if line.strip():
+                break
+            pos += len(line)
+        else:
+            return
+        lines = itertools.chain([line], self.fileobj)
+        if line.startswith(b'From '):
+            yield from self._iter_mbox(lines, pos, offset)
+        elif line == self.MMDF_MARKER:
+            yield from self._iter_mmdf(lines, pos, offset)
+        else:
+            raise UnknownFormat('stream does not start with a "From " or MMDF line')
+
+    def _iter_mbox(self, lines, pos, offset):
+        start = None
+        from_line = None
+        content = []
+        last_was_empty = False
+        for line in lines:
+            if line.startswith(b'From '):
+                if from_line is not None and start >= offset:
+                    yield pos, self._build_message(from_line, content, last_was_empty)
+                start = pos
+                from_line = line
+                content = []
+                last_was_empty = False
+            else:
+                if start >= offset:
+                    content.append(line)
+                last_was_empty = line == b'\n'
+            pos += len(line)
+        if from_line is not None and start >= offset:
+            yield pos, self._build_message(from_line, content, last_was_empty)
+
+    def _iter_mmdf(self, lines, pos, offset):
+        # markers alternate between opening and closing a message, see CustomMMDF
+        start = None
+        content = []
+        for line in lines:
+            pos += len(line)
+            if line == self.MMDF_MARKER:
+                if start is None:
+                    start = pos - len(line)
+                    content = []
+                else:
+                    if start >= offset:
+                        # the newline before the closing marker is not part of the message
+                        yield pos, mailbox.MMDFMessage(b''.join(content)[:-1])
+                    start = None
+            elif start is not None and start >= offset:
+                content.append(line)
+        if start is not None and start >= offset:
+            yield pos, mailbox.MMDFMessage(b''.join(content))
+
+    def _build_message(self, from_line, lines, last_was_empty):
+        if last_was_empty:
+            lines.pop()
+        msg = mailbox.mboxMessage(b''.join(lines))
+        msg.set_from(from_line[5:].rstrip(b'\n').decode('ascii'))
+        return msg
+
+    def close(self):
+        self.fileobj.close()
+
+
+class MappedMailboxMixin(object):
+    """Mixin for the single file mailbox classes (mbox, MMDF).  The table of contents
+    is built by scanning a read-only memory map of the file with a compiled regular
+    expression, instead of the standard library readline loop, and messages are read
+    from slices of the map rather than through seek and read calls on the file.
+    The operating system pages the file in as needed so memory use stays flat
+    regardless of the mailbox size.
+    """
+    _map = None
+
+    def _map_file(self):
+        """Create (or recreate) the memory map of the mailbox file"""
+        self._unmap()
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() == 0:
+            self._map = b''             # can't map an empty file
+        else:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _unmap(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._map = None
+
+    def _slice(self, key):
+        """Returns the bytes of the message with key, as stored"""
+        start, stop = self._lookup(key)
+        if self._map is None or stop > len(self._map):
+            self._map_file()
+        return self._map[start:stop]
+
+    @staticmethod
+    def _follows_blank_line(mm, pos):
+        """Returns True if the line preceding the line that starts at pos is empty"""
+        return pos > 0 and mm[pos - 1] == 10 and (pos == 1 or mm[pos - 2] == 10)
+
+    def flush(self):
+        # the file may be rewritten, drop the map
+        self._unmap()
+        super().flush()
+
+    def close(self):
+        self._unmap()
+        super().close()
+
+
+class MappedMbox(MappedMailboxMixin, mailbox.mbox):
+    """mailbox.mbox using a memory map.  The table of contents is identical to the
+    one produced by the standard library.
+    """
+    FROM_PATTERN = re.compile(rb'^From ', re.MULTILINE)
+
+    def _generate_toc(self):
+        """Generate key-to-(start, stop) table of contents.  Follows mbox._generate_toc,
+        a message ends before the blank line preceding the next "From " line
+        """
+        mm = self._map_file()
+        starts, stops = [], []
+        for match in self.FROM_PATTERN.finditer(mm):
+            line_pos = match.start()
+            if len(stops) < len(starts):
+                if self._follows_blank_line(mm, line_pos):
+                    stops.append(line_pos - 1)
+                else:
+                    stops.append(line_pos)
+            starts.append(line_pos)
+        # end of file
+        line_pos = len(mm)
+        if self._follows_blank_line(mm, line_pos):
+            stops.append(line_pos - 1)
+        else:
+            stops.append(line_pos)
+        self._toc = dict(enumerate(zip(starts, stops)))
+        self._next_key = len(self._toc)
+        self._file_length = len(mm)
+
+    def get_message(self, key):
+        """Return a Message representation or raise a KeyError."""
+        from_line, _, string = self._slice(key).partition(b'\n')
+        msg = self._message_factory(string)
+        msg.set_from(from_line[5:].decode('ascii'))
+        return msg
+
+    def get_bytes(self, key, from_=False):
+        """Return a string representation or raise a KeyError."""
+        data = self._slice(key)
+        if not from_:
+            data = data.partition(b'\n')[2]
+        return data
+
+
+class CustomMMDF(MappedMailboxMixin, mailbox.MMDF):
     """Custom implementation of mailbox.MMDF.  The original class from the standard
     library is flawed in that it uses the same get_message() function as mailbox.mbox,
     which consumes the first line of the message as the "From " line envelope header.
     The MMDF format has "^A^A^A^A" postmark that separates messages, but these are
     already excluded in the _toc.
     """
+    MARKER_PATTERN = re.compile(rb'^\x01\x01\x01\x01\n', re.MULTILINE)
+
+    def _generate_toc(self):
+        """Generate key-to-(start, stop) table of contents.  Markers alternate
+        between opening and closing a message
+        """
+        mm = self._map_file()
+        starts, stops = [], []
+        for match in self.MARKER_PATTERN.finditer(mm):
+            if len(stops) < len(starts):
+                stops.append(match.start() - 1)
+            else:
+                starts.append(match.end())
+        if len(stops) < len(starts):
+            stops.append(len(mm))
+        self._toc = dict(enumerate(zip(starts, stops)))
+        self._next_key = len(self._toc)
+        self._file_length = len(mm)
+
     def get_message(self, key):
         """Return a Message representation or raise a KeyError."""
-        start, stop = self._lookup(key)
-        self._file.seek(start)
-        # from_line = self._file.readline().replace(os.linesep, '')
-        string = self._file.read(stop - self._file.tell())
-        msg = self._message_factory(string.replace(os.linesep, '\n'))
-        # msg.set_from(from_line[5:])
-        return msg
+        return self._message_factory(self._slice(key))
+
+    def get_bytes(self, key, from_=False):
+        """Return a string representation or raise a KeyError."""
+        return self._slice(key)
 
 
-class CustomMbox(mailbox.mbox):
+class CustomMbox(MappedMailboxMixin, mailbox.mbox):
     """Custom mbox class that improves message parsing.  Expects the separator keyword
     argument which is a compiled regex object representing the new message indicator.
 
@@ -523,46 +789,100 @@ class CustomMbox(mailbox.mbox):
     NOTE: in all cases the matched line must be preceeded by a blank line
     """
     def __init__(self, *args, **kwargs):
-        self._separator = kwargs.pop('separator')
-        self._false_separator = re.compile(b'^From .* message (Mon|Tue|Wed|Thu|Fri|Sat|Sun),?\s.+')
+        separator = kwargs.pop('separator')
+        pattern = separator.pattern
+        if isinstance(pattern, str):
+            pattern = pattern.encode('ascii')
+        self._separator = re.compile(pattern, re.MULTILINE)
+        self._false_separator = re.compile(rb'^From .* message (Mon|Tue|Wed|Thu|Fri|Sat|Sun),?\s.+')
         # can't use super because mbox is old style class
         mailbox.mbox.__init__(self, *args, **kwargs)
 
     def _generate_toc(self):
         """Generate key-to-(start, stop) table of contents."""
+        mm = self._map_file()
         starts, stops = [], []
-        lines = deque(' ', maxlen=2)
-        self._file.seek(0)
-        while True:
-            line_pos = self._file.tell()
-            lines.append(self._file.readline())
-            if self._separator.match(lines[1]) and not lines[0].strip() and not self._false_separator.match(lines[1]):
-                if len(stops) < len(starts):
-                    stops.append(line_pos - len(os.linesep))
-                starts.append(line_pos)
-            elif lines[1] == '':
-                stops.append(line_pos)
-                break
+        for match in self._separator.finditer(mm):
+            line_pos = match.start()
+            if line_pos > 0 and mm[line_pos - 1:line_pos] != b'\n':
+                continue
+            # previous line must be blank, the start of file counts as blank
+            previous = mm[mm.rfind(b'\n', 0, max(line_pos - 1, 0)) + 1:line_pos]
+            line_end = mm.find(b'\n', line_pos)
+            if line_end == -1:
+                line_end = len(mm)
+            if previous.strip() or self._false_separator.match(mm[line_pos:line_end]):
+                continue
+            if len(stops) < len(starts):
+                stops.append(line_pos - 1)
+            starts.append(line_pos)
+        stops.append(len(mm))
         self._toc = dict(enumerate(zip(starts, stops)))
         self._next_key = len(self._toc)
-        self._file_length = self._file.tell()
+        self._file_length = len(mm)
 
     def get_message(self, key):
         """Return a Message representation or raise a KeyError."""
-        has_from = True
-        start, stop = self._lookup(key)
-        self._file.seek(start)
-        from_line = self._file.readline().replace(os.linesep, '')
+        data = self._slice(key)
+        from_line, _, string = data.partition(b'\n')
+        from_line = from_line.decode('ascii', errors='replace')
         if HEADER_PATTERN.match(from_line):
-            self._file.seek(start)              # reset pointer to keep first header line
-            has_from = False
-        string = self._file.read(stop - self._file.tell())
-        msg = self._message_factory(string.replace(os.linesep, '\n'))
-        if has_from:
+            # keep first header line
+            msg = self._message_factory(data)
+        else:
+            msg = self._message_factory(string)
             msg.set_from(from_line)
         return msg
 
 
+MessageRef = namedtuple('MessageRef', ['id', 'thread_id'])
+
+
+class MessageIdResolver(object):
+    """Resolves Message-IDs to the archived messages of a list.  All the ids of
+    a message are looked up with one query.  An id matching more than one message
+    is treated as unresolved.
+
+    If cache_size is given, up to that many results are kept in a least recently
+    used cache, so during bulk loads replies to recent messages don't need a query.
+    Loaders add the messages they save with add().
+    """
+    def __init__(self, listname, cache_size=0):
+        self.listname = listname
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def add(self, msgid, id, thread_id):
+        if not self.cache_size:
+            return
+        self.cache[msgid] = MessageRef(id, thread_id)
+        self.cache.move_to_end(msgid)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def resolve(self, msgids):
+        """Returns a dictionary of msgid: MessageRef for the msgids found"""
+        result = {}
+        missing = set()
+        for msgid in msgids:
+            if msgid in self.cache:
+                self.cache.move_to_end(msgid)
+                result[msgid] = self.cache[msgid]
+            else:
+                missing.add(msgid)
+        if not missing:
+            return result
+        found = defaultdict(list)
+        queryset = Message.objects.filter(email_list__name=self.listname, msgid__in=missing)
+        for msgid, id, thread_id in queryset.values_list('msgid', 'id', 'thread_id'):
+            found[msgid].append(MessageRef(id, thread_id))
+        for msgid, refs in found.items():
+            if len(refs) == 1:
+                result[msgid] = refs[0]
+                self.add(msgid, *refs[0])
+        return result
+
+
 class Loader(object):
     """Object which handles loading messages from a mailbox file.  filename is the name
     of the file to load.  Accepts the following keyword options:
@@ -572,6 +892,11 @@ class Loader(object):
     listname: the name of the email list we are loading messages for
     private: True is this is a private list
     test: if True don't save the message to disk archive (only to database)
+    batch_size: if set, save messages in batches of this size.  See MessageBatch
+    resume: if True record progress in ImportCheckpoint and resume an interrupted
+        import of the same source from the last checkpoint
+    source: the name used to identify the file for resume, default is the file path
+        and modification time, so a file that changed isn't resumed
 
     NOTE: if the message is from the last 30 days we skip firstrun step, because there
     will be some lag between when the legacy archive index was created and the
@@ -585,12 +910,32 @@ class Loader(object):
         self.stats = {'count': 0, 'errors': 0, 'spam': 0, 'bytes_loaded': 0}
         self.private = options.get('private')
         self.listname = options.get('listname')
-        self.mb = get_mb(filename)
+        self.mb = self._get_mailbox()
         self.klass = self.mb.__class__.__name__
         self.stats[self.klass] = self.stats.get(self.klass, 0) + 1
+        self.resolver = MessageIdResolver(self.listname, cache_size=settings.IMPORT_MSGID_CACHE_SIZE)
+        self.batch = None
+        if options.get('batch_size') and not options.get('dryrun'):
+            self.batch = self._new_batch()
+            self.batch_messages = {}
 
         logger.info('loader called with: %s' % self.filename)
 
+    def _get_mailbox(self):
+        return get_mb(self.filename)
+
+    def _new_batch(self):
+        return MessageBatch(self.listname, private=self.private, test=self.options.get('test'),
+                            resolver=self.resolver)
+
+    def _get_size(self):
+        return os.path.getsize(self.filename)
+
+    def _get_source(self):
+        if self.options.get('source'):
+            return self.options['source']
+        return '{} {}'.format(os.path.abspath(self.filename), os.stat(self.filename).st_mtime_ns)
+
     def _cleanup(self):
         """Call this function when you are done with the loader object
         """
@@ -603,6 +948,7 @@ class Loader(object):
         self.stats['count'] += 1
         try:
             mw = MessageWrapper.from_message(msg, self.listname, private=self.private)
+            mw.resolver = self.resolver
         except Exception as e:
             print(self.filename)
             raise
@@ -618,30 +964,139 @@ class Loader(object):
                     mw.write_msg(subdir='_filtered')
                 return
 
+        # bulk mode, message is processed when the batch is saved
+        if self.batch is not None:
+            self.stats['bytes_loaded'] += len(mw.bytes)
+            self._add_to_batch(mw, msg)
+            return
+
         # process message
         mw.archive_message
         self.stats['bytes_loaded'] += len(mw.bytes)
 
         if not self.options.get('dryrun'):
             mw.save(test=self.options.get('test'))
+            self.resolver.add(mw.msgid, mw.archive_message.pk, mw.archive_message.thread_id)
+
+    def _add_to_batch(self, mw, msg):
+        """Add message to the batch.  See process()
+        """
+        self.batch.add(mw)
+        self.batch_messages[id(mw)] = msg
+
+    def _save_batch(self):
+        """Save the current batch and handle failures like process() does
+        """
+        batch, self.batch = self.batch, self._new_batch()
+        messages, self.batch_messages = self.batch_messages, {}
+        try:
+            failures = batch.save()
+        except Exception as error:
+            logger.error("Import Error [{0}, batch failed, {1}]".format(self.filename, error.args))
+            failures = [(mw, error) for mw in batch.wrappers]
+        for mw, error in failures:
+            self._handle_error(messages[id(mw)], error)
+
+    def _handle_error(self, msg, error):
+        """If the "break" option is set propogate the exception
+        """
+        if isinstance(error, DuplicateMessage):
+            logger.warning("Import Warn [{0}, {1}, {2}]".format(self.filename, error.args, get_from(msg)))
+            return
+        save_failed_msg(msg, self.listname, error)
+        self.stats['errors'] += 1
+        if self.options.get('break'):
+            raise error
+
+    def _init_checkpoint(self):
+        """Get the checkpoint of an interrupted run of this source or start a new one
+        """
+        self.checkpoint = None
+        self.offset = 0
+        self.resumed_count = 0
+        if not self.options.get('resume') or self.options.get('dryrun'):
+            return
+        source = self._get_source()
+        size = self._get_size()
+        self.checkpoint = ImportCheckpoint.objects.filter(
+            source=source,
+            listname=self.listname,
+            size=size,
+            completed=False).order_by('-updated').first()
+        if self.checkpoint:
+            self.offset = self.checkpoint.offset
+            self.resumed_count = self.checkpoint.count
+            logger.info('resuming import of {} at offset {}'.format(source, self.offset))
+        else:
+            self.checkpoint = ImportCheckpoint.objects.create(source=source, listname=self.listname, size=size)
+
+    def _save_checkpoint(self, completed=False):
+        """Record the offset of the messages processed so far.  Call only when all
+        messages up to offset have been saved
+        """
+        if not self.checkpoint:
+            return
+        self.checkpoint.offset = self.offset
+        self.checkpoint.count = self.resumed_count + self.stats['count']
+        self.checkpoint.completed = completed
+        self.checkpoint.save()
+
+    def _iter_messages(self):
+        """Yields (offset, message) for messages of the mailbox, skipping those before
+        the checkpoint offset.  offset is the position following the message
+        """
+        for key in self.mb.iterkeys():
+            start, stop = self.mb._lookup(key)
+            if start < self.offset:
+                continue
+            yield stop, self.mb[key]
 
     def process(self):
         """If the "break" option is set propogate the exception
         """
-        for m in self.mb:
+        self._init_checkpoint()
+        interval = settings.IMPORT_CHECKPOINT_INTERVAL
+        for offset, m in self._iter_messages():
             try:
                 self._load_message(m)
-            except DuplicateMessage as error:
-                logger.warning("Import Warn [{0}, {1}, {2}]".format(self.filename, error.args, get_from(m)))
             except Exception as error:
-                save_failed_msg(m, self.listname, error)
-                self.stats['errors'] += 1
-                if self.options.get('break'):
-                    raise
-
+                self._handle_error(m, error)
+            self.offset = offset
+            if self.batch is not None:
+                if len(self.batch) >= self.options['batch_size']:
+                    self._save_batch()
+                    self._save_checkpoint()
+            elif self.stats['count'] % interval == 0:
+                self._save_checkpoint()
+
+        if self.batch:
+            self._save_batch()
+        self._save_checkpoint(completed=True)
         self._cleanup()
 
 
+class StreamLoader(Loader):
+    """Loader that reads an mbox from a binary file object, ie. a download being
+    decompressed, instead of a file on disk.  Messages are archived as they are
+    read, the whole mailbox is never held in memory or written to disk.  Accepts the
+    Loader options plus:
+
+    size: size of the source, used with "source" to identify the run for resume
+    """
+    def __init__(self, fileobj, **options):
+        self.fileobj = fileobj
+        super().__init__(options.get('source', '<stream>'), **options)
+
+    def _get_mailbox(self):
+        return MboxStream(self.fileobj)
+
+    def _get_size(self):
+        return self.options.get('size') or 0
+
+    def _iter_messages(self):
+        return self.mb.iter_messages(offset=self.offset)
+
+
 class MessageWrapper(object):
     """This class takes a bytes object (raw email message) or message object
     and listname as a string and constructs the 
@@ -652,6 +1107,10 @@ class MessageWrapper(object):
     filtered by message id, no use performing rest of message parsing.  This means you
     must explicitly call process() or access the archive_message object for the object
     to contain valid data.
+
+    When created from bytes only the headers are parsed up front (self.headers).  The
+    full MIME tree (self.email_message) is parsed the first time it is used, ie. to
+    process attachments.
     """
     def __init__(self, bytes=None, message=None, listname=None, private=False, backup=True):
         """Create a MessageWrapper out of raw bytes or a email.Message
@@ -667,17 +1126,22 @@ class MessageWrapper(object):
         self.created_id = False
         if bytes is not None:
             self.bytes = bytes
-            self.email_message = get_message_from_bytes(bytes, policy=NO_REFOLD_POLICY)
+            self._email_message = None
+            self._headers = get_message_from_bytes(bytes, policy=NO_REFOLD_POLICY, headersonly=True)
         else:
             self.bytes = message.as_bytes(policy=NO_REFOLD_POLICY)
-            self.email_message = message
+            self._email_message = message
+            self._headers = message
         self.hashcode = None
         self.listname = listname
         self.private = private
+        self.resolver = None
+        self._referenced = None
+        self.inspector_times = {}
         self.spam_score = 0
         
         # fail right away if no headers
-        if not list(self.email_message.items()):         # no headers, something is wrong
+        if not list(self.headers.items()):               # no headers, something is wrong
             raise NoHeaders
 
         self.msgid = self.get_msgid()
@@ -697,6 +1161,23 @@ class MessageWrapper(object):
         return self._archive_message
     archive_message = property(_get_archive_message)
 
+    def _get_headers(self):
+        """Returns the message headers as an email.message.Message.  The body
+        may not be parsed, use email_message for that
+        """
+        return self._headers
+    headers = property(_get_headers)
+
+    def _get_email_message(self):
+        """Returns the fully parsed email.message.Message"""
+        if self._email_message is None:
+            self._email_message = get_message_from_bytes(self.bytes, policy=NO_REFOLD_POLICY)
+            if self.created_id:
+                set_msgid_header(self._email_message, self.msgid)
+            self._headers = self._email_message
+        return self._email_message
+    email_message = property(_get_email_message)
+
     def _get_date(self):
         if not self._date:
             self._date = self.get_date()
@@ -704,12 +1185,19 @@ class MessageWrapper(object):
     date = property(_get_date)
 
     def _init_in_reply_to_fields(self):
-        """Initialize self.in_reply_to, self.in_reply_to_value"""
+        """Initialize self.in_reply_to_id, self.in_reply_to_value"""
         assert self.email_list
-        self.in_reply_to_value = self.email_message.get('In-Reply-To', '')
-        self.in_reply_to = get_in_reply_to_message(
-            self.in_reply_to_value,
-            self.email_list)
+        self.in_reply_to_value = self.headers.get('In-Reply-To', '')
+        self.in_reply_to_id = None
+        msgids = parse_message_ids(self.in_reply_to_value)
+        if msgids:
+            ref = self.get_referenced_messages().get(msgids[0])
+            if ref:
+                self.in_reply_to_id = ref.id
+            else:
+                # not in this list
+                message = get_message_prefer_list(msgids[0], self.email_list)
+                self.in_reply_to_id = message.pk if message else None
 
     @staticmethod
     def get_addresses(text):
@@ -727,7 +1215,7 @@ class MessageWrapper(object):
 
     def get_cc(self):
         """Returns the CC field realname and email addresses"""
-        cc = self.email_message.get('cc')
+        cc = self.headers.get('cc')
         if not cc:
             return ''
         return self.get_addresses(cc)
@@ -752,25 +1240,25 @@ class MessageWrapper(object):
         the UTC timezone is assigned.
         """
         for func in (get_received_date, get_header_date, get_envelope_date):
-            date = func(self.email_message)
+            date = func(self.headers)
             if date:
                 return date.astimezone(datetime.UTC)
 
         else:
             # can't really proceed without a date, likely indicates bigger parsing error
-            raise DateError("%s, %s" % (self.msgid, self.email_message.get_unixfrom()))
+            raise DateError("%s, %s" % (self.msgid, self.headers.get_unixfrom()))
 
     def get_hash(self):
         """Returns the message hashcode"""
         return make_hash(msgid=self.msgid, listname=self.listname)
 
     def get_msgid(self):
-        msgid = self.normalize(self.email_message.get('Message-ID', ''))
+        msgid = self.normalize(self.headers.get('Message-ID', ''))
         if msgid:
             msgid = msgid.strip('<>')
         else:
             # see if this is a resent Message, which sometimes have missing Message-ID field
-            resent_msgid = self.email_message.get('Resent-Message-ID')
+            resent_msgid = self.headers.get('Resent-Message-ID')
             if resent_msgid:
                 msgid = resent_msgid.strip('<>')
         if not msgid:
@@ -778,10 +1266,7 @@ class MessageWrapper(object):
             self.created_id = True
             self.spam_score = self.spam_score | settings.MARK_BITS['NO_MSGID']
             # add message-id to email_message headers so it gets to disk file
-            if 'message-id' in self.email_message:
-                self.email_message.replace_header('Message-ID', msgid)
-            else:
-                self.email_message.add_header('Message-ID', msgid)
+            set_msgid_header(self.headers, msgid)
             # raise GenericWarning('No MessageID (%s)' % self.email_message.get_from())
         return msgid
 
@@ -789,14 +1274,14 @@ class MessageWrapper(object):
         """Gets the message subject.  Truncate very long lines (probably spam) to
         avoid databaser errors.
         """
-        subject = self.normalize(self.email_message.get('Subject', ''))
+        subject = self.normalize(self.headers.get('Subject', ''))
         if len(subject) > 512:
             subject = subject[:512]
         return subject
 
     def get_to(self):
         """Returns the To field realname and email addresses"""
-        to = self.email_message.get('to')
+        to = self.headers.get('to')
         if not to:
             return ''
         return self.get_addresses(to)
@@ -816,23 +1301,30 @@ class MessageWrapper(object):
 
         # check subject
         if subject_is_reply(self.subject):
-            messages = Message.objects.filter(email_list=self.email_list,
-                                              date__lt=self.date,
-                                              base_subject=self.base_subject).order_by('-date')
-            if messages:
-                return messages[0].thread
+            entry = get_subject_thread(self.email_list, self.base_subject, self.date)
+            if entry:
+                return entry.thread
 
         # return a new thread
         return Thread.objects.create(date=self.date, email_list=self.email_list)
 
     def get_thread_from_header(self, value):
         """Returns the thread given text containing message ids"""
+        referenced = self.get_referenced_messages()
         for msgid in parse_message_ids(value):
-            try:
-                message = Message.objects.get(email_list=self.email_list, msgid=msgid)
-                return message.thread
-            except (Message.DoesNotExist, Message.MultipleObjectsReturned):
-                pass
+            if msgid in referenced:
+                return Thread.objects.get(pk=referenced[msgid].thread_id)
+
+    def get_referenced_messages(self):
+        """Returns dictionary of msgid: MessageRef for the messages of this list
+        referenced in the References and In-Reply-To headers.  Looked up once
+        """
+        if self._referenced is None:
+            if self.resolver is None:
+                self.resolver = MessageIdResolver(self.listname)
+            msgids = parse_message_ids(self.references) + parse_message_ids(self.in_reply_to_value)
+            self._referenced = self.resolver.resolve(msgids)
+        return self._referenced
 
     def normalize(self, header_text):
         """This function takes some header_text as a string.
@@ -863,6 +1355,30 @@ class MessageWrapper(object):
         """Perform the rest of the parsing and construct the Message object.  Note,
         we are not saving the object to the database.  This happens in the save() function.
         """
+        self._init_email_list()
+        self._init_fields()
+        self._init_in_reply_to_fields()
+        self.thread = self.get_thread()
+        self._archive_message = self.build_archive_message()
+        # not saving here.
+        # try to place the message without recomputing the whole thread,
+        # save() then makes room for it.  self.thread_info is None in this case
+        rows = [ThreadRow(*values) for values in
+                self.thread.message_set.values_list(*ThreadRow._fields)]
+        position = get_insert_position(rows, self._archive_message)
+        if position:
+            self.thread_info = None
+            self._archive_message.thread_order, self._archive_message.thread_depth = position
+            return
+        thread_messages = list(self.thread.message_set.all().order_by('date'))
+        thread_messages.append(self._archive_message)
+        self.thread_info = compute_thread(thread_messages)
+        info = self.thread_info[self.hashcode]
+        self._archive_message.thread_depth = info.depth
+        self._archive_message.thread_order = info.order
+
+    def _init_email_list(self):
+        """Get or create the EmailList, initialize self.email_list"""
         self.email_list, created = EmailList.objects.get_or_create(
             name=self.listname, defaults={'description': self.listname, 'private': self.private})
         if not created and self.private is True and self.email_list.private is False:
@@ -870,42 +1386,43 @@ class MessageWrapper(object):
             logger.info('Email List {} changed from public to private'.format(self.email_list.name))
             self.email_list.private = True
             self.email_list.save()
+
+    def _init_fields(self):
+        """Initialize the message fields which don't require database lookups"""
         self.hashcode = self.get_hash()
-        self._init_in_reply_to_fields()
-        self.references = self.email_message.get('References', '')
+        self.in_reply_to_value = self.headers.get('In-Reply-To', '')
+        self.references = self.headers.get('References', '')
         self.subject = self.get_subject()
         self.base_subject = get_base_subject(self.subject)
-        self.thread = self.get_thread()
-        self.from_line = self.normalize(get_from(self.email_message)) or ''
+        self.from_line = self.normalize(get_from(self.headers)) or ''
         if self.from_line:
             self.from_line = self.from_line[5:].lstrip()    # we only need the unique part
-        self.frm = self.normalize(self.email_message.get('From', ''))
-        self._archive_message = Message(base_subject=self.base_subject,
-                                        cc=self.get_cc(),
-                                        date=self.date,
-                                        email_list=self.email_list,
-                                        frm=self.frm,
-                                        from_line=self.from_line,
-                                        hashcode=self.hashcode,
-                                        in_reply_to_value=self.in_reply_to_value,
-                                        in_reply_to=self.in_reply_to,
-                                        msgid=self.msgid,
-                                        references=self.references,
-                                        spam_score=self.spam_score,
-                                        subject=self.subject,
-                                        thread=self.thread,
-                                        to=self.get_to())
-        # not saving here.
-        thread_messages = list(self.thread.message_set.all().order_by('date'))
-        thread_messages.append(self._archive_message)
-        self.thread_info = compute_thread(thread_messages)
-        info = self.thread_info[self.hashcode]
-        self._archive_message.thread_depth = info.depth
-        self._archive_message.thread_order = info.order
+        self.frm = self.normalize(self.headers.get('From', ''))
 
-    def process_attachments(self, test=False):
+    def build_archive_message(self):
+        """Returns a new, unsaved, archive.models.Message.  Requires that the fields
+        and self.thread have been initialized
         """
-        Walks the message parts and saves any attachments.  See is_attachment().
+        return Message(base_subject=self.base_subject,
+                       cc=self.get_cc(),
+                       date=self.date,
+                       email_list=self.email_list,
+                       frm=self.frm,
+                       from_line=self.from_line,
+                       hashcode=self.hashcode,
+                       in_reply_to_value=self.in_reply_to_value,
+                       in_reply_to_id=self.in_reply_to_id,
+                       msgid=self.msgid,
+                       references=self.references,
+                       spam_score=self.spam_score,
+                       subject=self.subject,
+                       thread=self.thread,
+                       to=self.get_to())
+
+    def get_attachments(self):
+        """
+        Walks the message parts and returns a list of unsaved Attachment objects
+        for self.archive_message.  See is_attachment().
         See docs for details: https://docs.python.org/3/library/email.message.html
         The message/external-body type indicates that the actual body data are not
         included, but merely referenced.
@@ -913,27 +1430,49 @@ class MessageWrapper(object):
         NOTE: Python 3 has iter_attachments()
         NOTE: get_filename() may return folded name so remove newlines
         """
+        attachments = []
         for sequence, part in enumerate(self.email_message.walk()):
             if is_attachment(part):
                 filename = get_filename(part)
                 filename = filename.replace('\r', '').replace('\n', '')
-                Attachment.objects.create(message=self.archive_message,
-                                          description='',
-                                          content_type=part.get_content_type(),
-                                          content_disposition=get_content_disposition(part),
-                                          name=filename,
-                                          sequence=sequence)
+                attachments.append(Attachment(message=self.archive_message,
+                                              description='',
+                                              content_type=part.get_content_type(),
+                                              content_disposition=get_content_disposition(part),
+                                              name=filename,
+                                              sequence=sequence))
+        return attachments
+
+    def inspect(self, header_only=None):
+        """Run the configured inspectors, header only inspectors first.  Raises an
+        InspectorMessage exception if the message should not be archived.  Use
+        header_only=True or False to run just one group.  The time taken by each
+        inspector is kept in self.inspector_times
+        """
+        for inspector_class, options in get_inspectors():
+            if header_only is not None and inspector_class.header_only != header_only:
+                continue
+            start = time.perf_counter()
+            try:
+                inspector_class(self, options).inspect()
+            finally:
+                elapsed = time.perf_counter() - start
+                self.inspector_times[inspector_class.__name__] = elapsed
+                logger.debug('Inspector {} took {:.6f}s msgid:{}'.format(
+                    inspector_class.__name__, elapsed, self.msgid))
+
+    def process_attachments(self, test=False):
+        """Saves any attachments of the message.  See get_attachments()"""
+        attachments = self.get_attachments()
+        if attachments:
+            Attachment.objects.bulk_create(attachments)
 
     def save(self, test=False):
         """Ensure message is not duplicate message-id or hash.  Save message to database.
         Save to disk (if not test mode) and process attachments.
         """
         # check for spam
-        if hasattr(settings, 'INSPECTORS'):
-            for inspector_name in settings.INSPECTORS:
-                inspector_class = eval(inspector_name)
-                inspector = inspector_class(self)
-                inspector.inspect()
+        self.inspect()
 
         # check for duplicate message id, and skip
         if Message.objects.filter(msgid=self.msgid, email_list__name=self.listname):
@@ -952,20 +1491,40 @@ class MessageWrapper(object):
         # which requires file to be present
         if not test:
             self.write_msg()
+        if self.thread_info is None:
+            self.shift_thread()
         self.archive_message.save()
         logger.info('Message archived list:{} from:{}'.format(self.listname, self.frm))
 
         # update thread information
-        if self.archive_message.thread.message_set.count() > 1:
+        if self.thread_info is None:
+            from mlarchive.archive.signals import thread_order_shifted
+            thread_order_shifted.send(sender=Message,
+                                      thread_id=self.thread.pk,
+                                      start=self.archive_message.thread_order,
+                                      exclude=self.archive_message.pk)
+        elif self.archive_message.thread.message_set.count() > 1:
             reconcile_thread(self.thread_info)
+        self.thread.update_message_ids()
 
         # now that the archive.Message object is created we can process any attachments
         self.process_attachments(test=test)
 
-    def write_msg(self, subdir=None):
+    def shift_thread(self):
+        """Move messages at or after the new message's position in the thread down
+        one place, with a single query.  See get_insert_position()
+        """
+        Message.objects.filter(
+            thread=self.thread,
+            thread_order__gte=self.archive_message.thread_order).update(
+                thread_order=F('thread_order') + 1,
+                updated=timezone.now())
+
+    def write_msg(self, subdir=None, store_blob=True):
         """Write a copy of the original email message to the disk archive.
         Use optional argument subdir to specify a subdirectory within the list directory
-        ie. "_filtered" or "_failure"
+        ie. "_filtered" or "_failure".  Set store_blob to False if the caller takes
+        care of writing the blobdb copy (see MessageBatch)
         """
         # set filename
         filename = self.hashcode
@@ -987,6 +1546,8 @@ class MessageWrapper(object):
 
         # write file to disk
         write_file(path, self.bytes)
+        if not store_blob:
+            return
 
         # ---------------------------------------------------------------
         # write message to appropriate blobdb bucket(s)
@@ -1001,10 +1562,272 @@ class MessageWrapper(object):
         # store siloed messages
         if subdir:
             bucket = f'ml-messages-{subdir.lstrip('_')}'
-            store_file(bucket, blob_path, io.BytesIO(self.bytes), content_type='message/rfc822')
         # store private messages
         elif self.email_list.private:
-            store_file('ml-messages-private', blob_path, io.BytesIO(self.bytes), content_type='message/rfc822')
+            bucket = 'ml-messages-private'
         # store regular public messages
         else:
-            store_file('ml-messages', blob_path, io.BytesIO(self.bytes), content_type='message/rfc822')
+            bucket = 'ml-messages'
+
+        # the blob holds the original bytes, as stored by MessageBatch. The task
+        # carries them (base64 encoded for the json serializer), so workers don't
+        # need access to the archive file.  If the task can't be queued store it now
+        if settings.BLOB_WRITE_BEHIND:
+            from mlarchive.archive.tasks import store_message_blob_task
+            try:
+                store_message_blob_task.delay(base64.b64encode(self.bytes).decode('ascii'),
+                                              bucket, blob_path)
+                return
+            except Exception as error:
+                logger.error('Could not queue blob {}:{}: {}'.format(bucket, blob_path, error))
+        store_file(bucket, blob_path, io.BytesIO(self.bytes), content_type='message/rfc822')
+
+
+class MessageBatch(object):
+    """Saves a group of MessageWrappers, all from the same list and in chronological
+    order, to the archive.  This is the bulk counterpart of MessageWrapper.save().
+    Duplicates and threads are resolved with set based queries, Message, Thread and
+    Attachment rows are inserted with bulk_create and the search index is updated
+    with one bulk request.
+
+    The per instance post_save signals are not sent, the work they do (thread.first,
+    blobs, json blobs, indexing) is done here for the batch as a whole.  Cache purge
+    is skipped, bulk mode is meant for imports.
+    """
+    def __init__(self, listname, private=False, test=False, resolver=None):
+        self.listname = listname
+        self.private = private
+        self.test = test
+        self.resolver = resolver or MessageIdResolver(listname)
+        self.wrappers = []
+
+    def __len__(self):
+        return len(self.wrappers)
+
+    def add(self, mw):
+        self.wrappers.append(mw)
+
+    def save(self):
+        """Save the messages in the batch.  Returns a list of (MessageWrapper, exception)
+        tuples for the messages that were not archived.
+        """
+        if not self.wrappers:
+            return []
+        failures = []
+        wrappers = self._prepare(failures)
+        wrappers = self._remove_duplicates(wrappers, failures)
+        if not wrappers:
+            return failures
+        deferred = self._resolve_threads(wrappers)
+
+        # write messages to disk before saving, the indexer requires the file to be present
+        if not self.test:
+            for mw in wrappers:
+                mw.write_msg(store_blob=False)
+
+        messages = [mw.archive_message for mw in wrappers]
+        new_threads = list({id(mw.thread): mw.thread for mw in wrappers if mw.thread.pk is None}.values())
+        attachments = [a for mw in wrappers for a in mw.get_attachments()]
+        with transaction.atomic():
+            Thread.objects.bulk_create(new_threads)
+            Message.objects.bulk_create(messages)
+            for message, in_reply_to in deferred:
+                message.in_reply_to = in_reply_to
+            if deferred:
+                Message.objects.bulk_update([m for m, _ in deferred], ['in_reply_to'])
+            Attachment.objects.bulk_create(attachments)
+            threads, changed = self._update_threads(messages)
+            update_subject_threads(messages)
+        for message in messages:
+            self.resolver.add(message.msgid, message.pk, message.thread_id)
+        logger.info('Message batch archived list:{} count:{}'.format(self.listname, len(messages)))
+
+        if not self.test:
+            self._store_blobs(wrappers)
+        self._store_json_blobs(messages, threads)
+
+        from mlarchive.archive.signals import messages_bulk_created
+        messages_bulk_created.send(sender=Message, instances=messages + changed)
+        return failures
+
+    def _prepare(self, failures):
+        """Initialize message fields and run inspectors.  Returns list of wrappers
+        that passed
+        """
+        email_list = None
+        passed = []
+        for mw in self.wrappers:
+            try:
+                if email_list is None:
+                    mw._init_email_list()
+                    email_list = mw.email_list
+                else:
+                    mw.email_list = email_list
+                mw._init_fields()
+                _ = mw.date     # noqa
+                mw.inspect()
+            except Exception as error:
+                failures.append((mw, error))
+            else:
+                passed.append(mw)
+        return passed
+
+    def _remove_duplicates(self, wrappers, failures):
+        """Check for duplicate message id or hash, against the archive and within
+        the batch.  Returns list of unique wrappers
+        """
+        existing_msgids = set(Message.objects.filter(
+            email_list__name=self.listname,
+            msgid__in=[mw.msgid for mw in wrappers]).values_list('msgid', flat=True))
+        existing_hashcodes = set(Message.objects.filter(
+            hashcode__in=[mw.hashcode for mw in wrappers]).values_list('hashcode', flat=True))
+        unique = []
+        for mw in wrappers:
+            if mw.msgid in existing_msgids:
+                mw.write_msg(subdir='_dupes')
+                failures.append((mw, DuplicateMessage('Duplicate msgid: %s' % mw.msgid)))
+            elif mw.hashcode in existing_hashcodes:
+                mw.write_msg(subdir='_dupes')
+                failures.append((mw, CommandError('Duplicate hash, msgid: %s' % mw.msgid)))
+            else:
+                existing_msgids.add(mw.msgid)
+                existing_hashcodes.add(mw.hashcode)
+                unique.append(mw)
+        return unique
+
+    def _resolve_threads(self, wrappers):
+        """Set in_reply_to and thread for each wrapper and build the archive message.
+        Referenced messages are resolved with one query and, for messages earlier in
+        the batch, with a local map.  Returns list of (message, in_reply_to) where
+        in_reply_to is also in the batch, these are set after insert
+        """
+        email_list = wrappers[0].email_list
+        msgids = set()
+        for mw in wrappers:
+            msgids.update(parse_message_ids(mw.references))
+            msgids.update(parse_message_ids(mw.in_reply_to_value))
+        found = self.resolver.resolve(msgids)
+        threads = Thread.objects.in_bulk(set(ref.thread_id for ref in found.values()))
+        local = {}
+        deferred = []
+        for mw in wrappers:
+            # in reply to
+            mw.in_reply_to_id = None
+            in_reply_to_ids = parse_message_ids(mw.in_reply_to_value)
+            if in_reply_to_ids:
+                msgid = in_reply_to_ids[0]
+                if msgid in local:
+                    deferred.append((mw, local[msgid].archive_message))
+                elif msgid in found:
+                    mw.in_reply_to_id = found[msgid].id
+                else:
+                    message = get_message_prefer_list(msgid, email_list)
+                    mw.in_reply_to_id = message.pk if message else None
+
+            # thread
+            mw.thread = None
+            for header in (mw.references, mw.in_reply_to_value):
+                for msgid in parse_message_ids(header):
+                    if msgid in local:
+                        mw.thread = local[msgid].thread
+                    elif msgid in found:
+                        mw.thread = threads[found[msgid].thread_id]
+                    if mw.thread:
+                        break
+                if mw.thread:
+                    break
+            if not mw.thread and subject_is_reply(mw.subject):
+                mw.thread = self._get_thread_from_subject(mw, local.values())
+            if not mw.thread:
+                mw.thread = Thread(date=mw.date, email_list=email_list)
+
+            mw._archive_message = mw.build_archive_message()
+            local[mw.msgid] = mw
+        return [(mw.archive_message, in_reply_to) for mw, in_reply_to in deferred]
+
+    def _get_thread_from_subject(self, mw, resolved):
+        """Returns the thread of the latest earlier message with the same base subject,
+        from the already resolved messages of the batch or the archive
+        """
+        candidates = [w for w in resolved if w.base_subject == mw.base_subject and w.date < mw.date]
+        entry = get_subject_thread(mw.email_list, mw.base_subject, mw.date)
+        if entry:
+            candidates.append(entry)
+        if candidates:
+            return max(candidates, key=lambda x: x.date).thread
+
+    def _update_threads(self, messages):
+        """Recompute thread order and depth and set thread first message and message ids for the threads
+        that received new messages.  Returns list of affected threads and list of
+        existing messages that changed
+        """
+        threads = {m.thread_id: m.thread for m in messages}
+        thread_messages = defaultdict(list)
+        queryset = Message.objects.filter(thread__in=threads.keys()).select_related('email_list', 'thread')
+        for message in queryset.order_by('date'):
+            thread_messages[message.thread_id].append(message)
+        pks = set(m.pk for m in messages)
+        now = timezone.now()
+        changed = []
+        dated = []
+        for thread_id, thread in threads.items():
+            for info in compute_thread(thread_messages[thread_id]).values():
+                message = info.message
+                if (message.thread_order != info.order or message.thread_depth != info.depth):
+                    message.thread_order = info.order
+                    message.thread_depth = info.depth
+                    message.updated = now
+                    changed.append(message)
+            first = thread_messages[thread_id][0]
+            if thread.first_id != first.pk:
+                if thread.first_id and thread.date != first.date:
+                    dated.append(thread)
+                thread.first = first
+                thread.date = first.date
+            ordered = sorted(thread_messages[thread_id], key=lambda m: m.thread_order)
+            thread.message_ids = [m.pk for m in ordered]
+        if changed:
+            Message.objects.bulk_update(changed, ['thread_order', 'thread_depth', 'updated'])
+        Thread.objects.bulk_update(list(threads.values()), ['first', 'date', 'message_ids'])
+        if dated:
+            from mlarchive.archive.signals import thread_date_changed
+            for thread in dated:
+                thread_date_changed.send(sender=Thread, thread_id=thread.pk, date=thread.date)
+        # keep batch instances current
+        by_pk = {m.pk: m for m in changed}
+        for message in messages:
+            if message.pk in by_pk:
+                message.thread_order = by_pk[message.pk].thread_order
+                message.thread_depth = by_pk[message.pk].thread_depth
+        return list(threads.values()), [m for m in changed if m.pk not in pks]
+
+    def _store_blobs(self, wrappers):
+        """Write messages to blobdb with one insert and replicate"""
+        if not settings.ENABLE_BLOBSTORAGE:
+            return
+        from mlarchive.archive.utils import replicate_batch
+        from mlarchive.blobdb.models import Blob
+        bucket = 'ml-messages-private' if wrappers[0].email_list.private else 'ml-messages'
+        blobs = [Blob(name=mw.archive_message.get_blob_name(),
+                      bucket=bucket,
+                      content=mw.bytes,
+                      content_type='message/rfc822') for mw in wrappers]
+        Blob.bulk_objects.bulk_create(blobs, ignore_conflicts=True)
+        replicate_batch(blobs)
+
+    def _store_json_blobs(self, messages, threads):
+        """Rebuild json blobs for the new messages, the other messages in their
+        threads and the message preceding the batch in list order
+        """
+        if not settings.ENABLE_BLOBSTORAGE or messages[0].email_list.private:
+            return
+        from mlarchive.archive.utils import rebuild_json_blobs
+        pks = set(m.pk for m in messages)
+        affected = list(messages)
+        for message in Message.objects.filter(thread__in=threads).exclude(pk__in=pks).select_related('email_list'):
+            affected.append(message)
+            pks.add(message.pk)
+        previous = messages[0].previous_in_list()
+        if previous and previous.pk not in pks:
+            affected.append(previous)
+        rebuild_json_blobs(affected)
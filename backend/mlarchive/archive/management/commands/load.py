@@ -1,10 +1,12 @@
 import datetime
+import multiprocessing
 import os
 import re
 import shutil
 import time
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 
 from mlarchive.archive.models import EmailList, Legacy
 from mlarchive.archive.mail import get_mb, CustomMbox, Loader, UnknownFormat
@@ -12,6 +14,9 @@ from mlarchive.archive.mail import get_mb, CustomMbox, Loader, UnknownFormat
 import logging
 logger = logging.getLogger(__name__)
 
+# command options passed through to Loader
+LOADER_OPTIONS = ('batch_size', 'break', 'dryrun', 'firstrun', 'format', 'private', 'resume', 'test')
+
 # --------------------------------------------------
 # Helper Functions
 # --------------------------------------------------
@@ -41,6 +46,23 @@ def guess_list(path):
             return match.groups()[0]
 
 
+def get_files(source):
+    """Returns the list of mailbox files to load from source, a file or a directory.
+    Directory files are returned in chronological order, so thread resolution works
+    """
+    if os.path.isfile(source):
+        return [source]
+    elif os.path.isdir(source):
+        FILE_PATTERN = re.compile(r'^\d{4}-\d{2}(|.mail)$')
+        mboxs = [f for f in os.listdir(source) if FILE_PATTERN.match(f)]
+        sorted_mboxs = sorted(mboxs)
+        full = [os.path.join(source, x) for x in sorted_mboxs]
+        # exclude directories and empty files
+        return list(filter(isfile, full))
+    else:
+        raise CommandError("%s is not a file or directory" % source)
+
+
 def isfile(path):
     """Custom version of os.path.isfile, return True if path is an existing regular file
     and not empty
@@ -53,6 +75,32 @@ def isfile(path):
     return True
 
 
+def load_files(files, options):
+    """Load files, all from the same list, in order.  Returns stats
+    """
+    stats = {}
+    for filename in files:
+        try:
+            loader = Loader(filename, **options)
+            loader.process()
+            merge_stats(stats, loader.stats)
+        except UnknownFormat as error:
+            # save failed message
+            if not (options['dryrun'] or options['test']):
+                target = EmailList.get_failed_dir(options['listname'])
+                if not os.path.exists(target):
+                    os.makedirs(target)
+                shutil.copy(filename, target)
+            logger.error("Import Error [Unknown file format, {0}]".format(error.args))
+            stats['unknown'] = stats.get('unknown', 0) + 1
+    return stats
+
+
+def merge_stats(stats, other):
+    for key, val in list(other.items()):
+        stats[key] = stats.get(key, 0) + val
+
+
 # --------------------------------------------------
 # Classes
 # --------------------------------------------------
@@ -62,7 +110,8 @@ class Command(BaseCommand):
     help = 'Imports message(s) into the archive'
 
     def add_arguments(self, parser):
-        parser.add_argument('source')
+        parser.add_argument('source', nargs='+',
+            help='mailbox file or directory.  When loading multiple lists give one directory per list')
         parser.add_argument('-b', '--break', action='store_true', dest='break', default=False,
             help='break on error')
         parser.add_argument('-d', '--dry-run', action='store_true', dest='dryrun', default=False,
@@ -79,52 +128,47 @@ class Command(BaseCommand):
             help="test mode.  write database but don't store message files"),
         parser.add_argument('--firstrun', action='store_true', dest='firstrun', default=False,
             help='only use this on the initial import of the archive'),
+        parser.add_argument('-w', '--workers', type=int, dest='workers', default=1,
+            help='number of lists to load in parallel (default is 1)'),
+        parser.add_argument('--resume', action='store_true', dest='resume', default=False,
+            help='record progress and resume an interrupted import of the same, unchanged, file'),
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=0,
+            help='save messages in batches of this size using bulk inserts (default is one at a time)'),
 
     def handle(self, *args, **options):
-        stats = {}
-        source = options['source']
+        sources = options['source']
         if options.get('firstrun') and Legacy.objects.all().count() == 0:
             raise CommandError('firstrun specified but the legacy archive table is empty')
-
-        # gather source files
-        if os.path.isfile(source):
-            files = [source]
-        elif os.path.isdir(source):
-            FILE_PATTERN = re.compile(r'^\d{4}-\d{2}(|.mail)$')
-            mboxs = [f for f in os.listdir(source) if FILE_PATTERN.match(f)]
-            # we need to import the files in chronological order so thread resolution works
-            sorted_mboxs = sorted(mboxs)
-            full = [os.path.join(source, x) for x in sorted_mboxs]
-            # exclude directories and empty files
-            files = list(filter(isfile, full))
-        else:
-            raise CommandError("%s is not a file or directory" % source)
-
-        # determine list
-        if not options['listname']:
-            options['listname'] = guess_list(files[0])
-        if not options['listname']:
-            raise CommandError("list not specified and not guessable [%s]" % files[0])
-
-        # force listname lowercase
-        options['listname'] = options['listname'].lower()
+        if len(sources) > 1 and options['listname']:
+            raise CommandError('listname can only be specified with a single source')
+
+        # gather source files, one job per list
+        jobs = {}
+        for source in sources:
+            files = get_files(source)
+            listname = options['listname'] or guess_list(files[0])
+            if not listname and len(sources) > 1 and os.path.isdir(source):
+                listname = os.path.basename(os.path.normpath(source))
+            if not listname:
+                raise CommandError("list not specified and not guessable [%s]" % files[0])
+            # force listname lowercase
+            jobs.setdefault(listname.lower(), []).extend(files)
 
         start_time = time.time()
-        for filename in files:
-            try:
-                loader = Loader(filename, **options)
-                loader.process()
-                for key, val in list(loader.stats.items()):          # compile stats
-                    stats[key] = stats.get(key, 0) + val
-            except UnknownFormat as error:
-                # save failed message
-                if not (options['dryrun'] or options['test']):
-                    target = EmailList.get_failed_dir(options['listname'])
-                    if not os.path.exists(target):
-                        os.makedirs(target)
-                    shutil.copy(filename, target)
-                logger.error("Import Error [Unknown file format, {0}]".format(error.args))
-                stats['unknown'] = stats.get('unknown', 0) + 1
+        loader_options = {k: options.get(k) for k in LOADER_OPTIONS}
+        args = [(files, dict(loader_options, listname=listname)) for listname, files in jobs.items()]
+        workers = min(options['workers'], len(jobs))
+        if workers > 1:
+            # lists are loaded concurrently, each list by one worker, in order.
+            # close database connections so they aren't shared with forked workers
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                results = pool.starmap(load_files, args)
+        else:
+            results = [load_files(*arg) for arg in args]
+        stats = {}
+        for result in results:
+            merge_stats(stats, result)
 
         stats['time'] = int(time.time() - start_time)
 
@@ -102,6 +102,16 @@ class Command(BaseCommand):
             ),
         )
 
+        PeriodicTask.objects.get_or_create(
+            name="Update search index",
+            task="mlarchive.archive.tasks.update_index_task",
+            defaults=dict(
+                enabled=False,
+                crontab=self.crontabs["every_15m"],
+                description="Index messages updated since the last run"
+            ),
+        )
+
 
     def show_tasks(self):
         for label, crontab in self.crontabs.items():
@@ -1,11 +1,17 @@
 # encoding: utf-8
 
+from django.conf import settings
 from django.core.management import call_command
 from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from mlarchive.archive.backends.elasticsearch import ESBackend
+from mlarchive.archive.models import IndexWatermark
 
 
 class Command(BaseCommand):
-    help = "Completely rebuilds the search index by removing the old data and then updating."
+    help = ("Completely rebuilds the search index.  A new index is built and then the index "
+            "alias is switched to it, search keeps using the old index until then.")
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -20,13 +26,50 @@ class Command(BaseCommand):
             '-b', '--batch-size', dest='batchsize', type=int, default=1000,
             help='Number of items to index at once.'
         )
+        parser.add_argument(
+            '-k', '--workers', type=int, default=0,
+            help='Number of worker processes to index with, in parallel.'
+        )
+        parser.add_argument(
+            '-p', '--prepare-workers', type=int, default=0,
+            help='Number of processes to extract message text with, for each batch.'
+        )
+        parser.add_argument(
+            '--in-place', action='store_true', dest='in_place', default=False,
+            help='Clear the live index and update it, search is incomplete until done.'
+        )
 
     def handle(self, **options):
         clear_options = options.copy()
         update_options = options.copy()
-        for key in ('batchsize', ):
+        for key in ('batchsize', 'workers', 'prepare_workers', 'in_place'):
             del clear_options[key]
-        for key in ('interactive', ):
+        for key in ('interactive', 'in_place'):
             del update_options[key]
-        call_command('clear_index', **clear_options)
-        call_command('update_index', **update_options)
+        if options['in_place']:
+            call_command('clear_index', **clear_options)
+            call_command('update_index', **update_options)
+            return
+
+        backend = ESBackend()
+        started = now()
+        index_name = backend.create_index(bulk=True)
+        if options['verbosity'] >= 1:
+            self.stdout.write("Building index {}".format(index_name))
+        try:
+            call_command('update_index', index_name=index_name, **update_options)
+            backend.finish_bulk(index_name)
+        except Exception:
+            backend.delete_index(index_name)
+            raise
+        backend.switch_alias(index_name)
+        if options['verbosity'] >= 1:
+            self.stdout.write("Index alias {} switched to {}".format(backend.alias, index_name))
+
+        # index changes made while building, the new index has everything up to the
+        # start.  Messages deleted meanwhile were only removed from the old index
+        IndexWatermark.objects.update_or_create(name=settings.ELASTICSEARCH_INDEX_NAME,
+                                                defaults={'value': started})
+        call_command('update_index', incremental=True, remove=True,
+                     batchsize=options['batchsize'], verbosity=options['verbosity'],
+                     stdout=self.stdout)
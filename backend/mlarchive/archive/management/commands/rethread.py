@@ -0,0 +1,49 @@
+import datetime
+
+from dateutil.parser import isoparse
+from django.core.management.base import BaseCommand, CommandError
+
+from mlarchive.archive.models import EmailList
+from mlarchive.archive.utils import rethread_list
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Recompute thread order and depth of messages in a list, optionally limited "
+            "to threads with messages in a date range.  Run update_index for the same "
+            "period afterwards")
+
+    def add_arguments(self, parser):
+        parser.add_argument('listname', help='The list name')
+        parser.add_argument(
+            '-s', '--start', dest='start_date',
+            help='The start date in UTC. Use format YYYY-MM-DDTHH:MM'
+        )
+        parser.add_argument(
+            '-e', '--end', dest='end_date',
+            help='The end date in UTC. Use format YYYY-MM-DDTHH:MM'
+        )
+        parser.add_argument(
+            '-b', '--batch-size', dest='batchsize', type=int, default=1000,
+            help='Number of messages to read and write at once.'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            email_list = EmailList.objects.get(name=options['listname'])
+        except EmailList.DoesNotExist:
+            raise CommandError('{} not a valid list'.format(options['listname']))
+
+        dates = {}
+        for key in ('start_date', 'end_date'):
+            if options[key] is not None:
+                try:
+                    dates[key] = isoparse(options[key]).astimezone(datetime.timezone.utc)
+                except ValueError:
+                    raise CommandError('Invalid date {}'.format(options[key]))
+
+        threads, changed = rethread_list(email_list, batch_size=options['batchsize'], **dates)
+        logger.info('rethread {}: threads={}, changed={}'.format(email_list.name, threads, changed))
+        self.stdout.write('Rethreaded {} threads, {} messages changed'.format(threads, changed))
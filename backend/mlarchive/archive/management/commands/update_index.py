@@ -8,13 +8,12 @@ from datetime import timedelta
 from dateutil.parser import isoparse
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management.base import BaseCommand, CommandError
-from django.db import close_old_connections, reset_queries
-from django.utils.encoding import smart_bytes
+from django.db import connections, reset_queries
 from django.utils.timezone import now
-from elasticsearch_dsl import Search
 
-from mlarchive.archive.models import Message
+from mlarchive.archive.models import IndexWatermark, Message
 from mlarchive.archive.backends.elasticsearch import ESBackend
 
 LOG = multiprocessing.log_to_stderr(level=logging.WARNING)
@@ -23,10 +22,78 @@ logger = logging.getLogger(__name__)
 DEFAULT_BATCH_SIZE = 1000
 DEFAULT_AGE = None
 DEFAULT_MAX_RETRIES = 5
-
-
-def do_update(backend, qs, start, end, total, verbosity=1, commit=True,
-              max_retries=DEFAULT_MAX_RETRIES, last_max_pk=None):
+# incremental runs reindex messages updated this long before the watermark, to
+# cover transactions that were still open when the previous run started
+WATERMARK_OVERLAP = timedelta(minutes=5)
+# incremental runs of an index hold a cache lock so they don't overlap, it expires
+# after this many seconds in case a run is killed
+INCREMENTAL_LOCK_TIMEOUT = 60 * 60
+
+# search backend of a worker process, see init_worker()
+worker_backend = None
+
+
+def build_queryset(start_date=None, end_date=None, updated_since=None):
+    kwargs = {}
+    if start_date:
+        kwargs['date__gte'] = start_date
+    if end_date:
+        kwargs['date__lte'] = end_date
+    if updated_since:
+        kwargs['updated__gt'] = updated_since
+    return Message.objects.filter(**kwargs).select_related('email_list', 'thread').order_by('id')
+
+
+def get_batch_ranges(qs, batch_size):
+    """Returns, for each batch of batch_size objects of qs, the pk range
+    (lower, upper], lower exclusive and upper inclusive, and the number of objects
+    in it.  Batches are the pk ranges that are handed to the workers.  Fixed ranges
+    don't overlap or leave gaps when rows are added or removed while the workers run
+    """
+    ranges = []
+    lower = 0
+    count = 0
+    for count, pk in enumerate(qs.values_list('pk', flat=True).iterator(chunk_size=10000), 1):
+        if count % batch_size == 0:
+            ranges.append((lower, pk, batch_size))
+            lower = pk
+    if count % batch_size:
+        ranges.append((lower, pk, count % batch_size))
+    return ranges
+
+
+def iter_database_pks(batch_size):
+    """Yields all Message pks in order, read in batches with keyset pagination"""
+    last_pk = 0
+    while True:
+        pks = list(Message.objects.filter(pk__gt=last_pk).order_by('pk').values_list(
+            'pk', flat=True)[:batch_size])
+        yield from pks
+        if len(pks) < batch_size:
+            return
+        last_pk = pks[-1]
+
+
+def init_worker(index_name=None):
+    """Worker process initializer.  The parent closes its database connections
+    before starting the workers so each worker opens its own.  The search client
+    can't be shared across processes either, create one per worker
+    """
+    global worker_backend
+    worker_backend = ESBackend(index_name=index_name)
+
+
+def update_worker(args):
+    (start, end, total, lower_pk, upper_pk, start_date, end_date, updated_since,
+     verbosity, max_retries) = args
+    qs = build_queryset(start_date=start_date, end_date=end_date, updated_since=updated_since)
+    do_update(worker_backend, qs, start, end, total, verbosity=verbosity,
+              max_retries=max_retries, last_max_pk=lower_pk, upper_pk=upper_pk)
+    return end - start
+
+
+def do_update(backend, qs, start, end, total, verbosity=1,
+              max_retries=DEFAULT_MAX_RETRIES, last_max_pk=None, pool=None, upper_pk=None):
 
     logger.debug('do_update() called. backend={}, qs={}'.format(
         type(backend), qs.count()))
@@ -38,7 +105,11 @@ def do_update(backend, qs, start, end, total, verbosity=1, commit=True,
     # If we got the max seen PK from last batch, use it to restrict the qs
     # to values above; this optimises the query for Postgres as not to
     # devolve into multi-second run time at large offsets.
-    if last_max_pk is not None:
+    # With upper_pk the batch is the pk range (last_max_pk, upper_pk], regardless
+    # of its size
+    if upper_pk is not None:
+        current_qs = small_cache_qs.filter(pk__gt=last_max_pk or 0, pk__lte=upper_pk)
+    elif last_max_pk is not None:
         current_qs = small_cache_qs.filter(pk__gt=last_max_pk)[:end - start]
     else:
         current_qs = small_cache_qs[start:end]
@@ -55,7 +126,7 @@ def do_update(backend, qs, start, end, total, verbosity=1, commit=True,
     retries = 0
     while retries < max_retries:
         try:
-            backend.update(current_qs, commit=commit)
+            backend.update(current_qs, pool=pool)
             if verbosity >= 2 and retries:
                 print('Completed indexing {} - {}, tried {}/{} times'.format(
                     start + 1,
@@ -117,7 +188,25 @@ class Command(BaseCommand):
         )
         parser.add_argument(
             '--nocommit', action='store_false', dest='commit',
-            default=True, help='Will pass commit=False to the backend.'
+            default=True, help='Skip the index refresh at the end, changes become searchable with the refresh interval.'
+        )
+        parser.add_argument(
+            '-k', '--workers', type=int, default=0,
+            help='Number of worker processes to index with, in parallel.'
+        )
+        parser.add_argument(
+            '-p', '--prepare-workers', type=int, default=0,
+            help='Number of processes to extract message text with, for each batch.  '
+                 'Not combined with --workers, which prepares in each worker.'
+        )
+        parser.add_argument(
+            '-i', '--incremental', action='store_true', default=False,
+            help='Index messages updated since the last incremental or full run.  The first '
+                 'run of an index must be a full run, or rebuild_index.'
+        )
+        parser.add_argument(
+            '--index', dest='index_name',
+            help='Index to write to, instead of the live index alias.  Used by rebuild_index.'
         )
 
     def handle(self, **options):
@@ -125,8 +214,14 @@ class Command(BaseCommand):
         self.batchsize = options.get('batchsize')
         self.start_date = None
         self.end_date = None
+        self.updated_since = None
+        self.incremental = options.get('incremental', False)
+        self.index_name = options.get('index_name')
+        # each index has its own watermark
+        self.watermark_name = self.index_name or settings.ELASTICSEARCH_INDEX_NAME
         self.remove = options.get('remove', False)
         self.workers = options.get('workers', 0)
+        self.prepare_workers = options.get('prepare_workers', 0)
         self.commit = options.get('commit', True)
         self.max_retries = options.get('max_retries', DEFAULT_MAX_RETRIES)
 
@@ -149,6 +244,9 @@ class Command(BaseCommand):
             except ValueError:
                 raise CommandError('Invalid date {}'.format(start_date))
 
+        if self.workers > 0 and self.prepare_workers > 0:
+            raise CommandError('--workers and --prepare-workers can not be combined')
+
         if end_date is not None:
             try:
                 edate = isoparse(end_date)
@@ -156,90 +254,126 @@ class Command(BaseCommand):
             except ValueError:
                 raise CommandError('Invalid date {}'.format(end_date))
 
+        if self.incremental:
+            watermark = IndexWatermark.objects.filter(name=self.watermark_name).first()
+            if watermark is None:
+                raise CommandError('No incremental watermark for index {}, run a full update_index '
+                                   'or rebuild_index first'.format(self.watermark_name))
+            self.updated_since = watermark.value - WATERMARK_OVERLAP
+            lock_key = 'update_index_incremental:{}'.format(self.watermark_name)
+            if not cache.add(lock_key, os.getpid(), INCREMENTAL_LOCK_TIMEOUT):
+                raise CommandError('An incremental update of index {} is already running'.format(
+                    self.watermark_name))
+        run_started = now()
+
         try:
             self.update_backend()
         except:
             LOG.exception("Error updating archive index")
             raise
+        finally:
+            if self.incremental:
+                cache.delete(lock_key)
+
+        # a full run of all messages also sets the watermark, for later incremental runs
+        if self.incremental or (self.start_date is None and self.end_date is None):
+            IndexWatermark.objects.update_or_create(name=self.watermark_name,
+                                                    defaults={'value': run_started})
 
     def update_backend(self):
-        backend = ESBackend()
-        
-        # handle date range
-        kwargs = {}
-        if self.start_date:
-            kwargs['date__gte'] = self.start_date
-        if self.end_date:
-            kwargs['date__lte'] = self.end_date
-
-        qs = Message.objects.filter(**kwargs).order_by('id')
+        backend = ESBackend(index_name=self.index_name)
+
+        qs = build_queryset(start_date=self.start_date, end_date=self.end_date,
+                            updated_since=self.updated_since)
         total = qs.count()
 
-        logger.info('updating index. kwargs={}, count={}'.format(
-            kwargs, total))
+        logger.info('updating index. start={}, end={}, updated_since={}, count={}'.format(
+            self.start_date, self.end_date, self.updated_since, total))
 
         if self.verbosity >= 1:
             self.stdout.write("Indexing {} Messages".format(total))
 
         batch_size = self.batchsize
 
-        max_pk = None
-        for start in range(0, total, batch_size):
-            end = min(start + batch_size, total)
-
-            max_pk = do_update(backend, qs, start, end, total,
-                               verbosity=self.verbosity,
-                               commit=self.commit, max_retries=self.max_retries,
-                               last_max_pk=max_pk)
-            logger.debug('max_pk: {}'.format(max_pk))
+        if self.workers > 0:
+            self.update_parallel(qs, total)
+        else:
+            pool = None
+            if self.prepare_workers > 0:
+                # pool processes must not share the parent's database connections
+                connections.close_all()
+                pool = multiprocessing.get_context('fork').Pool(self.prepare_workers)
+            try:
+                max_pk = None
+                for start in range(0, total, batch_size):
+                    end = min(start + batch_size, total)
+
+                    max_pk = do_update(backend, qs, start, end, total,
+                                       verbosity=self.verbosity,
+                                       max_retries=self.max_retries,
+                                       last_max_pk=max_pk,
+                                       pool=pool)
+                    logger.debug('max_pk: {}'.format(max_pk))
+            finally:
+                if pool:
+                    pool.close()
+                    pool.join()
 
         if self.remove:
-            if self.start_date or self.end_date or total <= 0:
-                # They're using a reduced set, which may not incorporate
-                # all pks. Rebuild the list with everything.
-                qs = Message.objects.all().values_list('pk', flat=True)
-                database_pks = set(smart_bytes(pk) for pk in qs)
-            else:
-                database_pks = set(smart_bytes(pk) for pk in qs.values_list('pk', flat=True))
-
-            # Since records may still be in the search index but not the local database
-            # we'll use that to create batches for processing.
-            s = Search(using=backend.client, index=settings.ELASTICSEARCH_INDEX_NAME)
-            index_total = s.count()
-
-            # Retrieve PKs from the index. Note that this cannot be a numeric range query because although
-            # pks are normally numeric they can be non-numeric UUIDs or other custom values. To reduce
-            # load on the search engine, we only retrieve the pk field, which will be checked against the
-            # full list obtained from the database, and the id field, which will be used to delete the
-            # record should it be found to be stale.
-            s = Search(using=backend.client, index=settings.ELASTICSEARCH_INDEX_NAME)
-            s = s.source(fields={'includes': ['django_id', 'id']})
-            s = s.scan()
-            index_pks = [(h['django_id'], h['id']) for h in s]
-            # index_pks = SearchQuerySet(using=backend.connection_alias).models(model)
-            # index_pks = index_pks.values_list('pk', 'id')
-
-            # We'll collect all of the record IDs which are no longer present in the database and delete
-            # them after walking the entire index. This uses more memory than the incremental approach but
-            # avoids needing the pagination logic below to account for both commit modes:
-            stale_records = set()
-
-            for start in range(0, index_total, batch_size):
-                upper_bound = start + batch_size
-
-                # If the database pk is no longer present, queue the index key for removal:
-                for pk, rec_id in index_pks[start:upper_bound]:
-                    if smart_bytes(pk) not in database_pks:
-                        stale_records.add(rec_id)
-
-            if stale_records:
-                if self.verbosity >= 1:
-                    self.stdout.write("  removing %d stale records." % len(stale_records))
-
-                for rec_id in stale_records:
-                    # Since the PK was not in the database list, we'll delete the record from the search
-                    # index:
-                    if self.verbosity >= 2:
-                        self.stdout.write("  removing %s." % rec_id)
-
-                    backend.remove(rec_id, commit=self.commit)
+            self.remove_stale(backend)
+
+        # one refresh for the whole run, instead of one per batch
+        if self.commit:
+            backend.refresh()
+
+    def remove_stale(self, backend):
+        """Remove records from the index that are no longer present in the database.
+        Database pks and indexed records are both walked in pk order, a batch at a
+        time, so memory use doesn't depend on the size of the archive.  Covers all
+        messages, regardless of date options
+        """
+        database_pks = iter_database_pks(self.batchsize)
+        db_pk = next(database_pks, None)
+        stale_records = []
+        removed = 0
+        for pk, rec_id in backend.scan_ids(batch_size=self.batchsize):
+            while db_pk is not None and db_pk < pk:
+                db_pk = next(database_pks, None)
+            if db_pk == pk:
+                continue
+            # Since the PK was not in the database list, we'll delete the record from the search
+            # index:
+            if self.verbosity >= 2:
+                self.stdout.write("  removing %s." % rec_id)
+            stale_records.append(rec_id)
+            if len(stale_records) >= self.batchsize:
+                backend.remove_many(stale_records)
+                removed += len(stale_records)
+                stale_records = []
+        if stale_records:
+            backend.remove_many(stale_records)
+            removed += len(stale_records)
+
+        if removed and self.verbosity >= 1:
+            self.stdout.write("  removed %d stale records." % removed)
+
+    def update_parallel(self, qs, total):
+        """Index qs with a pool of worker processes, one pk range batch per task"""
+        tasks = []
+        start = 0
+        for lower_pk, upper_pk, count in get_batch_ranges(qs, self.batchsize):
+            end = start + count
+            tasks.append((start, end, total, lower_pk, upper_pk, self.start_date, self.end_date,
+                          self.updated_since, self.verbosity, self.max_retries))
+            start = end
+
+        # workers must not share the parent's database connections
+        connections.close_all()
+        done = 0
+        context = multiprocessing.get_context('fork')
+        with context.Pool(self.workers, initializer=init_worker, initargs=(self.index_name,)) as pool:
+            for count in pool.imap_unordered(update_worker, tasks):
+                done += count
+                logger.debug('indexed {} of {}'.format(done, total))
+        if self.verbosity >= 2:
+            self.stdout.write("  indexed {} of {} with {} workers.".format(done, total, self.workers))
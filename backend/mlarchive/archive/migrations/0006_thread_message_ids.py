@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:40
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0005_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='message_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True,
+                                                            default=list, size=None),
+        ),
+    ]
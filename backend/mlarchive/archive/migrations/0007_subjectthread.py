@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def forward(apps, schema_editor):
+    Message = apps.get_model('archive', 'Message')
+    SubjectThread = apps.get_model('archive', 'SubjectThread')
+
+    latest = Message.objects.order_by('email_list_id', 'base_subject', '-date').distinct(
+        'email_list_id', 'base_subject').values_list('email_list_id', 'base_subject', 'thread_id', 'date')
+    batch = []
+    for email_list_id, base_subject, thread_id, date in latest.iterator(chunk_size=1000):
+        batch.append(SubjectThread(email_list_id=email_list_id, base_subject=base_subject,
+                                   thread_id=thread_id, date=date))
+        if len(batch) >= 1000:
+            SubjectThread.objects.bulk_create(batch)
+            batch = []
+    SubjectThread.objects.bulk_create(batch)
+
+
+def reverse(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0006_thread_message_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubjectThread',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base_subject', models.CharField(blank=True, max_length=512)),
+                ('date', models.DateTimeField()),
+                ('email_list', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='archive.emaillist')),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='archive.thread')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('email_list', 'base_subject'),
+                                                        name='unique_subject_thread')],
+            },
+        ),
+        migrations.RunPython(forward, reverse),
+    ]
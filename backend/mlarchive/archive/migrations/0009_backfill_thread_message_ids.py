@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:14
+
+from django.db import migrations
+
+
+def forward(apps, schema_editor):
+    Message = apps.get_model('archive', 'Message')
+    Thread = apps.get_model('archive', 'Thread')
+
+    # threads in pk order, a batch at a time, with the ids of their messages
+    last_pk = 0
+    while True:
+        threads = list(Thread.objects.filter(pk__gt=last_pk, message_ids=[]).order_by('pk')[:1000])
+        if not threads:
+            break
+        last_pk = threads[-1].pk
+        ids = {thread.pk: [] for thread in threads}
+        messages = Message.objects.filter(thread__in=threads).order_by('thread_id', 'thread_order')
+        for thread_id, pk in messages.values_list('thread_id', 'pk'):
+            ids[thread_id].append(pk)
+        for thread in threads:
+            thread.message_ids = ids[thread.pk]
+        Thread.objects.bulk_update(threads, ['message_ids'])
+
+
+def reverse(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0008_indexwatermark'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, reverse),
+    ]
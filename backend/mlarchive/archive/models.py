@@ -7,9 +7,12 @@ import logging
 import os
 import re
 import subprocess
+from collections import defaultdict
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.postgres.fields import ArrayField
+from django.core.files.storage import storages
 from django.db import models
 from django.forms.models import model_to_dict
 from django.urls import reverse
@@ -17,6 +20,7 @@ from django.utils.http import urlencode
 from django.template.loader import render_to_string
 
 from mlarchive.archive.generator import Generator
+from mlarchive.archive.storage_utils import store_str
 from mlarchive.archive.thread import parse_message_ids
 from mlarchive.utils.encoding import is_attachment, custom_policy
 
@@ -24,6 +28,9 @@ from mlarchive.utils.encoding import is_attachment, custom_policy
 TXT2HTML = ['/usr/bin/mhonarc', '-single']
 ATTACHMENT_PATTERN = r'<p><strong>Attachment:((?:.|\n)*?)</p>'
 REFERENCE_RE = re.compile(r'<(.*?)>')
+# version of the text extracted by Generator.as_text(), part of the key of the
+# ml-messages-text blobs.  Increment when the output changes to stop using old text
+TEXT_EXTRACTOR_VERSION = 1
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +40,78 @@ logger = logging.getLogger(__name__)
 # --------------------------------------------------
 
 
+def get_thread_messages(threads):
+    '''Returns the messages of threads, thread by thread in thread order.  Uses the
+    stored Thread.message_ids, so all threads are read with one query.  Threads
+    without message_ids are read with one more query
+    '''
+    ids = [pk for thread in threads for pk in thread.message_ids]
+    messages = Message.objects.in_bulk(ids) if ids else {}
+    missing = defaultdict(list)
+    unsorted = [thread.pk for thread in threads if not thread.message_ids]
+    if unsorted:
+        for message in Message.objects.filter(thread__in=unsorted).order_by('thread_id', 'thread_order'):
+            missing[message.thread_id].append(message)
+    results = []
+    for thread in threads:
+        if thread.message_ids:
+            results.extend(messages[pk] for pk in thread.message_ids if pk in messages)
+        else:
+            results.extend(missing[thread.pk])
+    return results
+
+
+def get_subject_thread(email_list, base_subject, date):
+    '''Returns a SubjectThread for the latest message in email_list before date
+    with base_subject, or None.  Normally one read of the SubjectThread row, when
+    date is older than the stored message, ie. messages imported out of order,
+    the messages are queried and an unsaved SubjectThread is returned
+    '''
+    entry = SubjectThread.objects.filter(email_list=email_list,
+                                         base_subject=base_subject).select_related('thread').first()
+    if entry is None or entry.date < date:
+        return entry
+    message = Message.objects.filter(email_list=email_list,
+                                     date__lt=date,
+                                     base_subject=base_subject).select_related('thread').order_by('-date').first()
+    if message:
+        return SubjectThread(email_list=email_list, base_subject=base_subject,
+                             thread=message.thread, date=message.date)
+
+
+def update_subject_threads(messages):
+    '''Records the thread of messages as the latest for their base subject,
+    unless the list has a newer message with the same base subject
+    '''
+    latest = {}
+    for message in messages:
+        key = (message.email_list_id, message.base_subject)
+        if key not in latest or message.date > latest[key].date:
+            latest[key] = message
+    new = []
+    for (email_list_id, base_subject), message in latest.items():
+        updated = SubjectThread.objects.filter(email_list_id=email_list_id,
+                                               base_subject=base_subject,
+                                               date__lt=message.date).update(thread_id=message.thread_id,
+                                                                             date=message.date)
+        if not updated:
+            new.append(SubjectThread(email_list_id=email_list_id, base_subject=base_subject,
+                                     thread_id=message.thread_id, date=message.date))
+    if new:
+        SubjectThread.objects.bulk_create(new, ignore_conflicts=True)
+
+
+def refresh_subject_thread(email_list, base_subject):
+    '''Sets the SubjectThread for base_subject from the latest remaining message.
+    Call when messages are removed
+    '''
+    SubjectThread.objects.filter(email_list=email_list, base_subject=base_subject).delete()
+    message = Message.objects.filter(email_list=email_list,
+                                     base_subject=base_subject).order_by('-date').first()
+    if message:
+        update_subject_threads([message])
+
+
 def get_in_reply_to_message(in_reply_to_value, email_list):
     '''Returns the in_reply_to message, if it exists'''
     msgids = parse_message_ids(in_reply_to_value)
@@ -85,24 +164,45 @@ class Thread(models.Model):
     email_list = models.ForeignKey('EmailList', db_index=True, on_delete=models.CASCADE, null=True)
     # first message in thread, by date
     first = models.ForeignKey('Message', on_delete=models.SET_NULL, related_name='thread_key', blank=True, null=True)
+    # ids of the messages in thread order, see update_message_ids()
+    message_ids = ArrayField(models.IntegerField(), default=list, blank=True)
 
     def __str__(self):
         return str(self.id)
 
+    def get_message_ids(self):
+        """Returns the ids of the messages in thread order"""
+        if self.message_ids:
+            return self.message_ids
+        return list(self.message_set.order_by('thread_order').values_list('id', flat=True))
+
+    def get_messages(self):
+        """Returns the messages of the thread in thread order"""
+        return get_thread_messages([self])
+
     def get_snippet(self):
         """Returns all messages of the thread as an HTML snippet"""
-        context = {'messages': self.message_set.order_by('thread_order')}
+        context = {'messages': self.get_messages()}
         return render_to_string('archive/thread_snippet.html', context)
 
+    def update_message_ids(self):
+        """Stores the message ids in thread order.  Call when threading changes"""
+        self.message_ids = list(self.message_set.order_by('thread_order').values_list('id', flat=True))
+        Thread.objects.filter(pk=self.pk).update(message_ids=self.message_ids)
+
     def set_first(self, message=None):
         """Sets the first message of the thread.  Call when adding or removing
         messages
         """
         if not message:
             message = self.message_set.all().order_by('date').first()
+        date_changed = self.pk and self.date != message.date
         self.first = message
         self.date = message.date
         self.save()
+        if date_changed:
+            from mlarchive.archive.signals import thread_date_changed
+            thread_date_changed.send(sender=Thread, thread_id=self.pk, date=self.date)
 
     def get_next(self):
         """Returns next thread in the list"""
@@ -333,9 +433,32 @@ class Message(models.Model):
     def get_body(self):
         """Returns the contents of the message body, text only for use in indexing.
         ie. HTML is stripped.  This is called from the index template.
+
+        The text is extracted once and kept in the ml-messages-text bucket, see
+        get_text_blob_name()
         """
-        gen = Generator(self)
-        return gen.as_text()
+        if not settings.ENABLE_BLOBSTORAGE:
+            return Generator(self).as_text()
+        name = self.get_text_blob_name()
+        try:
+            with storages['ml-messages-text'].open(name) as f:
+                return f.read().decode('utf8')
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            logger.warning(f'Error reading message text {name}: {repr(err)}')
+        text = Generator(self).as_text()
+        # don't keep errors, the file may be readable later
+        if not self.pymsg_error:
+            try:
+                store_str('ml-messages-text', name, text, allow_overwrite=True, content_type='text/plain')
+            except Exception:
+                pass    # logged by store_str
+        return text
+
+    def get_text_blob_name(self):
+        """Returns the name of the extracted text blob in the ml-messages-text bucket"""
+        return f'v{TEXT_EXTRACTOR_VERSION}/{self.hashcode}'
 
     def get_body_html(self, request=None):
         """Returns the contents of the message body as HTML, for use in display
@@ -465,7 +588,7 @@ class Message(models.Model):
     def get_thread_snippet(self):
         """Returns all messages of the thread as an HTML snippet"""
         context = {
-            'messages': self.thread.message_set.order_by('thread_order'),
+            'messages': self.thread.get_messages(),
             'msg': self,
         }
         return render_to_string('archive/thread_snippet.html', context)
@@ -483,18 +606,29 @@ class Message(models.Model):
         messages = messages.order_by('date')
         return messages.first()
 
+    def _get_thread_message_ids(self):
+        """Returns the ids of the messages of the thread, in thread order.  Reads
+        them from the messages if the stored ids don't include this message
+        """
+        ids = self.thread.get_message_ids()
+        if self.pk not in ids:
+            ids = list(self.thread.message_set.order_by('thread_order').values_list('id', flat=True))
+        return ids
+
     def next_in_thread(self):
         """Return the next message in thread"""
-        messages = self.thread.message_set.filter(thread_order__gt=self.thread_order)
-        messages = messages.order_by('thread_order')
-        if messages.first():
-            return messages.first()
+        ids = self._get_thread_message_ids()
+        if self.pk in ids:
+            later = ids[ids.index(self.pk) + 1:]
+            if later:
+                return Message.objects.filter(pk=later[0]).first()
 
         next_thread = Thread.objects.filter(
             date__gt=self.thread.date,
             email_list=self.email_list).order_by('date').first()
         if next_thread:
-            return next_thread.message_set.order_by('thread_order').first()
+            ids = next_thread.get_message_ids()
+            return Message.objects.filter(pk=ids[0]).first() if ids else None
         else:
             return None
 
@@ -507,16 +641,18 @@ class Message(models.Model):
 
     def previous_in_thread(self):
         """Return the previous message in thread"""
-        messages = self.thread.message_set.filter(thread_order__lt=self.thread_order)
-        messages = messages.order_by('thread_order')
-        if messages.last():
-            return messages.last()
+        ids = self._get_thread_message_ids()
+        if self.pk in ids:
+            earlier = ids[:ids.index(self.pk)]
+            if earlier:
+                return Message.objects.filter(pk=earlier[-1]).first()
 
         previous_thread = Thread.objects.filter(
             date__lt=self.thread.date,
             email_list=self.email_list).order_by('date').last()
         if previous_thread:
-            return previous_thread.message_set.order_by('thread_order').first()
+            ids = previous_thread.get_message_ids()
+            return Message.objects.filter(pk=ids[0]).first() if ids else None
         else:
             return None
 
@@ -537,6 +673,24 @@ class Message(models.Model):
             return self.to
 
 
+class SubjectThread(models.Model):
+    '''The thread of the latest message in email_list with base_subject.  Used
+    to thread replies that don't reference an archived message, see
+    MessageWrapper.get_thread()'''
+    email_list = models.ForeignKey(EmailList, on_delete=models.CASCADE)
+    base_subject = models.CharField(max_length=512, blank=True)
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
+    date = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['email_list', 'base_subject'], name='unique_subject_thread'),
+        ]
+
+    def __str__(self):
+        return f'{self.email_list_id}:{self.base_subject}'
+
+
 class Attachment(models.Model):
     # message if problem with attachment
     error = models.CharField(max_length=255, blank=True)
@@ -606,3 +760,35 @@ class MailmanMember(models.Model):
 
     def __str__(self):
         return f'{self.email_list.name}:{self.address}'
+
+
+class IndexWatermark(models.Model):
+    '''High-water mark of incremental index updates.  value is the time the last
+    successful "update_index --incremental" or full run started, messages with a
+    later Message.updated are indexed by the next incremental run'''
+    name = models.CharField(max_length=255, unique=True)
+    value = models.DateTimeField()
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.name}:{self.value}'
+
+
+class ImportCheckpoint(models.Model):
+    '''Progress of a mailbox import run.  offset is the byte offset in the source
+    file up to which messages have been processed.  An interrupted run, completed
+    is False, is resumed from offset by the next Loader for the same source'''
+    source = models.CharField(max_length=1024)
+    listname = models.CharField(max_length=65)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+    completed = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['source', 'listname'])]
+
+    def __str__(self):
+        return f'{self.listname}:{self.source}:{self.offset}'
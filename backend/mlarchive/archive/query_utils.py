@@ -5,7 +5,6 @@ import secrets
 from django.conf import settings
 from django.core.cache import cache
 from django.core.paginator import Paginator
-from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import RequestError
 from elasticsearch_dsl import Q, Search
 
@@ -59,13 +58,8 @@ def get_cached_query(request):
     search_dict = cache.get(queryid)
     if search_dict:
         logger.debug('Found search in cache: {}'.format(search_dict))
-        connection_options = settings.ELASTICSEARCH_CONNECTION
-        client = Elasticsearch(
-            connection_options['URL'],
-            index=connection_options['INDEX_NAME'],
-            http_auth=connection_options['http_auth'],
-            **connection_options.get('KWARGS', {}))
-        search = Search(using=client, index=settings.ELASTICSEARCH_INDEX_NAME)
+        from mlarchive.archive.backends.elasticsearch import get_client
+        search = Search(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
         search = search.update_from_dict(search_dict)
         # Apply the *current* user's private-list exclusion. The cached query is
         # user-neutral (the exclusion is not cached), and a qid travels in URLs,
@@ -273,13 +267,8 @@ def get_count(query):
 # TODO: remove?
 def get_empty_response():
     '''Return an empty elasticsearch response'''
-    connection_options = settings.ELASTICSEARCH_CONNECTION
-    client = Elasticsearch(
-        connection_options['URL'],
-        index=connection_options['INDEX_NAME'],
-        http_auth=connection_options['http_auth'],
-        **connection_options.get('KWARGS', {}))
-    s = Search(using=client, index=settings.ELASTICSEARCH_INDEX_NAME)
+    from mlarchive.archive.backends.elasticsearch import get_client
+    s = Search(using=get_client(), index=settings.ELASTICSEARCH_INDEX_NAME)
     s = s.query('term', dummy='')
     return s.execute()
 
@@ -1,10 +1,13 @@
+import atexit
 import io
 import logging
 import os
 import requests
 import shutil
 import sys
+import threading
 import traceback
+from celery.signals import task_postrun, worker_process_shutdown
 from cloudflare import Cloudflare, APIError
 
 from importlib import import_module
@@ -12,11 +15,13 @@ from importlib import import_module
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
-from django.dispatch import receiver
+from django.core.signals import request_finished
+from django.dispatch import receiver, Signal
 from django.db.models.signals import pre_delete, post_delete, post_save
 from django.db import models, connection, transaction
 
-from mlarchive.archive.models import Message, EmailList
+from mlarchive.archive.models import (Message, EmailList, SubjectThread, Thread,
+    refresh_subject_thread, update_subject_threads)
 from mlarchive.archive.backends.elasticsearch import ESBackend, get_identifier
 from mlarchive.archive.storage_utils import store_file, remove_from_storage, move_object
 from mlarchive.archive.utils import _export_lists
@@ -24,6 +29,17 @@ from mlarchive.celeryapp import app
 
 logger = logging.getLogger(__name__)
 
+# sent by MessageBatch in place of post_save, with argument "instances"
+messages_bulk_created = Signal()
+
+# sent by MessageWrapper after moving messages down to make room for a new
+# message in a thread, with arguments "thread_id", "start" and "exclude"
+thread_order_shifted = Signal()
+
+# sent when the date of a thread changes, ie. its first message, with arguments
+# "thread_id" and "date"
+thread_date_changed = Signal()
+
 
 # --------------------------------------------------
 # Signal Handlers
@@ -82,6 +98,7 @@ def _message_remove(sender, instance, **kwargs):
     # delete blob from ml-messages-json bucket
     # Ok if it's not there, a private message wouldn't be
     remove_from_storage(kind='ml-messages-json', name=instance.get_blob_name(), warn_if_missing=False)
+    remove_from_storage(kind='ml-messages-text', name=instance.get_text_blob_name(), warn_if_missing=False)
 
     logger.info('message file moved: {} => {}'.format(path, target_dir))
 
@@ -97,6 +114,34 @@ def _message_remove(sender, instance, **kwargs):
         purge_files_from_cache(instance)
 
 
+# threads of messages deleted in the current transaction, per thread
+_deleted_message_threads = threading.local()
+
+
+@receiver(post_delete, sender=Message)
+def _update_thread_message_ids(sender, instance, using, **kwargs):
+    """When messages are removed, drop them from the thread's stored message ids.
+    Threads are collected and updated once, when the transaction commits
+    """
+    thread_ids = getattr(_deleted_message_threads, 'ids', None)
+    if thread_ids is None:
+        thread_ids = _deleted_message_threads.ids = set()
+    thread_ids.add(instance.thread_id)
+    transaction.on_commit(_update_deleted_message_threads, using=using)
+
+
+def _update_deleted_message_threads():
+    """Updates the stored message ids of the threads collected by
+    _update_thread_message_ids().  Threads that were deleted too are skipped
+    """
+    thread_ids = getattr(_deleted_message_threads, 'ids', None)
+    if not thread_ids:
+        return
+    _deleted_message_threads.ids = set()
+    for thread in Thread.objects.filter(pk__in=thread_ids):
+        thread.update_message_ids()
+
+
 @receiver(post_save, sender=Message)
 def _update_thread(sender, instance, **kwargs):
     """When messages are saved, udpate thread info
@@ -105,6 +150,25 @@ def _update_thread(sender, instance, **kwargs):
         instance.thread.set_first(instance)
 
 
+@receiver(post_save, sender=Message)
+def _update_subject_thread(sender, instance, created, **kwargs):
+    """When messages are created, update the thread of their base subject
+    """
+    if created:
+        update_subject_threads([instance])
+
+
+@receiver(post_delete, sender=Message)
+def _remove_subject_thread(sender, instance, **kwargs):
+    """When the latest message of a base subject is removed, fall back to the
+    previous one
+    """
+    if SubjectThread.objects.filter(email_list_id=instance.email_list_id,
+                                    base_subject=instance.base_subject,
+                                    date=instance.date).exists():
+        refresh_subject_thread(instance.email_list_id, instance.base_subject)
+
+
 @receiver(post_save, sender=Message)
 def _purge_cache(sender, instance, created, **kwargs):
     if created and settings.SERVER_MODE == 'production' and settings.USING_CDN:
@@ -260,17 +324,46 @@ class BaseSignalProcessor(object):
         Given an individual model instance, update the index
         """
         try:
-            self.backend.update([instance])
+            self.backend.update([instance], refresh=settings.ELASTICSEARCH_WRITE_REFRESH)
         except Exception:
             # TODO: Maybe log it or let the exception bubble?
             pass
 
+    def handle_bulk_save(self, sender, instances, **kwargs):
+        """
+        Given a list of model instances, update the index with one request
+        """
+        try:
+            self.backend.update(instances, refresh=settings.ELASTICSEARCH_WRITE_REFRESH)
+        except Exception:
+            logger.exception('bulk index update failed')
+
+    def handle_thread_shift(self, sender, thread_id, start, exclude=None, **kwargs):
+        """
+        Given a thread, increment thread_order of indexed messages from start on
+        """
+        try:
+            self.backend.shift_thread_order(thread_id, start, exclude=exclude,
+                                            refresh=settings.ELASTICSEARCH_WRITE_REFRESH)
+        except Exception:
+            logger.exception('thread order index update failed')
+
+    def handle_thread_date(self, sender, thread_id, date, **kwargs):
+        """
+        Given a thread, set thread_date of its indexed messages
+        """
+        try:
+            self.backend.update_thread_date(thread_id, date,
+                                            refresh=settings.ELASTICSEARCH_WRITE_REFRESH)
+        except Exception:
+            logger.exception('thread date index update failed')
+
     def handle_delete(self, sender, instance, **kwargs):
         """
         Given an individual model instance, delete from index.
         """
         try:
-            self.backend.remove(instance)
+            self.backend.remove(instance, refresh=settings.ELASTICSEARCH_WRITE_REFRESH)
         except Exception:
             # TODO: Maybe log it or let the exception bubble?
             pass
@@ -284,21 +377,90 @@ class RealtimeSignalProcessor(BaseSignalProcessor):
     def setup(self):
         models.signals.post_save.connect(self.handle_save, sender=Message)
         models.signals.post_delete.connect(self.handle_delete, sender=Message)
+        messages_bulk_created.connect(self.handle_bulk_save, sender=Message)
+        thread_order_shifted.connect(self.handle_thread_shift, sender=Message)
+        thread_date_changed.connect(self.handle_thread_date, sender=Thread)
 
     def teardown(self):
         models.signals.post_save.disconnect(self.handle_save, sender=Message)
         models.signals.post_delete.disconnect(self.handle_delete, sender=Message)
+        messages_bulk_created.disconnect(self.handle_bulk_save, sender=Message)
+        thread_order_shifted.disconnect(self.handle_thread_shift, sender=Message)
+        thread_date_changed.disconnect(self.handle_thread_date, sender=Thread)
+
+
+class IndexBatcher(object):
+    """
+    Collects index updates and sends them to Celery as one batch task.  A batch
+    is sent when it holds "size" changes or "window" seconds after its first
+    change, whichever comes first, and at process exit.  CelerySignalProcessor
+    also sends it at the end of each request and Celery task.  With a window of 0
+    every change is sent right away.
+
+    Updates that are lost with the process, ie. when it is killed, have a newer
+    Message.updated, so the incremental update_index run (update_index_task)
+    indexes them.  Deletes can't be recovered that way, they are sent right
+    away, along with any pending updates.
+    """
+    def __init__(self, window, size):
+        self.window = window
+        self.size = size
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timer = None
+        atexit.register(self.flush)
+
+    def add(self, action, identifier, pk):
+        with self.lock:
+            # the last action for an instance wins
+            self.pending[identifier] = (action, pk)
+            send = len(self.pending) >= self.size or self.window <= 0 or action == 'delete'
+            if not send and self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if send:
+            self.flush()
+
+    def flush(self, **kwargs):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        updates = [pk for action, pk in pending.values() if action == 'update']
+        deletes = [identifier for identifier, (action, _) in pending.items() if action == 'delete']
+        try:
+            get_update_task(settings.CELERY_BATCH_TASK).apply_async((updates, deletes))
+        except Exception:
+            logger.exception('sending index batch failed')
 
 
 class CelerySignalProcessor(BaseSignalProcessor):
 
     def setup(self):
+        self.batcher = IndexBatcher(settings.CELERY_INDEX_BATCH_WINDOW, settings.CELERY_INDEX_BATCH_SIZE)
         models.signals.post_save.connect(self.enqueue_save, sender=Message)
         models.signals.post_delete.connect(self.enqueue_delete, sender=Message)
+        messages_bulk_created.connect(self.handle_bulk_save, sender=Message)
+        thread_order_shifted.connect(self.handle_thread_shift, sender=Message)
+        thread_date_changed.connect(self.handle_thread_date, sender=Thread)
+        # don't hold changes in processes that may be recycled between requests or tasks
+        request_finished.connect(self.batcher.flush)
+        task_postrun.connect(self.batcher.flush)
+        worker_process_shutdown.connect(self.batcher.flush)
 
     def teardown(self):
         models.signals.post_save.disconnect(self.enqueue_save, sender=Message)
         models.signals.post_delete.disconnect(self.enqueue_delete, sender=Message)
+        messages_bulk_created.disconnect(self.handle_bulk_save, sender=Message)
+        thread_order_shifted.disconnect(self.handle_thread_shift, sender=Message)
+        thread_date_changed.disconnect(self.handle_thread_date, sender=Thread)
+        request_finished.disconnect(self.batcher.flush)
+        task_postrun.disconnect(self.batcher.flush)
+        worker_process_shutdown.disconnect(self.batcher.flush)
 
     def enqueue_save(self, sender, instance, **kwargs):
         return self.enqueue('update', instance, sender, **kwargs)
@@ -307,9 +469,31 @@ class CelerySignalProcessor(BaseSignalProcessor):
         return self.enqueue('delete', instance, sender, **kwargs)
 
     def enqueue(self, action, instance, sender, **kwargs):
-        enqueue_task(action, instance)
+        # the pk is gone from deleted instances by the time the transaction commits
+        identifier = get_identifier(instance)
+        pk = instance.pk
+        transaction.on_commit(lambda: self.batcher.add(action, identifier, pk))
         return
 
+    def handle_bulk_save(self, sender, instances, **kwargs):
+        for instance in instances:
+            self.enqueue('update', instance, sender)
+
+    def handle_thread_shift(self, sender, thread_id, start, exclude=None, **kwargs):
+        # the task sets the stored order, so it can be retried
+        self.enqueue_thread_task(settings.CELERY_THREAD_ORDER_TASK, thread_id, start)
+
+    def handle_thread_date(self, sender, thread_id, date, **kwargs):
+        self.enqueue_thread_task(settings.CELERY_THREAD_DATE_TASK, thread_id)
+
+    def enqueue_thread_task(self, name, *args):
+        def send():
+            try:
+                get_update_task(name).apply_async(args)
+            except Exception:
+                logger.exception('sending {} failed'.format(name))
+        transaction.on_commit(send)
+
 
 def enqueue_task(action, instance, **kwargs):
     """
@@ -1,7 +1,7 @@
+import base64
 import gzip
+import io
 import logging
-import tempfile
-import os
 
 import requests
 from celery import Task, shared_task
@@ -24,8 +24,9 @@ from mlarchive.archive.utils import mark_not_spam
 from mlarchive.archive.utils import purge_confirmed_dupes
 from mlarchive.archive.utils import import_message_blob
 from mlarchive.archive.utils import load_hidden_messages
-from mlarchive.archive.models import EmailList, Message, User
-from mlarchive.archive.mail import Loader
+from mlarchive.archive.models import EmailList, Message, Thread, User
+from mlarchive.archive.mail import ChunkStream, StreamLoader
+from mlarchive.archive.storage_utils import store_file
 
 logger = logging.getLogger(__name__)
 
@@ -103,7 +104,7 @@ class CelerySignalHandler(Task):
             # If the object is gone, we'll use just the identifier
             # against the index.
             try:
-                backend.remove(identifier)
+                backend.remove(identifier, refresh=settings.ELASTICSEARCH_WRITE_REFRESH)
             except Exception as exc:
                 logger.exception(exc)
                 self.retry(exc=exc)
@@ -123,7 +124,7 @@ class CelerySignalHandler(Task):
             # Call the appropriate handler of the current index and
             # handle exception if neccessary
             try:
-                backend.update([instance])
+                backend.update([instance], refresh=settings.ELASTICSEARCH_WRITE_REFRESH)
             except Exception as exc:
                 logger.exception(exc)
                 self.retry(exc=exc)
@@ -140,6 +141,36 @@ class CelerySignalHandler(Task):
 app.register_task(CelerySignalHandler())
 
 
+class CelerySignalBatchHandler(CelerySignalHandler):
+    """Index a batch of changes collected by IndexBatcher, with one bulk request
+    """
+    def run(self, updates, deletes, **kwargs):
+        """
+        updates is a list of Message pks to index, deletes a list of identifiers
+        to remove from the index
+        """
+        backend = ESBackend()
+        messages = list(Message.objects.filter(pk__in=updates).select_related('email_list', 'thread'))
+        if len(messages) < len(updates):
+            logger.debug("Skipped %d messages that went missing" % (len(updates) - len(messages)))
+        try:
+            if deletes:
+                backend.remove_many(deletes, refresh=settings.ELASTICSEARCH_WRITE_REFRESH)
+            if messages:
+                backend.update(messages, refresh=settings.ELASTICSEARCH_WRITE_REFRESH)
+        except Exception as exc:
+            logger.exception(exc)
+            self.retry(exc=exc)
+        else:
+            msg = ("Updated %d, deleted %d (with %s)" %
+                   (len(messages), len(deletes), backend.index_name))
+            logger.debug(msg)
+            return msg
+
+
+app.register_task(CelerySignalBatchHandler())
+
+
 @app.task
 def remove_selected_task(user_id):
     remove_selected(user_id)
@@ -159,6 +190,45 @@ def import_message_blob_task(bucket, name):
     import_message_blob(bucket, name)
 
 
+@shared_task(
+    acks_late=True, autoretry_for=(Exception,), retry_backoff=10, retry_kwargs={"max_retries": 5}
+)
+def store_message_blob_task(data, bucket, name):
+    """Store an archived message in blob storage.  data is the base64 encoded
+    message.  Queued by MessageWrapper.write_msg(), see BLOB_WRITE_BEHIND
+    """
+    store_file(bucket, name, io.BytesIO(base64.b64decode(data)), allow_overwrite=True,
+               content_type='message/rfc822')
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=10, retry_kwargs={"max_retries": 5})
+def update_thread_order_task(thread_id, start):
+    """Set thread_order of the indexed messages of a thread, from start on, to the
+    stored values.  Queued by CelerySignalProcessor after messages were moved down
+    to make room for a new one
+    """
+    orders = dict(Message.objects.filter(thread_id=thread_id, thread_order__gte=start).values_list(
+        'pk', 'thread_order'))
+    if orders:
+        backend = ESBackend()
+        # raise errors, to retry
+        backend.silently_fail = False
+        backend.set_thread_orders(thread_id, orders, refresh=settings.ELASTICSEARCH_WRITE_REFRESH)
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=10, retry_kwargs={"max_retries": 5})
+def update_thread_date_task(thread_id):
+    """Set thread_date of the indexed messages of a thread to the stored date.
+    Queued by CelerySignalProcessor when the first message of a thread changes
+    """
+    thread = Thread.objects.filter(pk=thread_id).first()
+    if thread:
+        backend = ESBackend()
+        # raise errors, to retry
+        backend.silently_fail = False
+        backend.update_thread_date(thread.pk, thread.date, refresh=settings.ELASTICSEARCH_WRITE_REFRESH)
+
+
 @shared_task
 def import_mbox_url_task(list_name, list_visibility, url):
     """Download an mbox file from url and import all messages into the archive."""
@@ -173,9 +243,11 @@ def import_mbox_url_task(list_name, list_visibility, url):
         return
 
     content_length = response.headers.get('Content-Length')
+    size = 0
     if content_length is not None:
         try:
-            if int(content_length) > settings.IMPORT_MBOX_MAX_SIZE:
+            size = int(content_length)
+            if size > settings.IMPORT_MBOX_MAX_SIZE:
                 logger.error(
                     f'import_mbox_url_task: {url} Content-Length {content_length} '
                     f'exceeds limit {settings.IMPORT_MBOX_MAX_SIZE}'
@@ -188,38 +260,35 @@ def import_mbox_url_task(list_name, list_visibility, url):
     content_type = response.headers.get('Content-Type', '')
     is_gzip = content_type in ('application/x-gzip', 'application/gzip')
 
-    temp_files = []
-    try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.download') as raw_f:
-            raw_path = raw_f.name
-            temp_files.append(raw_path)
-            for chunk in response.iter_content(chunk_size=65536):
-                raw_f.write(chunk)
+    # a checkpoint is only resumed for the same content.  Without a size the url
+    # could serve anything, don't resume
+    source = url
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    if validator:
+        source = f'{url} {validator}'
+    resume = size > 0
 
+    # download, decompression and message splitting are chained so messages are
+    # archived while the rest of the file is still arriving
+    try:
+        stream = ChunkStream(response.iter_content(chunk_size=65536), max_size=settings.IMPORT_MBOX_MAX_SIZE)
+        fileobj = io.BufferedReader(stream, buffer_size=65536)
         if is_gzip:
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.mbox') as mbox_f:
-                mbox_path = mbox_f.name
-                temp_files.append(mbox_path)
-                with gzip.open(raw_path, 'rb') as gz_in:
-                    for chunk in iter(lambda: gz_in.read(65536), b''):
-                        mbox_f.write(chunk)
-            import_path = mbox_path
-        else:
-            import_path = raw_path
-
+            fileobj = gzip.GzipFile(fileobj=fileobj, mode='rb')
         private = list_visibility == 'private'
-        loader = Loader(import_path, listname=list_name, private=private)
+        loader = StreamLoader(
+            fileobj,
+            listname=list_name,
+            private=private,
+            resume=resume,
+            source=source,
+            size=size)
         loader.process()
         logger.info(f'import_mbox_url_task: imported {url} into {list_name}, stats={loader.stats}')
     except Exception as err:
         logger.error(f'import_mbox_url_task: failed for {url}: {err}')
     finally:
         response.close()
-        for path in temp_files:
-            try:
-                os.unlink(path)
-            except OSError:
-                pass
 
 
 # --------------------------------------------------
@@ -263,6 +332,15 @@ def update_mbox_files_task():
         logger.error(f"Error in update_mbox_files_task: {err}")
 
 
+@shared_task
+def update_index_task():
+    '''Index messages updated since the last run, see update_index --incremental'''
+    try:
+        call_command('update_index', incremental=True, verbosity=0)
+    except Exception as err:
+        logger.error(f"Error in update_index_task: {err}")
+
+
 @shared_task
 def init_private_list_members_task():
     '''Initialize the private list membership'''
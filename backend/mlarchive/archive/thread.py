@@ -24,15 +24,21 @@ from builtins import input
 import re
 
 from collections import defaultdict, namedtuple, OrderedDict
-from operator import methodcaller
+from operator import attrgetter, methodcaller
 
 CONTAINER_COUNT = 0
 DEBUG = False
 MESSAGE_ID_RE = re.compile(r'<(.*?)>')
 
+# the message fields needed to place a new message in a threaded list, see
+# get_insert_position()
+ThreadRow = namedtuple('ThreadRow', ['msgid', 'date', 'references', 'in_reply_to_value',
+                                     'thread_order', 'thread_depth'])
+
 
 class Container(object):
     '''Used to construct the thread ordering then discarded'''
+    __slots__ = ('message', 'parent', 'child', 'next', 'depth')
 
     def __init__(self, message=None):
         self.message = message
@@ -69,18 +75,19 @@ class Container(object):
             return '{} ({})'.format(subject, self.message.msgid)
 
     def has_ancestor(self, target):
-        '''Returns True if target is an ancestor'''
-        if self.parent is None:
-            return False
-        elif self.parent == target:
-            return True
-        else:
-            return self.parent.has_ancestor(target)
+        '''Returns True if target is an ancestor.  Follows parent links, so the
+        cost is the depth of the container'''
+        container = self.parent
+        while container is not None:
+            if container is target:
+                return True
+            container = container.parent
+        return False
 
     def has_descendent(self, target):
-        '''Returns True if the target is a descendent'''
-        flat = [c for c in self.walk()]
-        return target in flat
+        '''Returns True if the target is a descendent (or self).  Checked from
+        target up, rather than by walking the subtree'''
+        return target is self or target.has_ancestor(self)
 
     def has_relative(self, target):
         '''Returns True if target is either an ancestor or descendent'''
@@ -91,23 +98,23 @@ class Container(object):
         return self.message is None
 
     def reverse_children(self):
-        '''Reverse order of children'''
-        if self.child:
+        '''Reverse order of children, at every level below this container'''
+        stack = [self]
+        while stack:
+            container = stack.pop()
             prev = None
-            kid = self.child
-            rest = kid.next
+            kid = container.child
             while kid:
+                rest = kid.next
                 kid.next = prev
-
-                # continue
                 prev = kid
                 kid = rest
-                rest = None if rest is None else rest.next
-            self.child = prev
+            container.child = prev
 
-            kid = self.child
+            kid = container.child
             while kid:
-                kid.reverse_children()
+                if kid.child:
+                    stack.append(kid)
                 kid = kid.next
 
     def sort_date(self):
@@ -124,17 +131,17 @@ class Container(object):
 
     def walk(self, depth=0):
         '''Returns a generator that walks the tree and returns
-        containers'''
-        container = self
-        while container:
+        containers, depth first.  At depth 0 the siblings (next) of
+        this container are not included'''
+        stack = [(self, depth)]
+        while stack:
+            container, depth = stack.pop()
             container.depth = depth
             yield container
+            if container.next and depth != 0:
+                stack.append((container.next, depth))
             if container.child:
-                for c in container.child.walk(depth=depth + 1):
-                    yield c
-            if depth == 0:
-                break
-            container = container.next
+                stack.append((container.child, depth + 1))
 
 
 def build_container(message, id_table, bogus_id_count):
@@ -289,6 +296,79 @@ def reconcile_thread(thread_data):
             message.save()
 
 
+def get_insert_position(rows, message):
+    '''Returns (order, depth) of a new message in an already threaded thread,
+    without recomputing the thread.  rows is a list of ThreadRow, one for each
+    message in the thread.  This handles the common case, a reply to a message
+    in the thread which is newer than the replies already there.  Returns None
+    if the new message could change the position of existing messages, in which
+    case use compute_thread()
+    '''
+    if not rows:
+        return None
+    rows = sorted(rows, key=attrgetter('thread_order'))
+    by_msgid = {row.msgid: row for row in rows}
+    if len(by_msgid) != len(rows):
+        return None
+
+    # the thread must be a single branch, either a message at order 0 or the
+    # children of an empty container, starting at order 1
+    start = 0 if rows[0].thread_depth == 0 else 1
+    if [row.thread_order for row in rows] != list(range(start, start + len(rows))):
+        return None
+
+    # rebuild the parent of each row from the stored depths
+    parents = {}
+    path = []
+    for row in rows:
+        depth = row.thread_depth - start
+        if depth < 0 or depth > len(path) or (depth == 0 and path and start == 0):
+            return None
+        del path[depth:]
+        parents[row.msgid] = path[-1] if path else None
+        path.append(row)
+
+    row_refs = {row.msgid: get_references_or_in_reply_to(row) for row in rows}
+    referenced = set()
+    for refs in row_refs.values():
+        referenced.update(refs)
+    if message.msgid in by_msgid or message.msgid in referenced:
+        return None
+
+    refs = get_references_or_in_reply_to(message)
+    if not refs or refs[-1] not in by_msgid or message.msgid in refs:
+        return None
+    for index, ref in enumerate(refs):
+        row = by_msgid.get(ref)
+        if row is None:
+            # an unknown reference is discarded as an empty container unless
+            # existing messages refer to it too
+            if ref in referenced:
+                return None
+        elif index > 0:
+            # build_container() links each reference to the previous one,
+            # unless it already has a parent from its own references
+            parent = parents[ref]
+            if parent is None or row_refs[ref][-1:] != [parent.msgid]:
+                return None
+
+    # the new message becomes the last child of the last reference
+    parent = by_msgid[refs[-1]]
+    # gather_subjects() moves messages under a root, the position of a new
+    # reply among them depends on how the subjects are regrouped
+    if start == 1 and parent.thread_depth == start:
+        return None
+    order = parent.thread_order + 1
+    for row in rows[parent.thread_order - start + 1:]:
+        if row.thread_depth <= parent.thread_depth:
+            break
+        if row.thread_depth == parent.thread_depth + 1:
+            if row.date >= message.date or row_refs[row.msgid][-1:] != [parent.msgid]:
+                return None
+        order = row.thread_order + 1
+    return order, parent.thread_depth + 1
+
+
 def container_stats(parent, id_table):
     '''Show container stats for help in debugging'''
     empty = 0
@@ -337,10 +417,9 @@ def display_thread(parent):
 
 def find_root(node):
     '''Find the top level node'''
-    if not node.parent:
-        return node
-    else:
-        return find_root(node.parent)
+    while node.parent:
+        node = node.parent
+    return node
 
 
 def find_root_set(id_table):
@@ -360,12 +439,17 @@ def find_root_set(id_table):
 
 def gather_siblings(parent, siblings):
     '''Build mapping of parent to list of children containers'''
-    container = parent.child
-    while container:
-        siblings[container.parent].append(container)
-        if container.child:
-            gather_siblings(container, siblings)
-        container = container.next
+    stack = [parent]
+    while stack:
+        parent = stack.pop()
+        container = parent.child
+        parents = []
+        while container:
+            siblings[container.parent].append(container)
+            if container.child:
+                parents.append(container)
+            container = container.next
+        stack.extend(reversed(parents))
 
 
 def gather_subjects(root_node):
@@ -505,6 +589,17 @@ def prune_empty_containers(parent):
     After calling this, there will only be empty container objects
     at depth 0, and those will all have at least two kids
     '''
+    parents = [parent]
+    while parents:
+        parent = parents.pop()
+        prune_children(parent, parents)
+
+
+def prune_children(parent, parents):
+    '''Prune empty containers from the children of parent, see
+    prune_empty_containers().  Children which have children of their own
+    are added to parents, to be pruned in turn
+    '''
     prev = None
     container = parent.child
     if container is None:
@@ -542,7 +637,7 @@ def prune_empty_containers(parent):
             container = prev
 
         elif container.child:
-            prune_empty_containers(container)
+            parents.append(container)
 
         # continue with loop
         prev = container
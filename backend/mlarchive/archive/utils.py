@@ -16,7 +16,9 @@ import shutil
 import subprocess
 import sys
 import time
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from itertools import groupby
+from operator import attrgetter
 from pathlib import Path
 
 import mailmanclient
@@ -24,6 +26,7 @@ from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.core.cache import cache
 from django.db import connection
+from django.utils import timezone
 from django.http import HttpResponse
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
@@ -32,11 +35,12 @@ from django.test import RequestFactory
 from django.urls import reverse
 
 from mlarchive.archive.models import (EmailList, Subscriber, Redirect, UserEmail, MailmanMember,
-    User, Message)
+    User, Message, Thread)
 from mlarchive.archive.mail import MessageWrapper, archive_message
 from mlarchive.archive.storage_utils import (retrieve_bytes, store_bytes, exists_in_storage,
     remove_from_storage)
 from mlarchive.archive.inspectors import is_no_archive
+from mlarchive.archive.thread import compute_thread
 from mlarchive.blobdb.models import Blob
 
 
@@ -45,6 +49,11 @@ THREAD_SORT_FIELDS = ('-thread__date', 'thread_id', 'thread_order')
 LIST_LISTS_PATTERN = re.compile(r'\s*([\w\-]*) - (.*)$')
 MAILMAN_LISTID_PATTERN = re.compile(r'(.*)\.(ietf|irtf|iab|iesg|rfc-editor)\.org')
 
+# the Message columns needed to thread a message, see rethread_list()
+RethreadRow = namedtuple('RethreadRow', ['id', 'thread_id', 'hashcode', 'msgid', 'date',
+                                         'references', 'in_reply_to_value', 'subject',
+                                         'base_subject', 'thread_order', 'thread_depth'])
+
 # --------------------------------------------------
 # Helper Functions
 # --------------------------------------------------
@@ -1096,7 +1105,7 @@ def purge_nfs_incoming():
 
             # header-only test, so check before anything that needs the hash.
             # NoArchiveInspector drops these without storing, so no blob is expected
-            if is_no_archive(mw.email_message):
+            if is_no_archive(mw.headers):
                 os.remove(entry.path)
                 stats['purged_no_archive'] += 1
                 continue
@@ -1168,6 +1177,58 @@ def move_list(source, target):
         Redirect.objects.create(old=old_url, new=new_url)
 
 
+def rethread_list(email_list, start_date=None, end_date=None, batch_size=1000):
+    '''Recompute thread_order and thread_depth of messages in email_list.  With
+    start_date and/or end_date, every thread with a message in the range is
+    recomputed.  Reads only the columns in RethreadRow and saves changes with
+    bulk_update, no signals are sent, so the search index must be updated
+    afterwards (changed messages get a new "updated" time).  The ordered
+    Thread.message_ids of every processed thread are rewritten.  Returns a tuple
+    (threads, changed)
+    '''
+    messages = Message.objects.filter(email_list=email_list)
+    if start_date or end_date:
+        in_range = messages
+        if start_date:
+            in_range = in_range.filter(date__gte=start_date)
+        if end_date:
+            in_range = in_range.filter(date__lte=end_date)
+        messages = messages.filter(thread_id__in=in_range.values('thread_id'))
+    rows = messages.order_by('thread_id', 'date', 'id').values_list(
+        *RethreadRow._fields).iterator(chunk_size=batch_size)
+
+    threads = 0
+    changed = 0
+    pending = []
+    pending_threads = []
+    for thread_id, thread_rows in groupby(map(RethreadRow._make, rows), key=attrgetter('thread_id')):
+        threads += 1
+        now = timezone.now()
+        infos = compute_thread(list(thread_rows)).values()
+        for info in infos:
+            row = info.message
+            if row.thread_order != info.order or row.thread_depth != info.depth:
+                pending.append(Message(id=row.id, thread_order=info.order,
+                                       thread_depth=info.depth, updated=now))
+        ordered = sorted(infos, key=attrgetter('order'))
+        pending_threads.append(Thread(id=thread_id, message_ids=[i.message.id for i in ordered]))
+        if len(pending) >= batch_size or len(pending_threads) >= batch_size:
+            changed += _save_rethread(pending, pending_threads, batch_size)
+            pending = []
+            pending_threads = []
+    changed += _save_rethread(pending, pending_threads, batch_size)
+    return threads, changed
+
+
+def _save_rethread(messages, threads, batch_size):
+    if messages:
+        Message.objects.bulk_update(messages, ['thread_order', 'thread_depth', 'updated'],
+                                    batch_size=batch_size)
+    if threads:
+        Thread.objects.bulk_update(threads, ['message_ids'], batch_size=batch_size)
+    return len(messages)
+
+
 def get_known_emails(email):
     '''Calls Datatracker API to retrieve all known emails related to given email'''
     url = settings.DATATRACKER_EMAIL_RELATED_URL.format(email=email)
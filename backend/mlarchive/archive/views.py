@@ -43,7 +43,7 @@ from mlarchive.archive.view_funcs import (initialize_formsets, get_columns, get_
     get_query_neighbors, get_query_string, get_lists_for_user, get_random_token)
 
 from mlarchive.archive.models import (EmailList, Message, Thread, Attachment,
-    Subscriber)
+    Subscriber, get_thread_messages)
 from mlarchive.archive.forms import (AdminForm, AdminActionForm, 
     AdvancedSearchForm, BrowseForm, RulesForm, SearchForm, DateForm)
 
@@ -464,7 +464,7 @@ class CustomBrowseView(CustomSearchView):
                 results = []
                 thread = index_message.thread
                 while len(results) < self.results_per_page and thread:
-                    results.extend(thread.message_set.order_by('thread_order'))
+                    results.extend(thread.get_messages())
                     thread = thread.get_previous()  # default ordering is descending by thread date
             else:
                 results = Message.objects.filter(
@@ -585,8 +585,10 @@ class BaseStaticIndexView(View):
         if self.group_by_thread:
             # two-step query to avoid inefficient INNER JOIN
             self.filters['email_list'] = self.kwargs['email_list']
-            threads = [t.id for t in Thread.objects.filter(**self.filters)]
-            self.queryset = kwargs['email_list'].message_set.filter(thread_id__in=threads).order_by(*self.order_fields)
+            threads = list(Thread.objects.filter(**self.filters).order_by('-date', 'id'))
+            # lazy queryset for the redirect check, which only needs the count and last message
+            self.queryset = kwargs['email_list'].message_set.filter(
+                thread_id__in=[t.id for t in threads]).order_by(*self.order_fields)
 
         else:
             self.queryset = kwargs['email_list'].message_set.filter(**self.filters).order_by(*self.order_fields)
@@ -595,6 +597,10 @@ class BaseStaticIndexView(View):
         if redirect:
             return redirect
 
+        if self.group_by_thread:
+            # threads in index order, messages from the stored thread order
+            self.queryset = get_thread_messages(threads)
+
         context = self.get_context_data()
         return self.render_to_response(context)
 
@@ -61,6 +61,8 @@ env = environ.Env(
     ELASTICSEARCH_HOST=(str, '127.0.0.1'),
     ELASTICSEARCH_PASSWORD=(str, 'changeme'),
     ELASTICSEARCH_SIGNAL_PROCESSOR=(str, 'mlarchive.archive.signals.CelerySignalProcessor'),
+    ELASTICSEARCH_POOL_MAXSIZE=(int, 10),   # persistent connections per node, per process
+    ELASTICSEARCH_TIMEOUT=(int, 10),        # seconds
     EXPORT_LIMIT=(int, 5000),
     HTAUTH_PASSWD_FILENAME=(str, ''),
     IMPORT_MESSAGE_APIKEY=(str, ''),
@@ -260,6 +262,10 @@ STORAGES = {
         "BACKEND": "mlarchive.blobdb.storage.BlobdbStorage",
         "OPTIONS": {"bucket_name": 'ml-messages-spam'},
     },
+    'ml-messages-text': {
+        "BACKEND": "mlarchive.blobdb.storage.BlobdbStorage",
+        "OPTIONS": {"bucket_name": 'ml-messages-text'},
+    },
     'ml-templates': {
         "BACKEND": "mlarchive.blobdb.storage.BlobdbStorage",
         "OPTIONS": {"bucket_name": 'ml-templates'},
@@ -276,9 +282,13 @@ ARTIFACT_STORAGE_NAMES: list[str] = [
     "ml-messages-filtered",
     "ml-messages-dupes",
     "ml-messages-spam",
+    "ml-messages-text",
 ]
 
 ENABLE_BLOBSTORAGE = True
+# store archived message blobs from a celery task (store_message_blob_task)
+# rather than in the archive_message() call
+BLOB_WRITE_BEHIND = True
 BLOBDB_DATABASE = 'blobdb'
 BLOBDB_REPLICATION = {
     "ENABLED": env('BLOBDB_REPLICATION_ENABLED'),
@@ -290,7 +300,8 @@ BLOBDB_REPLICATION = {
         "ml-messages-incoming",
         "ml-messages-filtered",
         "ml-messages-dupes",
-        "ml-messages-spam"],
+        "ml-messages-spam",
+        "ml-messages-text"],
     "VERBOSE_LOGGING": True,
 }
 
@@ -316,10 +327,22 @@ ELASTICSEARCH_CONNECTION = {
     'URL': ES_URL,
     'INDEX_NAME': 'mail-archive',
     'http_auth': ('elastic', env('ELASTICSEARCH_PASSWORD')),
+    # passed to the client, see backends.elasticsearch.get_client()
+    'KWARGS': {
+        'maxsize': env('ELASTICSEARCH_POOL_MAXSIZE'),
+        'timeout': env('ELASTICSEARCH_TIMEOUT'),
+    },
 }
 ELASTICSEARCH_DEFAULT_OPERATOR = 'AND'
 ELASTICSEARCH_RESULTS_PER_PAGE = 40
 ELASTICSEARCH_SIGNAL_PROCESSOR = env('ELASTICSEARCH_SIGNAL_PROCESSOR')
+# refresh option of index writes made by the signal processors: False to let
+# the index refresh interval make them visible, 'wait_for' to wait for the
+# next refresh, True to refresh right away
+ELASTICSEARCH_WRITE_REFRESH = False
+# documents per bulk request, and bulk requests sent in parallel, see ESBackend.update()
+ELASTICSEARCH_BULK_CHUNK_SIZE = 500
+ELASTICSEARCH_BULK_THREADS = 4
 
 
 """
@@ -436,6 +459,10 @@ IMPORT_MBOX_APIKEY = env('IMPORT_MBOX_APIKEY')
 
 # admin import mbox settings
 IMPORT_MBOX_MAX_SIZE = 1_800_000_000  # 1.8 GB
+# messages loaded between import progress checkpoints, see mail.Loader
+IMPORT_CHECKPOINT_INTERVAL = 1000
+# recently resolved message ids kept in memory during a load, see mail.MessageIdResolver
+IMPORT_MSGID_CACHE_SIZE = 10000
 
 # API KEYS: key=endpoint, value=[api-key,]
 SEARCH_MESSAGE_APIKEY = env('SEARCH_MESSAGE_APIKEY')
@@ -512,6 +539,12 @@ CELERY_BROKER_URL = env('CELERY_BROKER_URL')
 CELERY_TIMEZONE = 'America/Los_Angeles'
 CELERY_ENABLE_UTC = True
 CELERY_DEFAULT_TASK = 'mlarchive.archive.tasks.CelerySignalHandler'
+CELERY_BATCH_TASK = 'mlarchive.archive.tasks.CelerySignalBatchHandler'
+CELERY_THREAD_ORDER_TASK = 'mlarchive.archive.tasks.update_thread_order_task'
+CELERY_THREAD_DATE_TASK = 'mlarchive.archive.tasks.update_thread_date_task'
+# index changes are sent to Celery in batches, see signals.IndexBatcher
+CELERY_INDEX_BATCH_WINDOW = 2   # seconds
+CELERY_INDEX_BATCH_SIZE = 500
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 CELERY_HAYSTACK_DEFAULT_ALIAS = 'default'
 CELERY_HAYSTACK_MAX_RETRIES = 1
@@ -56,6 +56,8 @@ ELASTICSEARCH_CONNECTION = {
     'http_auth': ('elastic', 'changeme'),
 }
 ELASTICSEARCH_SIGNAL_PROCESSOR = 'mlarchive.archive.signals.RealtimeSignalProcessor'
+# tests search right after saving
+ELASTICSEARCH_WRITE_REFRESH = True
 
 # use standard default of 20 as it's easier to test
 ELASTICSEARCH_RESULTS_PER_PAGE = 20
@@ -85,3 +87,6 @@ EXPORT_DIR = os.path.join(DATA_ROOT, 'export')
 
 # CLOUDFLARE  INTEGRATION
 USING_CDN = False
+
+# store message blobs synchronously
+BLOB_WRITE_BEHIND = False
@@ -9,7 +9,7 @@ from unittest.mock import patch
 
 from django.urls import reverse
 from factories import EmailListFactory, MessageFactory
-from mlarchive.archive.models import Subscriber, Message, EmailList
+from mlarchive.archive.models import Subscriber, Message, EmailList, ImportCheckpoint
 from mlarchive.blobdb.models import Blob
 from mlarchive.archive.storage_utils import exists_in_storage
 
@@ -608,6 +608,27 @@ def test_import_mbox_task(settings):
         import_mbox_url_task('ancp', 'public', 'https://example.com/ancp.mbox')
 
     assert Message.objects.filter(email_list__name='ancp').exists()
+    # without a size the content can't be identified, no resume
+    assert not ImportCheckpoint.objects.exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_mbox_task_checkpoint(settings):
+    from mlarchive.archive.tasks import import_mbox_url_task
+    mbox_path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mbox.1')
+    with open(mbox_path, 'rb') as f:
+        mbox_content = f.read()
+
+    mock_response = _make_mock_response(mbox_content)
+    mock_response.headers['Content-Length'] = str(len(mbox_content))
+    mock_response.headers['ETag'] = '"abc"'
+    with patch('mlarchive.archive.tasks.requests.get', return_value=mock_response):
+        import_mbox_url_task('ancp', 'public', 'https://example.com/ancp.mbox')
+
+    checkpoint = ImportCheckpoint.objects.get()
+    assert checkpoint.source == 'https://example.com/ancp.mbox "abc"'
+    assert checkpoint.size == len(mbox_content)
+    assert checkpoint.completed
 
 
 @pytest.mark.django_db(transaction=True)
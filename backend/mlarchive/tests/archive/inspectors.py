@@ -2,9 +2,11 @@ import email
 import os
 import pytest
 
+from django.core.exceptions import ImproperlyConfigured
+
 from mlarchive.archive.inspectors import (ListIdSpamInspector, SpamMessage,
     SpamLevelSpamInspector, NoArchiveInspector, NoArchiveMessage,
-    LongMessageIDSpamInspector)
+    LongMessageIDSpamInspector, SpamInspector, get_inspectors)
 from mlarchive.archive.mail import MessageWrapper
 
 
@@ -95,3 +97,39 @@ def test_LongMessageIDSpamInspector(client, settings):
         inspector.inspect()
     print(excinfo)
     assert 'Spam' in str(excinfo.value)
+
+
+class BodySpamInspector(SpamInspector):
+    '''Test inspector that needs the message body'''
+    def has_condition(self):
+        return 'buy now' in self.message_wrapper.email_message.get_payload()
+
+
+def test_get_inspectors(settings):
+    settings.INSPECTORS = {
+        'BodySpamInspector': {},
+        'NoArchiveInspector': {},
+        'SpamLevelSpamInspector': {'includes': ['acme']},
+    }
+    assert get_inspectors() == [
+        (NoArchiveInspector, {}),
+        (SpamLevelSpamInspector, {'includes': ['acme']}),
+        (BodySpamInspector, {})]
+    # resolved once
+    assert get_inspectors() is get_inspectors()
+    settings.INSPECTORS = {'MissingInspector': {}}
+    with pytest.raises(ImproperlyConfigured):
+        get_inspectors()
+
+
+def test_MessageWrapper_inspect(settings):
+    settings.INSPECTORS = {'BodySpamInspector': {}, 'NoArchiveInspector': {}}
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mail_noarchive.1')
+    with open(path) as f:
+        message = email.message_from_file(f)
+    mw = MessageWrapper.from_message(message, 'acme')
+    mw.inspect(header_only=False)
+    assert list(mw.inspector_times) == ['BodySpamInspector']
+    with pytest.raises(NoArchiveMessage):
+        mw.inspect()
+    assert 'NoArchiveInspector' in mw.inspector_times
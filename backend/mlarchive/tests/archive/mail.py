@@ -20,11 +20,12 @@ from django.urls import reverse
 from django.utils.timezone import is_aware
 from factories import EmailListFactory, MessageFactory, ThreadFactory
 
-from mlarchive.archive.models import Message, EmailList
-from mlarchive.archive.mail import (archive_message, clean_spaces, MessageWrapper,
+from mlarchive.archive.models import Message, EmailList, ImportCheckpoint
+from mlarchive.archive.mail import (archive_message, clean_spaces, Loader, MessageWrapper,
     get_base_subject, get_envelope_date, get_from, get_header_date, get_mb,
     get_received_date, parsedate_to_datetime, subject_is_reply,
-    lookup_extension, get_message_from_bytes, make_hash)
+    lookup_extension, get_message_from_bytes, make_hash, ChunkStream, CustomMMDF, MappedMbox,
+    MboxStream, MessageIdResolver, SizeLimitExceeded, UnknownFormat, write_file)
 from mlarchive.archive.storage_utils import (exists_in_storage, retrieve_bytes,
     retrieve_str)
 from mlarchive.utils.test_utils import message_from_file, is_email_message, is_json
@@ -335,6 +336,99 @@ def test_get_mb():
         assert len(mb) > 0
 
 
+def test_get_mb_mmdf():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mailbox_mmdf')
+    mb = get_mb(path)
+    assert isinstance(mb, CustomMMDF)
+    assert len(mb) > 0
+    assert mb[0].get('Message-ID')
+    mb.close()
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'From a\nSubject: one\n\nbody\n\nFrom b\nSubject: two\n\nbody\n',
+    b'From a\nSubject: one\n\nbody\nFrom b\nSubject: two\n\nbody\n\n',
+    b'From a\nSubject: one\n\n\nFrom b\nFrom c\n',
+    b'\nFrom a\nSubject: one\n\nbody',
+    b'junk\nFrom a\nSubject: one\n\n>From b\n\n',
+])
+def test_MappedMbox_toc(tmpdir, data):
+    path = str(tmpdir.join('mbox'))
+    with open(path, 'wb') as f:
+        f.write(data)
+    expected = mailbox.mbox(path)
+    mb = MappedMbox(path)
+    assert mb._lookup() is None
+    expected._lookup()
+    assert mb._toc == expected._toc
+    assert [m.as_bytes() for m in mb] == [m.as_bytes() for m in expected]
+    assert [m.get_from() for m in mb] == [m.get_from() for m in expected]
+    mb.close()
+    expected.close()
+
+
+def test_MappedMbox_toc_data_files():
+    files = glob.glob(os.path.join(settings.BASE_DIR, 'tests', 'data', '*.mbox'))
+    files.extend(glob.glob(os.path.join(settings.BASE_DIR, 'tests', 'data', '*.mail')))
+    for path in files:
+        expected = mailbox.mbox(path)
+        mb = MappedMbox(path)
+        assert mb.keys() == expected.keys()
+        assert mb._toc == expected._toc
+        for key in mb.keys():
+            assert mb.get_bytes(key) == expected.get_bytes(key)
+        mb.close()
+        expected.close()
+
+
+def test_MboxStream():
+    files = glob.glob(os.path.join(settings.BASE_DIR, 'tests', 'data', '*.mbox'))
+    for path in files:
+        expected = mailbox.mbox(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        chunks = [data[i:i + 1000] for i in range(0, len(data), 1000)]
+        fileobj = io.BufferedReader(ChunkStream(chunks))
+        messages = list(MboxStream(fileobj).iter_messages())
+        assert [m.as_bytes() for _, m in messages] == [m.as_bytes() for m in expected]
+        assert [m.get_from() for _, m in messages] == [m.get_from() for m in expected]
+        starts = [expected._toc[k + 1][0] for k in range(len(expected) - 1)]
+        assert [offset for offset, _ in messages] == starts + [len(data)]
+        expected.close()
+
+
+def test_MboxStream_mmdf():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'mailbox_mmdf')
+    expected = get_mb(path)
+    with open(path, 'rb') as f:
+        messages = list(MboxStream(f).iter_messages())
+        assert [m.as_bytes() for _, m in messages] == [m.as_bytes() for m in expected]
+        # resume after the first message
+        f.seek(0)
+        rest = list(MboxStream(f).iter_messages(offset=messages[0][0]))
+        assert [m.as_bytes() for _, m in rest] == [m.as_bytes() for _, m in messages[1:]]
+    expected.close()
+
+
+def test_MboxStream_unknown_format():
+    with pytest.raises(UnknownFormat):
+        list(MboxStream(io.BytesIO(b'\nSubject: one\n\nbody\n')).iter_messages())
+
+
+def test_MboxStream_offset():
+    data = b'From a\nSubject: one\n\nbody\n\nFrom b\nSubject: two\n\nbody\n'
+    messages = list(MboxStream(io.BytesIO(data)).iter_messages(offset=data.index(b'From b')))
+    assert len(messages) == 1
+    assert messages[0][1]['subject'] == 'two'
+
+
+def test_ChunkStream_max_size():
+    stream = io.BufferedReader(ChunkStream([b'x' * 100, b'x' * 100], max_size=150))
+    with pytest.raises(SizeLimitExceeded):
+        stream.read()
+
+
 def test_get_received_date():
     data = '''Received: from mail.ietf.org ([64.170.98.30]) by localhost \
 (ietfa.amsl.com [127.0.0.1]) (amavisd-new, port 10024) with ESMTP id oE4MnXBb8IJ9 \
@@ -375,6 +469,95 @@ def test_subject_is_reply():
 
 # def test_Loader()
 
+
+@pytest.mark.django_db(transaction=True)
+def test_Loader_batch_size():
+    """Bulk mode should produce the same threading as the one at a time mode"""
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'thread.mail')
+    loader = Loader(path, listname='acme', test=True)
+    loader.process()
+    expected = [(m.msgid, m.thread.first.msgid, m.thread_order, m.thread_depth)
+                for m in Message.objects.order_by('date')]
+    Message.objects.all().delete()
+    loader = Loader(path, listname='acme', test=True, batch_size=3)
+    loader.process()
+    messages = Message.objects.order_by('date')
+    result = [(m.msgid, m.thread.first.msgid, m.thread_order, m.thread_depth) for m in messages]
+    assert loader.stats['count'] == 4
+    assert loader.stats['errors'] == 0
+    assert result == expected
+
+
+@pytest.mark.django_db(transaction=True)
+def test_Loader_resume():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'thread.mail')
+    mb = mailbox.mbox(path)
+    start, stop = mb._lookup(2)
+    checkpoint = ImportCheckpoint.objects.create(
+        source='{} {}'.format(os.path.abspath(path), os.stat(path).st_mtime_ns),
+        listname='acme',
+        size=os.path.getsize(path),
+        offset=start,
+        count=2)
+    loader = Loader(path, listname='acme', test=True, resume=True)
+    loader.process()
+    assert loader.stats['count'] == 2
+    assert Message.objects.count() == 2
+    checkpoint.refresh_from_db()
+    assert checkpoint.completed is True
+    assert checkpoint.count == 4
+    assert checkpoint.offset == os.path.getsize(path)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_Loader_resume_stale_checkpoint(tmp_path):
+    '''A checkpoint of a file that changed since is not resumed'''
+    path = str(tmp_path / 'thread.mail')
+    shutil.copy(os.path.join(settings.BASE_DIR, 'tests', 'data', 'thread.mail'), path)
+    start, stop = mailbox.mbox(path)._lookup(2)
+    source = '{} {}'.format(os.path.abspath(path), os.stat(path).st_mtime_ns)
+    # size changed
+    ImportCheckpoint.objects.create(source=source, listname='acme', size=os.path.getsize(path) + 1,
+                                    offset=start, count=2)
+    # modification time changed
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    ImportCheckpoint.objects.create(source=source, listname='acme', size=os.path.getsize(path),
+                                    offset=start, count=2)
+    loader = Loader(path, listname='acme', test=True, resume=True)
+    loader.process()
+    assert loader.stats['count'] == 4
+    assert Message.objects.count() == 4
+    assert loader.checkpoint.completed is True
+    assert ImportCheckpoint.objects.filter(completed=False).count() == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_Loader_batch_size_duplicates():
+    path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'duplicate_tests.mbox')
+    loader = Loader(path, listname='acme', test=True, batch_size=100)
+    loader.process()
+    assert Message.objects.count() == 2
+    assert Message.objects.filter(msgid='control-msg-001@example.com').count() == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_MessageIdResolver(django_assert_num_queries):
+    elist = EmailListFactory.create(name='public')
+    thread = ThreadFactory.create()
+    msg1 = MessageFactory.create(email_list=elist, thread=thread, msgid='001@example.com')
+    msg2 = MessageFactory.create(email_list=elist, thread=thread, msgid='002@example.com')
+    MessageFactory.create(email_list=EmailListFactory.create(name='other'), msgid='003@example.com')
+    resolver = MessageIdResolver('public', cache_size=10)
+    with django_assert_num_queries(1):
+        result = resolver.resolve(['001@example.com', '002@example.com', '003@example.com'])
+    assert result == {'001@example.com': (msg1.pk, thread.pk), '002@example.com': (msg2.pk, thread.pk)}
+    # cached
+    with django_assert_num_queries(0):
+        result = resolver.resolve(['001@example.com', '002@example.com'])
+    assert len(result) == 2
+
+
 # --------------------------------------------------
 # MessageWrapper
 # --------------------------------------------------
@@ -385,6 +568,24 @@ def test_MessageWrapper_from_bytes():
     assert isinstance(mw, MessageWrapper)
 
 
+def test_MessageWrapper_from_bytes_headers_first():
+    mw = MessageWrapper.from_bytes(SIMPLE_MESSAGE_BYTES, 'public')
+    assert mw.msgid == '0000000002@example.com'
+    assert mw.get_subject() == 'This is a test'
+    assert mw.date == datetime.datetime(2013, 11, 7, 17, 54, 55, tzinfo=timezone.utc)
+    # body not parsed yet
+    assert mw._email_message is None
+    assert 'This is a test email' in mw.email_message.get_content()
+    assert mw.headers is mw.email_message
+
+
+def test_MessageWrapper_from_bytes_no_msgid():
+    data = SIMPLE_MESSAGE_BYTES.replace(b'Message-ID: <0000000002@example.com>\n', b'')
+    mw = MessageWrapper.from_bytes(data, 'public')
+    assert mw.created_id
+    assert mw.email_message['Message-ID'] == mw.msgid
+
+
 def test_MessageWrapper_from_message():
     msg = email.message_from_bytes(SIMPLE_MESSAGE_BYTES)
     mw = MessageWrapper.from_message(msg, 'acme')
@@ -493,6 +694,42 @@ This is the message.
     assert mw.get_thread_from_header(mw.references) == message.thread
 
 
+@pytest.mark.django_db(transaction=True)
+def test_MessageWrapper_save_insert_thread():
+    '''A reply is placed in the existing thread without recomputing it,
+    later messages move down one place'''
+    elist = EmailListFactory.create(name='public')
+    thread = ThreadFactory.create()
+    for num, references in enumerate(['', '<001@example.com>', '<001@example.com>']):
+        MessageFactory.create(
+            email_list=elist,
+            msgid='00{}@example.com'.format(num + 1),
+            references=references,
+            thread=thread,
+            thread_depth=1 if references else 0,
+            thread_order=num,
+            date=datetime.datetime(2016, 1, num + 1, tzinfo=timezone.utc))
+    data = '''From: joe@example.com
+To: larry@example.com
+Subject: Re: New document
+References: <001@example.com> <002@example.com>
+Message-Id: <004@example.com>
+Date: Mon, 24 Feb 2016 08:04:41 -0800
+
+This is the message.
+'''
+    msg = email.message_from_string(data)
+    mw = MessageWrapper.from_message(msg, 'public')
+    mw.save(test=True)
+    assert mw.thread_info is None
+    messages = thread.message_set.order_by('thread_order')
+    assert [(m.msgid, m.thread_order, m.thread_depth) for m in messages] == [
+        ('001@example.com', 0, 0),
+        ('002@example.com', 1, 1),
+        ('004@example.com', 2, 2),
+        ('003@example.com', 3, 1)]
+
+
 def test_MessageWrapper_get_to():
     data = '''From: joe@acme.com
 To: larry@acme.com
@@ -559,6 +796,27 @@ def test_MessageWrapper_process_attachments_rfc2231_filename():
     assert attachment.name == u'satellite-\u6d77\u6dc0\u533a\u5317\u6d3c\u8def4\u53f7.png'
 
 
+@pytest.mark.django_db(transaction=True)
+def test_MessageWrapper_write_msg_write_behind(settings, tmpdir, monkeypatch):
+    '''With BLOB_WRITE_BEHIND the blob is queued with the original message'''
+    from mlarchive.archive import tasks
+    settings.BLOB_WRITE_BEHIND = True
+    settings.ARCHIVE_DIR = str(tmpdir)
+    queued = []
+    monkeypatch.setattr(tasks.store_message_blob_task, 'delay', lambda *args: queued.append(args))
+    mw = MessageWrapper.from_bytes(SIMPLE_MESSAGE_BYTES, 'public')
+    mw.process()
+    mw.write_msg()
+    blob_name = 'public/' + mw.hashcode.rstrip('=')
+    assert len(queued) == 1
+    assert queued[0][1:] == ('ml-messages', blob_name)
+    assert not exists_in_storage('ml-messages', blob_name)
+    # the task doesn't need the archive file
+    os.remove(os.path.join(str(tmpdir), 'public', mw.hashcode))
+    tasks.store_message_blob_task(*queued[0])
+    assert retrieve_bytes('ml-messages', blob_name) == SIMPLE_MESSAGE_BYTES
+
+
 def test_lookup_extension():
     assert lookup_extension('text/plain') == 'txt'
     assert lookup_extension('text/unknown_stuff') == 'txt'
@@ -593,3 +851,17 @@ def test_get_mail_from_bytes():
 
 # test various exceptions raised
 # test that older message added causes update to all tdates in index
+
+
+@pytest.mark.parametrize('data,expected', [
+    (b'a\nb\n', b'a\r\nb\r\n'),
+    (b'a\r\nb\n', b'a\r\nb\r\n'),
+    (b'a\rb\r\n', b'a\r\nb\r\n'),
+    (b'a', b'a'),
+])
+def test_write_file(tmpdir, data, expected):
+    path = os.path.join(str(tmpdir), 'list', 'message')
+    assert write_file(path, data) == expected
+    with open(path, 'rb') as f:
+        assert f.read() == expected
+    assert os.stat(path).st_mode & 0o777 == 0o666
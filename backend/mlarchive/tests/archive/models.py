@@ -9,7 +9,9 @@ from factories import EmailListFactory, ThreadFactory, MessageFactory
 from django.urls import reverse
 from django.utils.encoding import smart_str
 from django.utils.http import urlencode
-from mlarchive.archive.models import Message, Attachment, is_attachment, get_message_from_binary_file
+from mlarchive.archive.models import (Message, Attachment, SubjectThread, Thread, is_attachment,
+    get_message_from_binary_file, get_subject_thread, get_thread_messages, update_subject_threads)
+from mlarchive.archive.storage_utils import exists_in_storage, remove_from_storage, retrieve_str, store_str
 from mlarchive.utils.test_utils import message_from_file, load_message
 from mlarchive.utils.encoding import get_filename
 
@@ -71,6 +73,28 @@ def test_message_pymsg_error(client):
     assert msg.pymsg_error == 'Error reading message file'
 
 
+@pytest.mark.django_db(transaction=True)
+def test_message_get_body(client):
+    load_message('reply_to_url.mail')
+    msg = Message.objects.first()
+    name = msg.get_text_blob_name()
+    remove_from_storage('ml-messages-text', name, warn_if_missing=False)
+    body = msg.get_body()
+    assert 'This is a test' in body
+    assert retrieve_str('ml-messages-text', name) == body
+    # later calls use the stored text
+    store_str('ml-messages-text', name, 'stored text', allow_overwrite=True)
+    assert Message.objects.get(pk=msg.pk).get_body() == 'stored text'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_message_get_body_error(client):
+    elist = EmailListFactory.create(name='public')
+    msg = MessageFactory.create(email_list=elist)
+    assert msg.get_body() == 'Error reading message file'
+    assert not exists_in_storage('ml-messages-text', msg.get_text_blob_name())
+
+
 @pytest.mark.django_db(transaction=True)
 def test_message_get_reply_url(client):
     load_message('reply_to_url.mail')
@@ -301,6 +325,114 @@ def test_thread_get_snippet(client):
     assert message.thread.get_snippet()
 
 
+@pytest.mark.django_db(transaction=True)
+def test_thread_update_message_ids(client):
+    elist = EmailListFactory.create()
+    thread = ThreadFactory.create(email_list=elist)
+    message1 = MessageFactory.create(
+        email_list=elist,
+        thread=thread,
+        thread_order=2,
+        date=datetime.datetime(2016, 1, 1, tzinfo=timezone.utc))
+    message2 = MessageFactory.create(
+        email_list=elist,
+        thread=thread,
+        thread_order=1,
+        date=datetime.datetime(2016, 1, 2, tzinfo=timezone.utc))
+    # no stored ids, falls back to query
+    assert thread.get_messages() == [message2, message1]
+    thread.update_message_ids()
+    thread.refresh_from_db()
+    assert thread.message_ids == [message2.pk, message1.pk]
+    assert get_thread_messages([thread]) == [message2, message1]
+    # deleting a message updates stored ids
+    message2.delete()
+    thread.refresh_from_db()
+    assert thread.message_ids == [message1.pk]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_thread_update_message_ids_bulk_delete(client, monkeypatch):
+    elist = EmailListFactory.create()
+    thread = ThreadFactory.create(email_list=elist)
+    messages = [MessageFactory.create(email_list=elist, thread=thread, thread_order=i) for i in range(4)]
+    thread.update_message_ids()
+    calls = []
+    update_message_ids = Thread.update_message_ids
+    monkeypatch.setattr(Thread, 'update_message_ids', lambda self: calls.append(self.pk) or update_message_ids(self))
+    # the thread is updated once, after the messages are deleted
+    Message.objects.filter(pk__in=[m.pk for m in messages[:3]]).delete()
+    assert calls == [thread.pk]
+    thread.refresh_from_db()
+    assert thread.message_ids == [messages[3].pk]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_thread_messages_no_stored_ids(client, django_assert_num_queries):
+    elist = EmailListFactory.create()
+    thread1 = ThreadFactory.create(email_list=elist)
+    thread2 = ThreadFactory.create(email_list=elist)
+    message1 = MessageFactory.create(email_list=elist, thread=thread1, thread_order=1)
+    message2 = MessageFactory.create(email_list=elist, thread=thread1, thread_order=0)
+    message3 = MessageFactory.create(email_list=elist, thread=thread2, thread_order=0)
+    threads = list(Thread.objects.filter(pk__in=[thread1.pk, thread2.pk]).order_by('pk'))
+    # one query for all threads
+    with django_assert_num_queries(1):
+        assert get_thread_messages(threads) == [message2, message1, message3]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_message_next_in_thread_stale_ids(client):
+    '''Stored message ids that don't include the message are not used'''
+    elist = EmailListFactory.create()
+    thread = ThreadFactory.create(email_list=elist)
+    message1 = MessageFactory.create(email_list=elist, thread=thread, thread_order=0)
+    message2 = MessageFactory.create(email_list=elist, thread=thread, thread_order=1)
+    message3 = MessageFactory.create(email_list=elist, thread=thread, thread_order=2)
+    Thread.objects.filter(pk=thread.pk).update(message_ids=[message1.pk, message3.pk])
+    message2.thread.refresh_from_db()
+    assert message2.next_in_thread() == message3
+    assert message2.previous_in_thread() == message1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_get_subject_thread(client):
+    elist = EmailListFactory.create()
+    thread1 = ThreadFactory.create(email_list=elist)
+    thread2 = ThreadFactory.create(email_list=elist)
+    MessageFactory.create(
+        email_list=elist,
+        thread=thread1,
+        base_subject='New Members',
+        date=datetime.datetime(2016, 1, 1, tzinfo=timezone.utc))
+    message2 = MessageFactory.create(
+        email_list=elist,
+        thread=thread2,
+        base_subject='New Members',
+        date=datetime.datetime(2016, 1, 10, tzinfo=timezone.utc))
+    entry = SubjectThread.objects.get(email_list=elist, base_subject='New Members')
+    assert entry.thread == thread2
+    entry = get_subject_thread(elist, 'New Members', datetime.datetime(2016, 2, 1, tzinfo=timezone.utc))
+    assert entry.thread == thread2
+    # older than the latest message, found by query
+    entry = get_subject_thread(elist, 'New Members', datetime.datetime(2016, 1, 5, tzinfo=timezone.utc))
+    assert entry.thread == thread1
+    assert get_subject_thread(elist, 'New Members', datetime.datetime(2015, 1, 1, tzinfo=timezone.utc)) is None
+    assert get_subject_thread(elist, 'Other', datetime.datetime(2016, 2, 1, tzinfo=timezone.utc)) is None
+    # an older message doesn't replace the entry
+    update_subject_threads([MessageFactory.create(
+        email_list=elist,
+        thread=thread1,
+        base_subject='New Members',
+        date=datetime.datetime(2016, 1, 2, tzinfo=timezone.utc))])
+    assert SubjectThread.objects.get(email_list=elist, base_subject='New Members').thread == thread2
+    # removing the latest message falls back to the previous one
+    message2.delete()
+    entry = SubjectThread.objects.get(email_list=elist, base_subject='New Members')
+    assert entry.thread == thread1
+    assert entry.date == datetime.datetime(2016, 1, 2, tzinfo=timezone.utc)
+
+
 @pytest.mark.django_db(transaction=True)
 def test_attachment_get_sub_message(client, attachment_messages_no_index):
     attachment = Attachment.objects.first()
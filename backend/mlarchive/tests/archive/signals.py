@@ -1,12 +1,16 @@
 import datetime
 import os
 import pytest
+from celery.signals import task_postrun
 from datetime import timezone
+from django.core.signals import request_finished
 
 from factories import EmailListFactory, ThreadFactory, MessageFactory
 
 from mlarchive.archive.models import EmailList, Message, Thread
-from mlarchive.archive.signals import get_purge_cache_urls, get_purge_cache_tags
+from mlarchive.archive import signals
+from mlarchive.archive.signals import (get_purge_cache_urls, get_purge_cache_tags, CelerySignalProcessor,
+    IndexBatcher)
 
 
 @pytest.mark.django_db(transaction=True)
@@ -88,3 +92,106 @@ def test_get_purge_cache_tags_neighbor_threads(client):
     assert prev_msg.get_cache_tag() in tags
     assert next_msg.get_cache_tag() in tags
     assert len(set(tags)) == 3
+
+
+def test_index_batcher(monkeypatch):
+    sent = []
+
+    class FakeTask:
+        def apply_async(self, args):
+            sent.append(args)
+
+    monkeypatch.setattr(signals, 'get_update_task', lambda name=None: FakeTask())
+    batcher = IndexBatcher(window=60, size=3)
+    batcher.add('update', 'archive.message.1', 1)
+    batcher.add('update', 'archive.message.2', 2)
+    # repeated changes to one message are collapsed
+    batcher.add('update', 'archive.message.1', 1)
+    assert sent == []
+    assert batcher.timer is not None
+    batcher.add('delete', 'archive.message.3', 3)
+    assert sent == [([1, 2], ['archive.message.3'])]
+    assert batcher.timer is None
+    # window expiry or process exit sends the rest
+    batcher.add('delete', 'archive.message.2', 2)
+    batcher.flush()
+    assert sent[1] == ([], ['archive.message.2'])
+    batcher.flush()
+    assert len(sent) == 2
+
+
+def test_celery_signal_processor_thread_tasks(monkeypatch, settings):
+    '''Thread changes are queued as tasks, which can be retried'''
+    sent = []
+
+    class FakeTask:
+        def __init__(self, name):
+            self.name = name
+
+        def apply_async(self, args):
+            sent.append((self.name, args))
+
+    monkeypatch.setattr(signals, 'get_update_task', lambda name=None: FakeTask(name))
+    # no transaction, send right away
+    monkeypatch.setattr(signals.transaction, 'on_commit', lambda func: func())
+    processor = CelerySignalProcessor(None)
+    try:
+        processor.handle_thread_shift(Message, thread_id=1, start=3, exclude=5)
+        processor.handle_thread_date(Thread, thread_id=1, date=datetime.datetime.now(timezone.utc))
+    finally:
+        processor.teardown()
+    assert sent == [(settings.CELERY_THREAD_ORDER_TASK, (1, 3)),
+                    (settings.CELERY_THREAD_DATE_TASK, (1,))]
+
+
+def test_index_batcher_delete(monkeypatch):
+    '''Deletes are sent right away, with pending updates'''
+    sent = []
+
+    class FakeTask:
+        def apply_async(self, args):
+            sent.append(args)
+
+    monkeypatch.setattr(signals, 'get_update_task', lambda name=None: FakeTask())
+    batcher = IndexBatcher(window=60, size=100)
+    batcher.add('update', 'archive.message.1', 1)
+    assert sent == []
+    batcher.add('delete', 'archive.message.2', 2)
+    assert sent == [([1], ['archive.message.2'])]
+    assert batcher.timer is None
+
+
+def test_celery_signal_processor_flush(monkeypatch):
+    '''Pending updates are sent at the end of each task and request'''
+    sent = []
+
+    class FakeTask:
+        def apply_async(self, args):
+            sent.append(args)
+
+    monkeypatch.setattr(signals, 'get_update_task', lambda name=None: FakeTask())
+    processor = CelerySignalProcessor(None)
+    try:
+        processor.batcher.add('update', 'archive.message.1', 1)
+        assert sent == []
+        task_postrun.send(sender=None)
+        assert sent == [([1], [])]
+        processor.batcher.add('update', 'archive.message.2', 2)
+        request_finished.send(sender=None)
+        assert sent[1] == ([2], [])
+    finally:
+        processor.teardown()
+        processor.batcher.flush()
+
+
+def test_index_batcher_no_window(monkeypatch):
+    sent = []
+
+    class FakeTask:
+        def apply_async(self, args):
+            sent.append(args)
+
+    monkeypatch.setattr(signals, 'get_update_task', lambda name=None: FakeTask())
+    batcher = IndexBatcher(window=0, size=100)
+    batcher.add('update', 'archive.message.1', 1)
+    assert sent == [([1], [])]
@@ -4,13 +4,17 @@ from datetime import timezone
 from io import StringIO
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.models import F
 from elasticsearch.exceptions import NotFoundError
 from elasticsearch_dsl import Search
 from factories import EmailListFactory, ThreadFactory, MessageFactory
 
-from mlarchive.archive.models import Message
-from mlarchive.archive.backends.elasticsearch import ESBackend
+from mlarchive.archive.models import IndexWatermark, Message
+from mlarchive.archive.backends.elasticsearch import ESBackend, ElasticsearchSimpleQuery, get_client
+from mlarchive.archive.management.commands.update_index import get_batch_ranges
 
 
 @pytest.mark.django_db(transaction=True)
@@ -25,6 +29,14 @@ def test_clear_index(search_api_messages):
     assert s.count() == 0
 
 
+def test_get_client(settings):
+    client = get_client()
+    assert ESBackend().client is client
+    assert ElasticsearchSimpleQuery().client is client
+    settings.ELASTICSEARCH_INDEX_NAME = settings.ELASTICSEARCH_INDEX_NAME
+    assert get_client() is not client
+
+
 @pytest.mark.django_db(transaction=True)
 def test_rebuild_index(db_only):
     client = ESBackend().client
@@ -57,6 +69,103 @@ def test_rebuild_index(db_only):
     assert sorted(index_msgids) == ['x003', 'x004']
 
 
+@pytest.mark.django_db(transaction=True)
+def test_thread_date_changed(db_only):
+    msg = Message.objects.get(msgid='x003')
+    date = datetime.datetime(2000, 1, 1, tzinfo=timezone.utc)
+    # an earlier message becomes the first of the thread
+    MessageFactory.create(email_list=msg.email_list,
+                          thread=msg.thread,
+                          msgid='x004',
+                          date=date)
+    msg.thread.refresh_from_db()
+    assert msg.thread.date == date
+    client = ESBackend().client
+    s = Search(using=client, index=settings.ELASTICSEARCH_INDEX_NAME)
+    s = s.filter('term', thread_id=msg.thread_id)
+    hits = list(s.scan())
+    assert len(hits) == msg.thread.message_set.count()
+    assert set(h.thread_date for h in hits) == {date.isoformat()}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_update_thread_order_task(db_only):
+    from mlarchive.archive.tasks import update_thread_order_task
+    msg = Message.objects.get(msgid='x003')
+    Message.objects.filter(thread=msg.thread).update(thread_order=F('thread_order') + 1)
+    # repeating the task gives the same result
+    update_thread_order_task(msg.thread_id, 0)
+    update_thread_order_task(msg.thread_id, 0)
+    client = ESBackend().client
+    s = Search(using=client, index=settings.ELASTICSEARCH_INDEX_NAME)
+    s = s.filter('term', thread_id=msg.thread_id)
+    orders = dict(Message.objects.filter(thread=msg.thread).values_list('msgid', 'thread_order'))
+    assert {h.msgid: h.thread_order for h in s.scan()} == orders
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rebuild_index_switches_alias(db_only):
+    backend = ESBackend()
+    old_indices = backend.get_alias_indices()
+    assert len(old_indices) == 1
+    out = StringIO()
+    call_command('rebuild_index', interactive=False, stdout=out)
+    new_indices = backend.get_alias_indices()
+    assert len(new_indices) == 1
+    assert new_indices != old_indices
+    assert new_indices[0].startswith(settings.ELASTICSEARCH_INDEX_NAME + '-')
+    assert 'switched to {}'.format(new_indices[0]) in out.getvalue()
+    # old index is removed, new one is back to normal settings
+    assert not backend.client.indices.exists(index=old_indices[0])
+    index_settings = backend.client.indices.get_settings(index=new_indices[0])
+    assert 'refresh_interval' not in index_settings[new_indices[0]]['settings']['index']
+    assert Search(using=backend.client, index=settings.ELASTICSEARCH_INDEX_NAME).count() == 3
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rebuild_index_removes_deleted(db_only, monkeypatch):
+    '''Messages deleted while the new index is built are removed from it'''
+    backend = ESBackend()
+    finish_bulk = ESBackend.finish_bulk
+
+    def delete_and_finish(self, index_name):
+        Message.objects.get(msgid='x001').delete()
+        finish_bulk(self, index_name)
+
+    monkeypatch.setattr(ESBackend, 'finish_bulk', delete_and_finish)
+    out = StringIO()
+    call_command('rebuild_index', interactive=False, stdout=out)
+    assert 'removed 1 stale records' in out.getvalue()
+    s = Search(using=backend.client, index=settings.ELASTICSEARCH_INDEX_NAME)
+    assert sorted(h.msgid for h in s.scan()) == ['x002', 'x003']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rebuild_index_failure(db_only, monkeypatch):
+    '''A failed build leaves the live index alone and deletes the new one'''
+    backend = ESBackend()
+    old_indices = backend.get_alias_indices()
+
+    def fail(self, index_name):
+        raise RuntimeError('build failed')
+
+    monkeypatch.setattr(ESBackend, 'finish_bulk', fail)
+    with pytest.raises(RuntimeError):
+        call_command('rebuild_index', interactive=False, stdout=StringIO())
+    assert backend.get_alias_indices() == old_indices
+    indices = backend.client.indices.get(index=settings.ELASTICSEARCH_INDEX_NAME + '-*')
+    assert list(indices) == old_indices
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rebuild_index_in_place(db_only):
+    backend = ESBackend()
+    out = StringIO()
+    call_command('rebuild_index', interactive=False, in_place=True, stdout=out)
+    assert 'Indexing 3 Messages' in out.getvalue()
+    assert Search(using=backend.client, index=settings.ELASTICSEARCH_INDEX_NAME).count() == 3
+
+
 @pytest.mark.django_db(transaction=True)
 def test_update_index(db_only):
     index = settings.ELASTICSEARCH_INDEX_NAME
@@ -83,6 +192,55 @@ def test_update_index(db_only):
     assert doc['_source']['subject'] == 'This is a test message'
 
 
+def test_get_batch_ranges():
+    class FakeQuerySet:
+        def __init__(self, pks):
+            self.pks = pks
+
+        def values_list(self, *fields, **kwargs):
+            return self
+
+        def iterator(self, chunk_size=None):
+            return iter(self.pks)
+
+    assert get_batch_ranges(FakeQuerySet([]), 2) == []
+    assert get_batch_ranges(FakeQuerySet([3, 5, 8, 9]), 2) == [(0, 5, 2), (5, 9, 2)]
+    assert get_batch_ranges(FakeQuerySet([3, 5, 8, 9, 12]), 2) == [(0, 5, 2), (5, 9, 2), (9, 12, 1)]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_update_index_workers(db_only):
+    index = settings.ELASTICSEARCH_INDEX_NAME
+    out = StringIO()
+    call_command('clear_index', interactive=False, stdout=out)
+    client = ESBackend().client
+    s = Search(using=client, index=index)
+    assert s.count() == 0
+    out = StringIO()
+    call_command('update_index', workers=2, batchsize=1, verbosity=2, stdout=out)
+    assert 'Indexing 3 Messages' in out.getvalue()
+    assert 'indexed 3 of 3 with 2 workers' in out.getvalue()
+    s = Search(using=client, index=index)
+    assert s.count() == 3
+    assert set(h.msgid for h in s.scan()) == set(Message.objects.values_list('msgid', flat=True))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_update_index_prepare_workers(db_only, settings):
+    # chunks of one message, sent with parallel_bulk
+    settings.ELASTICSEARCH_BULK_CHUNK_SIZE = 1
+    index = settings.ELASTICSEARCH_INDEX_NAME
+    out = StringIO()
+    call_command('clear_index', interactive=False, stdout=out)
+    client = ESBackend().client
+    out = StringIO()
+    call_command('update_index', prepare_workers=2, verbosity=2, stdout=out)
+    assert 'Indexing 3 Messages' in out.getvalue()
+    s = Search(using=client, index=index)
+    assert s.count() == 3
+    assert set(h.msgid for h in s.scan()) == set(Message.objects.values_list('msgid', flat=True))
+
+
 @pytest.mark.django_db(transaction=True)
 def test_update_index_date_range(db_only):
     index = settings.ELASTICSEARCH_INDEX_NAME
@@ -126,6 +284,67 @@ def test_update_index_age(db_only):
     assert doc['_source']['msgid'] == 'x003'
 
 
+@pytest.mark.django_db(transaction=True)
+def test_update_index_incremental(db_only):
+    index = settings.ELASTICSEARCH_INDEX_NAME
+    out = StringIO()
+    call_command('clear_index', interactive=False, stdout=out)
+    # a full run sets the watermark
+    out = StringIO()
+    call_command('update_index', stdout=out)
+    assert 'Indexing 3 Messages' in out.getvalue()
+    watermark = IndexWatermark.objects.get(name=index)
+    # only messages updated since the last run
+    Message.objects.filter(msgid='x001').update(
+        spam_score=1,
+        updated=watermark.value + datetime.timedelta(minutes=1))
+    out = StringIO()
+    call_command('update_index', incremental=True, stdout=out)
+    assert 'Indexing 1 Messages' in out.getvalue()
+    assert IndexWatermark.objects.get(name=index).value > watermark.value
+    client = ESBackend().client
+    msg = Message.objects.get(msgid='x001')
+    doc = client.get(index=index, id='archive.message.{}'.format(msg.pk))
+    assert doc['_source']['spam_score'] == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_update_index_incremental_other_index(db_only):
+    '''The watermark is kept per index'''
+    backend = ESBackend()
+    index_name = backend.create_index()
+    try:
+        call_command('update_index', index_name=index_name, stdout=StringIO())
+        call_command('update_index', incremental=True, index_name=index_name, stdout=StringIO())
+        assert IndexWatermark.objects.filter(name=index_name).exists()
+        assert not IndexWatermark.objects.filter(name=settings.ELASTICSEARCH_INDEX_NAME).exists()
+    finally:
+        backend.delete_index(index_name)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_update_index_incremental_no_watermark():
+    '''An incremental run without a watermark fails instead of indexing everything'''
+    with pytest.raises(CommandError) as excinfo:
+        call_command('update_index', incremental=True, stdout=StringIO())
+    assert 'No incremental watermark' in str(excinfo.value)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_update_index_incremental_locked(settings):
+    '''Incremental runs of an index don't overlap'''
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    IndexWatermark.objects.create(name=settings.ELASTICSEARCH_INDEX_NAME, value=datetime.datetime.now(timezone.utc))
+    key = 'update_index_incremental:{}'.format(settings.ELASTICSEARCH_INDEX_NAME)
+    assert cache.add(key, 1)
+    try:
+        with pytest.raises(CommandError) as excinfo:
+            call_command('update_index', incremental=True, stdout=StringIO())
+        assert 'already running' in str(excinfo.value)
+    finally:
+        cache.delete(key)
+
+
 @pytest.mark.django_db(transaction=True)
 def test_update_index_remove(db_only):
     client = ESBackend().client
@@ -147,6 +366,27 @@ def test_update_index_remove(db_only):
         assert 'NotFoundError' in str(excinfo.value)
 
 
+@pytest.mark.django_db(transaction=True)
+def test_update_index_remove_stale(db_only):
+    index = settings.ELASTICSEARCH_INDEX_NAME
+    client = ESBackend().client
+    # records without a database row, before, between and after the messages
+    pks = list(Message.objects.order_by('pk').values_list('pk', flat=True))
+    stale = [0, pks[0] + 1 if pks[0] + 1 not in pks else pks[-1] + 2, pks[-1] + 1000]
+    for pk in stale:
+        client.index(index=index, id='archive.message.{}'.format(pk),
+                     body={'django_id': pk, 'id': 'archive.message.{}'.format(pk)},
+                     refresh=True)
+    assert Search(using=client, index=index).count() == 6
+    out = StringIO()
+    call_command('update_index', remove=True, batchsize=2, stdout=out)
+    assert 'removed 3 stale records' in out.getvalue()
+    client.indices.refresh(index=index)
+    s = Search(using=client, index=index)
+    assert s.count() == 3
+    assert sorted(int(h.django_id) for h in s.scan()) == pks
+
+
 @pytest.mark.django_db(transaction=True)
 def test_simple():
     pubone = EmailListFactory.create(name='pubone')
@@ -1,4 +1,5 @@
 import datetime
+import random
 from datetime import timezone
 from collections import namedtuple, defaultdict
 
@@ -7,7 +8,8 @@ from factories import EmailListFactory, MessageFactory, ThreadFactory
 from mlarchive.archive.thread import (Container, process, build_container,
     count_root_set, find_root, find_root_set, subject_is_reply,
     gather_subjects, prune_empty_containers, sort_thread, compute_thread,
-    gather_siblings, get_in_reply_to, get_references_or_in_reply_to)
+    gather_siblings, get_in_reply_to, get_references_or_in_reply_to,
+    get_insert_position, ThreadRow)
 from mlarchive.archive.models import Message
 
 
@@ -137,6 +139,14 @@ def test_container_has_descendent():
     assert not tree.c3.has_descendent(tree.c1)
 
 
+def test_container_has_descendent_matches_walk():
+    tree = create_tree()
+    for container in tree:
+        descendents = list(container.walk())
+        for target in tree:
+            assert container.has_descendent(target) == (target in descendents)
+
+
 def test_container_has_relative():
     '''Test has_relative, finding element up or down tree'''
     tree = create_tree()
@@ -253,6 +263,91 @@ def test_get_in_reply_to():
     assert get_in_reply_to(message) == '002@example.com'
 
 
+SimpleMessage = namedtuple('SimpleMessage', ['msgid', 'date', 'references',
+    'in_reply_to_value', 'subject', 'base_subject', 'hashcode'])
+
+
+def random_message(rng, num, messages, base):
+    '''Returns a SimpleMessage replying to a random message of messages, with
+    the mix of header styles found in the archive'''
+    msgid = '{:03d}@example.com'.format(num)
+    date = base + datetime.timedelta(hours=rng.randint(num, num + 3))
+    references = in_reply_to = ''
+    if messages and rng.random() < 0.9:
+        parent = rng.choice(messages)
+        refs = get_references_or_in_reply_to(parent) + [parent.msgid]
+        style = rng.random()
+        if style < 0.1:
+            in_reply_to = '<{}>'.format(parent.msgid)
+        elif style < 0.2:
+            refs = ['missing{}@example.com'.format(num)] + refs[-1:]
+        elif style < 0.3:
+            refs = refs[-2:]
+        references = ' '.join('<{}>'.format(r) for r in refs)
+    subject = 'Re: Topic' if references or in_reply_to or rng.random() < 0.5 else 'Topic'
+    return SimpleMessage(msgid, date, references, in_reply_to, subject, 'Topic', msgid)
+
+
+def test_compute_thread_deep_chain():
+    '''A reply chain deeper than the recursion limit'''
+    base = datetime.datetime(2016, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    for num in range(5000):
+        msgid = '{}@example.com'.format(num)
+        references = '<{}@example.com>'.format(num - 1) if num else ''
+        messages.append(SimpleMessage(msgid, base + datetime.timedelta(minutes=num),
+                                      references, '', 'Re: Topic', 'Topic', msgid))
+    info = compute_thread(messages)
+    assert [(i.order, i.depth) for i in info.values()] == [(n, n) for n in range(5000)]
+
+
+def test_get_insert_position():
+    '''Wherever get_insert_position() places a message, compute_thread()
+    must agree, including the positions of the existing messages'''
+    rng = random.Random(7)
+    base = datetime.datetime(2016, 1, 1, tzinfo=timezone.utc)
+    placed = 0
+    for _ in range(300):
+        messages = []
+        for num in range(rng.randint(1, 12)):
+            messages.append(random_message(rng, num, messages, base))
+        messages.sort(key=lambda m: m.date)
+        info = compute_thread(messages)
+        rows = [ThreadRow(m.msgid, m.date, m.references, m.in_reply_to_value,
+                          info[m.hashcode].order, info[m.hashcode].depth) for m in messages]
+        new = random_message(rng, 100, messages, base + datetime.timedelta(hours=10))
+        position = get_insert_position(rows, new)
+        if position is None:
+            continue
+        placed += 1
+        expected = compute_thread(messages + [new])
+        assert position == (expected[new.hashcode].order, expected[new.hashcode].depth)
+        for row, message in zip(rows, messages):
+            order = row.thread_order + 1 if row.thread_order >= position[0] else row.thread_order
+            assert (order, row.thread_depth) == (expected[message.hashcode].order,
+                                                 expected[message.hashcode].depth)
+    assert placed > 50
+
+
+def test_get_insert_position_fallback():
+    base = datetime.datetime(2016, 1, 1, tzinfo=timezone.utc)
+    rows = [ThreadRow('001@example.com', base, '', '', 0, 0),
+            ThreadRow('002@example.com', base + datetime.timedelta(days=1),
+                      '<001@example.com>', '', 1, 1)]
+    reply = SimpleMessage('003@example.com', base + datetime.timedelta(days=2),
+                          '<001@example.com>', '', 'Re: Topic', 'Topic', '003')
+    assert get_insert_position(rows, reply) == (2, 1)
+    # older than an existing reply
+    older = reply._replace(date=base)
+    assert get_insert_position(rows, older) is None
+    # no references
+    assert get_insert_position(rows, reply._replace(references='')) is None
+    # existing message refers to the new one
+    assert get_insert_position(rows, reply._replace(msgid='001@example.com')) is None
+    # stored order is not a single branch
+    assert get_insert_position(rows[:1] + [rows[1]._replace(thread_order=0)], reply) is None
+
+
 @pytest.mark.django_db(transaction=True)
 def test_get_references_or_in_reply_to():
     elist = EmailListFactory.create()
@@ -468,3 +563,23 @@ def test_subject_is_reply():
         date=datetime.datetime(2016, 1, 2, tzinfo=timezone.utc))
     assert subject_is_reply(message2)
     assert not subject_is_reply(message1)
+
+
+def test_get_insert_position_gathered_children():
+    '''Children of the root that were gathered by subject, not by references,
+    move when the root gets a reply'''
+    base = datetime.datetime(2016, 1, 1, tzinfo=timezone.utc)
+    messages = [
+        SimpleMessage('003@example.com', base, '<002@example.com>', '', 'Re: Topic', 'Topic', '003'),
+        SimpleMessage('002@example.com', base + datetime.timedelta(hours=4), '', '', 'Re: Topic', 'Topic', '002'),
+        SimpleMessage('000@example.com', base + datetime.timedelta(hours=8), '', '', 'Re: Other', 'Other', '000'),
+        SimpleMessage('001@example.com', base + datetime.timedelta(hours=10), '', '', 'Re: Topic', 'Topic', '001')]
+    info = compute_thread(messages)
+    rows = [ThreadRow(m.msgid, m.date, m.references, m.in_reply_to_value,
+                      info[m.hashcode].order, info[m.hashcode].depth) for m in messages]
+    assert [(r.thread_order, r.thread_depth) for r in rows] == [(2, 2), (1, 1), (0, 0), (3, 1)]
+    reply = SimpleMessage('100@example.com', base + datetime.timedelta(hours=20),
+                          '<000@example.com>', '', 'Re: Topic', 'Topic', '100')
+    expected = compute_thread(messages + [reply])
+    assert (expected[reply.hashcode].order, expected[reply.hashcode].depth) == (1, 1)
+    assert get_insert_position(rows, reply) is None
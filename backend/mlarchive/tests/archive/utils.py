@@ -5,7 +5,7 @@ import json
 import mailbox
 import pytest
 import requests
-from factories import EmailListFactory, MessageFactory, UserFactory
+from factories import EmailListFactory, MessageFactory, ThreadFactory, UserFactory
 from mock import patch
 import os
 import subprocess   # noqa
@@ -22,7 +22,8 @@ from mlarchive.archive.utils import (get_noauth, get_lists, get_lists_for_user,
     get_mailman_lists, get_membership, get_subscriber_counts, get_fqdn,
     update_mbox_files, _export_lists, move_list, remove_selected, mark_not_spam,
     is_duplicate_message, is_mailman_footer, import_message_blob,
-    create_cf_worker_templates, rebuild_json_blobs, _get_removed_message)
+    create_cf_worker_templates, rebuild_json_blobs, _get_removed_message,
+    rethread_list)
 from mlarchive.archive.models import User, Message, Redirect, MailmanMember, UserEmail
 from mlarchive.archive.mail import make_hash, archive_message, MessageWrapper
 from mlarchive.archive.forms import AdvancedSearchForm
@@ -568,6 +569,32 @@ def test_move_list(rf, search_api_messages):
     assert Message.objects.filter(email_list__name=target).count() == 4
 
 
+@pytest.mark.django_db(transaction=True)
+def test_rethread_list():
+    elist = EmailListFactory.create(name='public')
+    other = EmailListFactory.create(name='other')
+    thread = ThreadFactory.create()
+    for num, references in enumerate(['', '<001@example.com>', '<002@example.com>']):
+        MessageFactory.create(
+            email_list=elist,
+            msgid='00{}@example.com'.format(num + 1),
+            references=references,
+            thread=thread,
+            thread_depth=0,
+            thread_order=0,
+            date=datetime.datetime(2016, 1, num + 1, tzinfo=datetime.timezone.utc))
+    MessageFactory.create(email_list=other, thread=ThreadFactory.create(), thread_order=5)
+    threads, changed = rethread_list(elist)
+    assert (threads, changed) == (1, 2)
+    messages = thread.message_set.order_by('date')
+    assert [(m.thread_order, m.thread_depth) for m in messages] == [(0, 0), (1, 1), (2, 2)]
+    thread.refresh_from_db()
+    assert thread.message_ids == [m.pk for m in messages]
+    assert Message.objects.get(email_list=other).thread_order == 5
+    # date range outside the thread
+    assert rethread_list(elist, start_date=datetime.datetime(2017, 1, 1, tzinfo=datetime.timezone.utc)) == (0, 0)
+
+
 @pytest.mark.django_db(transaction=True)
 def test_remove_selected(client, search_api_messages_ford, users):
     user = User.objects.get(username='staff@example.com')
@@ -478,6 +478,16 @@ def test_browse_static_big_year_year(client, static_list, settings):
     assert 'public/2017-12' in smart_str(response.content)
 
 
+@pytest.mark.django_db(transaction=True)
+def test_browse_static_thread_big_year_year(client, static_list, settings):
+    settings.STATIC_INDEX_YEAR_MINIMUM = 20
+    url = reverse('archive_browse_static_thread', kwargs={'list_name': static_list.name, 'date': '2017'})
+    response = client.get(url)
+    assert response.status_code == 200
+    assert 'http-equiv="refresh"' in smart_str(response.content)
+    assert 'thread/2017-' in smart_str(response.content)
+
+
 @pytest.mark.django_db(transaction=True)
 def test_browse_static_redirect(client, static_list, settings):
     settings.STATIC_INDEX_YEAR_MINIMUM = 20
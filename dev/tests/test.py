@@ -60,6 +60,8 @@ ELASTICSEARCH_CONNECTION['URL'] = 'http://elasticsearch:9200/'
 ELASTICSEARCH_CONNECTION['INDEX_NAME'] = ELASTICSEARCH_INDEX_NAME
 
 ELASTICSEARCH_SIGNAL_PROCESSOR = 'mlarchive.archive.signals.RealtimeSignalProcessor'
+# tests search right after saving
+ELASTICSEARCH_WRITE_REFRESH = True
 
 # use standard default of 20 as it's easier to test
 ELASTICSEARCH_RESULTS_PER_PAGE = 20
@@ -89,3 +91,6 @@ EXPORT_DIR = os.path.join(DATA_ROOT, 'export')
 
 # CLOUDFLARE  INTEGRATION
 USING_CDN = False
+
+# store message blobs synchronously
+BLOB_WRITE_BEHIND = False